@@ -1,83 +1,180 @@
 import tkinter as tk
 from tkinter import messagebox, filedialog, ttk
 from pathlib import Path
-import requests #pip install requests  #Python 3.11.3 64-bit
-import json
-from datetime import datetime
-from PIL import Image, ImageTk   # Python 3.11.3 64-bit
+import threading
+import time
+import engine
+import metrics
+from gallery import Gallery
+from http_client import get_client
+from job_queue import JobQueue
+from key_pool import get_key_pool
+from pipeline import describe_pipeline, load_pipeline, render_pipeline_job
+from prompt_search import PromptIndex
+from rebuild import describe_stale, stale_jobs
+from result_cache import get_cache
+from run_journal import BuildManifest, manifest_path, run_path
+from scene_store import SceneStore
+from scheduler import Run, configure_scheduler, forecast, format_forecast, get_scheduler, using
+from single_flight import get_single_flight
+from stability_api import METHODS, check_strength
+from sweep import expand_grid, make_contact_sheet, parse_margins, parse_values, sheet_filename, variant_label
+from virtual_list import VirtualList
 
 # Initialize variables
 scenes = [] 
 current_json_file = None
-
-# URLs for the Stability AI API 
-core_url = 'https://api.stability.ai/v2beta/stable-image/generate/core' #  Stable Image Core API URL
-image_to_image_url = 'https://api.stability.ai/v2beta/stable-image/generate/ultra' # Stable Image Ultra Image-to-image API URL 
-structure_url = 'https://api.stability.ai/v2beta/stable-image/control/structure' # Structure API URL
-outpaint_url = 'https://api.stability.ai/v2beta/stable-image/edit/outpaint'  # Outpaint API URL
-
+scene_store = None
+loaded_scenes = 0  # scenes of the loading file already added to the list
+prompt_index = PromptIndex()
+shown_positions = []  # (scene_index, image_index) of each row in the list
+current_scene_index = None
+current_image_index = None
+
+# Generation jobs run on worker threads, started with the window
+job_queue = None
+sweeps = []  # running sweeps, waiting for their contact sheet
+interactive_run = Run('interactive', 'interactive')  # what single clicks are charged to
+warnings_shown = 0
+build_manifest = None  # what each position's latest output was made from, for the loaded file
 
 # Directory to save all generated images
 output_dir = 'generated_images'
-Path(output_dir).mkdir(parents=True, exist_ok=True)
+metrics_dir = Path(output_dir) / 'metrics'
 
 def load_json_file():
-    global scenes, current_json_file
+    """
+    Load a scene JSON file on a background thread; poll_loading() shows its scenes as they come in.
+    """
+    global scenes, current_json_file, scene_store, loaded_scenes
     file_path = filedialog.askopenfilename(title="Select JSON File", filetypes=[("JSON Files", "*.json")])
     if not file_path:
         return
 
-    try:
-        with open(file_path, 'r', encoding='utf-8') as file:
-            global data
-            data = json.load(file)
-
-            if 'scenes' not in data:
-                messagebox.showerror("Error", "The JSON file does not contain 'scenes'.")
-                return
-
-            scenes = data['scenes']
-            
-        current_json_file = Path(file_path).name
-        messagebox.showinfo("Success", f"Loaded JSON file: {current_json_file}")
+    # Write out anything still pending for the previous file
+    if scene_store is not None:
+        scene_store.close()
+
+    store = SceneStore(file_path)
+    scene_store = store
+    scenes = store.scenes
+    current_json_file = store.json_path  # full path, so saves go back to the loaded file
+    loaded_scenes = 0
+    prompt_index.build([])
+    search_entry.delete(0, tk.END)
+    show_positions(prompt_index.positions)
+    prompt_text.delete("1.0", tk.END)
+
+    errors = []
+
+    def load():
+        try:
+            store.load()
+        except ValueError as e:
+            errors.append(f"Failed to decode JSON: {e}")
+        except Exception as e:
+            errors.append(f"An unexpected error occurred: {e}")
+
+    thread = threading.Thread(target=load, name='scene-loader', daemon=True)
+    thread.start()
+    root.after(50, poll_loading, store, thread, errors, time.perf_counter())
+
+
+def poll_loading(store, thread, errors, started):
+    """
+    Add the scenes the loader has parsed since the last call to the list. Runs on the Tk
+    thread every 50 ms until the file is loaded.
+    """
+    global scenes, current_json_file, scene_store, loaded_scenes
+    if store is not scene_store:
+        return  # another file was opened meanwhile
+    finished = not thread.is_alive()
+    name = Path(store.json_path).name
+    if errors:
+        scenes, current_json_file, scene_store = [], None, None
         update_scene_options()
-    except json.JSONDecodeError:
-        messagebox.showerror("Error", "Failed to decode JSON. Please check the file format.")
-    except Exception as e:
-        messagebox.showerror("Error", f"An unexpected error occurred: {e}")
+        messagebox.showerror("Error", errors[0])
+        update_status()
+        return
+
+    if finished and store.recovered:
+        update_scene_options()  # the replayed edits changed prompts already listed
+        messagebox.showinfo("Success", f"Loaded JSON file: {name}\nRecovered {store.recovered} unsaved prompt edits.")
+    else:
+        board = store.board
+        listed = bool(prompt_index.positions)
+        for scene_index in range(loaded_scenes, board.loaded):
+            for image_index in range(board.image_count(scene_index)):
+                prompt_index.add(scene_index, image_index, board.description(scene_index, image_index))
+        loaded_scenes = board.loaded
+        if shown_positions is prompt_index.positions:
+            image_list.grow(len(shown_positions))
+            if not listed and shown_positions:
+                image_list.select(0)
+
+    if finished:
+        update_status(f"Loaded {name}: {len(prompt_index.positions)} images in {time.perf_counter() - started:.1f}s")
+    else:
+        update_status(f"Loading {name}: {loaded_scenes} scenes so far")
+        root.after(50, poll_loading, store, thread, errors, started)
+
+
+def still_loading():
+    if scene_store is not None and not scene_store.loaded:
+        messagebox.showinfo("Loading", "The JSON file is still loading; try again in a moment.")
+        return True
+    return False
 
 
 def update_scene_options(event=None):
-    if not scenes:
-        scene_index_combobox.set('')
-        image_index_combobox.set('')
+    """
+    Rebuild the search index and show every scene/image of the loaded file.
+    """
+    prompt_index.build(scenes)
+    search_entry.delete(0, tk.END)
+    show_positions(prompt_index.positions)
+    if shown_positions:
+        image_list.select(0)
+    else:
         prompt_text.delete("1.0", tk.END)
-        return
 
-    scene_indices = [str(i + 1) for i in range(len(scenes))]
-    scene_index_combobox['values'] = scene_indices
-    scene_index_combobox.set(scene_indices[0])  # Set default value to 1
-    update_image_options()
 
-def update_image_options(event=None):
-    if not scenes:
-        image_index_combobox['values'] = []
-        return
+def show_positions(positions):
+    global shown_positions
+    shown_positions = positions
+    image_list.set_count(len(positions), position_text)
+
+
+def position_text(row):
+    scene_index, image_index = shown_positions[row]
+    description = prompt_index.texts.get((scene_index, image_index), '')
+    return f"{scene_index + 1}.{image_index + 1}  {description[:40]}"
+
 
-    scene_index = int(scene_index_combobox.get()) - 1
-    image_indices = [str(i + 1) for i in range(len(scenes[scene_index]['scene']))]
-    image_index_combobox['values'] = image_indices
-    image_index_combobox.set(image_indices[0])  # Set default value to 1
+def select_position(row):
+    global current_scene_index, current_image_index
+    current_scene_index, current_image_index = shown_positions[row]
     update_prompt()
 
+
+def search_prompts(event=None):
+    """
+    Filter the scene/image list to the prompts matching the search box.
+    """
+    query = search_entry.get()
+    positions = prompt_index.search(query) if query.strip() else prompt_index.positions
+    show_positions(positions)
+    if positions:
+        image_list.select(0)
+    update_status(f"{len(positions)} matching prompts" if query.strip() else None)
+
+
 def update_prompt(event=None):
-    if not scenes:
+    if not scenes or current_scene_index is None:
         prompt_text.delete("1.0", tk.END)
         return
 
-    scene_index = int(scene_index_combobox.get()) - 1
-    image_index = int(image_index_combobox.get()) - 1
-    description = scenes[scene_index]['scene'][image_index]['image_description']
+    description = scene_store.board.description(current_scene_index, current_image_index)
     prompt_text.delete("1.0", tk.END)
     prompt_text.insert("1.0", description)
 
@@ -86,332 +183,415 @@ def save_prompt():
     if not scenes:
         messagebox.showerror("Error", "No JSON file loaded.")
         return
+    if still_loading():
+        return
 
-    scene_index = int(scene_index_combobox.get()) - 1
-    image_index = int(image_index_combobox.get()) - 1
+    scene_index = current_scene_index
+    image_index = current_image_index
     new_description = prompt_text.get("1.0", "end-1c")
 
-    scenes[scene_index]['scene'][image_index]['image_description'] = new_description
-    with open(current_json_file, 'w', encoding='utf-8') as file:
-        json.dump(data, file, ensure_ascii=False, indent=4)
+    # Journaled right away; the JSON file itself is rewritten in the background
+    scene_store.set_description(scene_index, image_index, new_description)
+    prompt_index.update(scene_index, image_index, new_description)
+    image_list.redraw()
+    update_status(f"Prompt for scene {scene_index + 1}, image {image_index + 1} saved")
 
-    messagebox.showinfo("Success", "Prompt description saved.")
 
+def on_close():
+    if scene_store is not None:
+        try:
+            scene_store.close()
+        except OSError as e:
+            messagebox.showerror("Error", f"Failed to save {current_json_file}: {e}")
+    if build_manifest is not None:
+        build_manifest.close()
+    metrics.get_recorder().write_prometheus(str(metrics_dir / 'metrics.prom'))
+    metrics.get_recorder().close()
+    root.destroy()
 
 
-def generate_image():
-    method = method_var.get()
+def select_reference_image():
+    return filedialog.askopenfilename(title="Select Reference Image", filetypes=[("Image Files", "*.png;*.jpg;*.jpeg;")])
+
+
+def read_form(method=None):
+    """
+    Read the generation parameters from the form. Returns None (after telling the user)
+    if something is missing or invalid, or the reference image dialog was cancelled.
+    method overrides the method picked in the form (a pipeline's first stage).
+    """
+    method = method or method_var.get()
     prompt = prompt_text.get("1.0", "end-1c")  # Fetch the text from the Text widget
-    seed = int(seed_entry.get())
     negative_prompt = negative_prompt_entry.get()  # Get the negative prompt value
 
-    # Get the image strength and control strength values from the entries
-    image_strength = image_strength_entry.get()
-    control_strength = control_strength_entry.get()
-
-    # Get Outpaint parameters
-    outpaint_left = int(outpaint_left_entry.get() or 0)
-    outpaint_right = int(outpaint_right_entry.get() or 0)
-    outpaint_up = int(outpaint_up_entry.get() or 0)
-    outpaint_down = int(outpaint_down_entry.get() or 0)
-
-    if method == 'Image Generation':
-        generate_image_from_prompt(prompt, seed, negative_prompt)
-    elif method == 'Image-to-Image':
-        reference_image_path = filedialog.askopenfilename(title="Select Reference Image", filetypes=[("Image Files", "*.png;*.jpg;*.jpeg;")])
-        if reference_image_path:
-            generate_image_to_image(prompt, reference_image_path, seed, float(image_strength),negative_prompt)
-    elif method == 'Image with Structure':
-        reference_image_path = filedialog.askopenfilename(title="Select Reference Image", filetypes=[("Image Files", "*.png;*.jpg;*.jpeg;")])
-        if reference_image_path:
-            generate_image_structure(prompt, reference_image_path, float(control_strength), seed, negative_prompt)
-    elif method == 'Outpaint':
-        reference_image_path = filedialog.askopenfilename(title="Select Reference Image", filetypes=[("Image Files", "*.png;*.jpg;*.jpeg;")])
-        if reference_image_path:
-            generate_outpaint(reference_image_path, outpaint_left, outpaint_right, outpaint_up, outpaint_down, prompt, seed)
-    else:
+    api_key = api_key_entry.get() or None  # None: draw keys from the key pool
+    if not api_key and get_key_pool() is None:
+        messagebox.showerror("Error", "API key is required (or set STABILITY_API_KEYS for a key pool).")
+        return None
+
+    try:
+        seed = int(seed_entry.get())
+
+        # Get the image strength and control strength values from the entries
+        image_strength = check_strength(image_strength_entry.get(), 'Image Strength')
+        control_strength = check_strength(control_strength_entry.get(), 'Control Strength')
+
+        # Get Outpaint parameters
+        outpaint_left = int(outpaint_left_entry.get() or 0)
+        outpaint_right = int(outpaint_right_entry.get() or 0)
+        outpaint_up = int(outpaint_up_entry.get() or 0)
+        outpaint_down = int(outpaint_down_entry.get() or 0)
+    except ValueError as e:
+        messagebox.showerror("Error", str(e))
+        return None
+
+    if method not in METHODS:
         messagebox.showerror("Error", "Please select a generation method.")
+        return None
 
+    reference_image_path = None
+    if method != 'Image Generation':
+        reference_image_path = select_reference_image()
+        if not reference_image_path:
+            return None
 
+    # Everything the worker needs, captured now so it never reads the widgets
+    return dict(get_naming(), method=method, api_key=api_key, reference_image=reference_image_path,
+                prompt=prompt, negative_prompt=negative_prompt, seed=seed,
+                image_strength=image_strength, control_strength=control_strength,
+                left=outpaint_left, right=outpaint_right, up=outpaint_up, down=outpaint_down)
 
-def resize_image(image_path, max_size=(1536, 1536)):
-    with Image.open(image_path) as img:
-        # Check if the image size exceeds the max_size
-        if img.width > max_size[0] or img.height > max_size[1]:
-            img.thumbnail(max_size, Image.LANCZOS)  # Use Image.LANCZOS for high-quality resizing
-            resized_path = image_path.replace('.', '_resized.')
-            img.save(resized_path)
-            return resized_path
-        else:
-            return image_path
 
-def get_filename(suffix, method='Image Generation'):
+def make_target(params, credit_run=None):
     """
-    Generate the filename based on the current method and whether a JSON file is loaded or not.
+    The function a worker runs for these parameters: engine.generate, traced and cancellable.
+    Its API call is charged to credit_run (a sweep), or as an interactive click.
     """
+    def generate(job):
+        with using(credit_run or interactive_run):
+            result = engine.generate(job.params['api_key'], job.params, output_dir,
+                                     check=job.check_cancelled, progress=job.set_progress)
+        return result['filename']
+    return lambda job: run_traced(job, generate)
 
-    # Get the current timestamp in the desired format
-    timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
 
+def run_traced(job, generate):
+    """
+    Run a generation inside a metrics trace, so its phase timings are recorded.
+    """
+    with metrics.trace(method=job.params['method'], job=job.id,
+                       scene_index=job.params['scene_index'], image_index=job.params['image_index']):
+        try:
+            return generate(job)
+        except Exception as e:
+            metrics.annotate(error=str(e))
+            raise
 
-    if scenes and current_json_file:
-        scene_index = int(scene_index_combobox.get()) - 1
-        image_index = int(image_index_combobox.get()) - 1
-        if method == 'Image Generation':
-            return f"{output_dir}/scene_{scene_index + 1}_image_{image_index + 1}_{timestamp}{suffix}"
-        elif method == 'Image-to-Image':
-            return f"{output_dir}/scene_{scene_index + 1}_image_{image_index + 1}_sample_1_{timestamp}{suffix}"
-        elif method == 'Image with Structure':
-            return f"{output_dir}/scene_{scene_index + 1}_image_{image_index + 1}_structure_{timestamp}{suffix}"
-        elif method == 'Outpaint':
-            return f"{output_dir}/scene_{scene_index + 1}_image_{image_index + 1}_outpaint_{timestamp}{suffix}"
-        else:
-            return f"{output_dir}/scene_{scene_index + 1}_image_{image_index + 1}_{timestamp}{suffix}"
-    else:
-        if method == 'Image Generation':
-            return f"{output_dir}/generated_image_{int(seed_entry.get())}_{timestamp}{suffix}"
-        elif method == 'Image-to-Image':
-            return f"{output_dir}/generated_image_{int(seed_entry.get())}_sample_1_{timestamp}{suffix}"
-        elif method == 'Image with Structure':
-            return f"{output_dir}/generated_image_{int(seed_entry.get())}_structure_{timestamp}{suffix}"
-        elif method == 'Outpaint':
-            return f"{output_dir}/generated_image_{int(seed_entry.get())}_outpaint_{timestamp}{suffix}"
-        else:
-            return f"{output_dir}/generated_image_{int(seed_entry.get())}_{timestamp}{suffix}"
-
-
-def generate_image_from_prompt(prompt, seed='', negative_prompt=''):
-    api_key = api_key_entry.get()
-    if not api_key:
-        messagebox.showerror("Error", "API key is required.")
-        return
 
-    headers = {
-        'Authorization': f'Bearer {api_key}',
-        'Accept': 'image/*',
-    }
+def submit_job(description, target, params, priority='batch'):
+    job = job_queue.submit(description, target, params, priority)
+    jobs_listbox.insert(tk.END, job_line(job))
+    return job
 
-    files = {
-        'prompt': (None, prompt),
-        'negative_prompt': (None, negative_prompt),  # Include the negative prompt in the request
-        'output_format': (None, 'png'),
-        'size': (None, '1024x1024'),
-        'seed': (None, str(seed))
-    }
 
-    response = requests.post(core_url, headers=headers, files=files)
+def generate_image():
+    """
+    Read the parameters from the form and queue a generation job.
+    The API call runs on a worker thread; poll_jobs() picks up the result.
+    """
+    params = read_form()
+    if params is None:
+        return
 
-    if response.status_code != 200:
-        messagebox.showerror("Error", f"Error {response.status_code}: {response.text}")
-    else:
-        filename = get_filename('.png', method='Image Generation')
-        with open(filename, 'wb') as file:
-            file.write(response.content)
-        
-        display_image(filename)
-        messagebox.showinfo("Success", f"Image saved as {filename}")
+    submit_job(describe_job(params['method'], params), make_target(params), params, 'interactive')
+    update_status()
 
 
-def generate_image_to_image(prompt, reference_image_path, seed=0, image_strength=0.5, output_format='png', negative_prompt=''):
-    # Validate `image_strength`
+def run_pipeline():
+    """
+    Queue a multi-stage pipeline (a JSON list of stages) for the selected image.
+    Each stage's result is handed to the next in memory; only the last one is saved
+    unless a stage says "save": true.
+    """
+    pipeline_path = filedialog.askopenfilename(title="Select Pipeline", filetypes=[("JSON Files", "*.json")])
+    if not pipeline_path:
+        return
     try:
-        image_strength = float(image_strength)
-    except ValueError:
-        messagebox.showerror("Error", "Image Strength must be a numeric value.")
+        stages = load_pipeline(pipeline_path)
+    except (OSError, ValueError) as e:
+        messagebox.showerror("Error", f"Invalid pipeline: {e}")
         return
 
-    if not (0 <= image_strength <= 1):
-        messagebox.showerror("Error", "Image Strength must be between 0 and 1.")
+    params = read_form(stages[0]['method'])
+    if params is None:
         return
+    params['pipeline'] = stages
+    params['method'] = stages[-1]['method']  # names the saved result
 
-    # Validate API key
-    api_key = api_key_entry.get()
-    if not api_key:
-        messagebox.showerror("Error", "API key is required.")
-        return
+    def target(job):
+        def before_stage(number, stage):
+            job.check_cancelled()
+            job.set_progress(f"stage {number}/{len(stages)}: {stage['method']}")
 
-    # Determine MIME type
-    file_extension = Path(reference_image_path).suffix.lower()
-    mime_type = (
-        'image/png' if file_extension == '.png' else
-        'image/jpeg' if file_extension in ['.jpg', '.jpeg'] else
-        'image/webp' if file_extension == '.webp' else None
-    )
-    if not mime_type:
-        messagebox.showerror("Error", f"Unsupported image format: {file_extension}")
-        return
+        with using(interactive_run):
+            result = render_pipeline_job(job.params['api_key'], job.params, output_dir, before_stage=before_stage)
+        if result['error']:
+            raise RuntimeError(result['error'])
+        return result['filename']
 
-    # Resize image if necessary
-    resized_image_path = resize_image(reference_image_path, max_size=(1536, 1536))
-
-    # Prepare headers and payload
-    headers = {
-        'Authorization': f'Bearer {api_key}',
-        'Accept': 'image/*',  # Accept raw image response
-    }
-
-    data = {
-        'prompt': prompt,
-        'strength': str(image_strength),
-        'output_format': 'png',
-        'aspect_ratio': '1:1',
-        'seed': str(seed),
-        'negative_prompt':negative_prompt
-    }
-
-
-    # Read and upload image file
-    with open(resized_image_path, 'rb') as file:
-        files = {
-            'image': ('reference' + file_extension, file, mime_type)
-        }
-
-        # Make POST request to Stable Image Ultra API
-        response = requests.post(image_to_image_url, headers=headers, files=files, data=data)
-
-    # Handle response
-    if response.status_code != 200:
-        messagebox.showerror("Error", f"Error {response.status_code}: {response.text}")
-    else:
-        filename = get_filename(f'.{output_format}', method='Image-to-Image')
-        with open(filename, 'wb') as file:
-            file.write(response.content)
-        
-        display_image(filename)
-        messagebox.showinfo("Success", f"Image saved as {filename}")
+    submit_job(describe_job(describe_pipeline(stages), params), target, params, 'interactive')
+    update_status()
 
 
+def get_build_manifest():
+    global build_manifest
+    path = manifest_path(output_dir, current_json_file)
+    if build_manifest is None or build_manifest.path != path:
+        if build_manifest is not None:
+            build_manifest.close()
+        build_manifest = BuildManifest(path)
+    return build_manifest
 
-def generate_image_structure(prompt, reference_image_path, control_strength=0.5, seed='',negative_prompt=''):
-       
-    # Έλεγχος αν το control_strength είναι αριθμός και εντός του εύρους [0, 1]
-    try:
-        control_strength = float(control_strength)  # Προσπάθεια μετατροπής σε float
-    except ValueError:
-        messagebox.showerror("Error", "Image Strength must be a numeric value.")
+
+def rebuild_changed():
+    """
+    Queue the images of the loaded file whose prompt, settings or reference image changed
+    since their latest output (see rebuild.py), with the settings in the form.
+    """
+    if not scenes:
+        messagebox.showerror("Error", "No JSON file loaded.")
+        return
+    if still_loading():
+        return
+    params = read_form()
+    if params is None:
         return
 
-    if not (0 <= control_strength <= 1):
-        messagebox.showerror("Error", "Image Strength must be between 0 and 1.")
+    settings = {name: value for name, value in params.items() if name not in ('prompt', 'scene_index', 'image_index')}
+    jobs = engine.collect_jobs(scenes, settings, base_dir=Path(current_json_file).parent)
+    manifest = get_build_manifest()
+    stale = stale_jobs(jobs, manifest, run_path(output_dir, current_json_file, settings))
+    summary = describe_stale(stale, len(jobs))
+    if not stale:
+        update_status(summary)
+        return
+    # Two batch workers share the queue with clicks
+    estimate = forecast([job for job, _, _ in stale], 2, get_scheduler().costs, cache=get_cache(),
+                        api_key=params['api_key'])
+    if not messagebox.askokcancel("Rebuild Changed Images", '\n'.join([summary, ''] + format_forecast(estimate))):
         return
 
+    for job, fingerprint, _ in stale:
+        submit_job(describe_job(job['method'], job), make_rebuild_target(job, manifest, fingerprint), job)
+    update_status(f"Rebuilding {len(stale)} images")
 
-    api_key = api_key_entry.get()
-    if not api_key:
-        messagebox.showerror("Error", "API key is required.")
-        return
 
-    headers = {
-        'Authorization': f'Bearer {api_key}',
-        'Accept': 'image/*',
-    }
-
-    file_extension = Path(reference_image_path).suffix.lower()
-    mime_type = 'image/png' if file_extension == '.png' else (
-        'image/jpeg' if file_extension in ['.jpg', '.jpeg'] else (
-        'image/webp' if file_extension == '.webp' else None))
-    if not mime_type:
-        raise ValueError(f"Unsupported image format: {file_extension}")
-
-    # Resize image if it's too large
-    resized_image_path = resize_image(reference_image_path, max_size=(1536, 1536))
-
-    with open(resized_image_path, 'rb') as file:
-        files = {
-            'image': ('reference' + file_extension, file, mime_type)
-        }
-
-        data = {
-            'prompt': prompt,
-            'negative_prompt': (None, negative_prompt),
-            'output_format': 'png',
-            'size': '1024x1024',
-            'control_strength': str(control_strength),
-            'seed': str(seed)
-        }
-
-        response = requests.post(structure_url, headers=headers, files=files, data=data)
-
-   
-    if response.status_code != 200:
-        messagebox.showerror("Error", f"Error {response.status_code}: {response.text}")
-    else:
-        filename = get_filename('.png', method='Image with Structure')
-        with open(filename, 'wb') as file:
-            file.write(response.content)
-        
-        display_image(filename)
-        messagebox.showinfo("Success", f"Image saved as {filename}")
- 
-
-def generate_outpaint(reference_image_path, left, right, up, down, prompt='', seed=''):
-    api_key = api_key_entry.get()
-    if not api_key:
-        messagebox.showerror("Error", "API key is required.")
-        return
+def make_rebuild_target(params, manifest, fingerprint):
+    """
+    make_target, recording the output as its position's latest once it is saved.
+    """
+    target = make_target(params)
 
-    headers = {
-        'Authorization': f'Bearer {api_key}',
-        'Accept': 'image/*',  # Expect image content
-    }
-
-    file_extension = Path(reference_image_path).suffix.lower()
-    mime_type = 'image/png' if file_extension == '.png' else (
-        'image/jpeg' if file_extension in ['.jpg', '.jpeg'] else (
-        'image/webp' if file_extension == '.webp'  else None))
-    
-    if not mime_type:
-        messagebox.showerror("Error", f"Unsupported image format: {file_extension}")
-        return
+    def rebuild(job):
+        filename = target(job)
+        manifest.record(job.params, fingerprint, filename)
+        return filename
+    return rebuild
 
-    # Resize image if it's too large
-    resized_image_path = resize_image(reference_image_path, max_size=(1536, 1536))
-
-    with open(resized_image_path, 'rb') as file:
-        files = {
-            'image': ('reference' + file_extension, file, mime_type)
-        }
-
-        data = {
-            'left': str(left),
-            'right': str(right),
-            'up': str(up),
-            'down': str(down),
-            'prompt': prompt,
-            'seed': str(seed),
-            'output_format': 'png',  # Specify the desired output format
-            'creativity': '0.7'  # Optional: adjust creativity
-        }
-
-        # Debugging output
-        print(f"Sending request to {outpaint_url} with data: {data}")
-        print(f"Files to send: {files}")
-
-        response = requests.post(outpaint_url, headers=headers, files=files, data=data)
-
-        # Debugging output
-        print(f"Response status code: {response.status_code}")
-        print(f"Response text: {response.text}")
-
-    if response.status_code != 200:
-        messagebox.showerror("Error", f"Error {response.status_code}: {response.text}")
-    else:
-        # Check if the response content is indeed image data
-        if 'image' in response.headers.get('Content-Type', ''):
-            filename = get_filename('.png', method='Outpaint')
-        with open(filename, 'wb') as file:
-            file.write(response.content)
-        
-        display_image(filename)
-        messagebox.showinfo("Success", f"Image saved as {filename}")
+
+def open_sweep():
+    """
+    Dialog for a seed/parameter sweep of the current prompt.
+    """
+    dialog = tk.Toplevel(root)
+    dialog.title("Parameter Sweep")
+    dialog.resizable(False, False)
+
+    fields = [
+        ("Seeds (e.g. 1-16 or 3,7,42):", '1-8'),
+        ("Image strengths (e.g. 0.3,0.5 or 0.2:0.8:0.2):", ''),
+        ("Control strengths:", ''),
+        ("Outpaint margins (l,r,u,d; l,r,u,d):", ''),
+        ("Concurrent requests:", '8'),
+        ("Credit budget (blank for none):", ''),
+    ]
+    entries = []
+    for row, (label, default) in enumerate(fields):
+        tk.Label(dialog, text=label).grid(row=row, column=0, padx=5, pady=5, sticky="e")
+        entry = tk.Entry(dialog, width=30)
+        entry.insert(0, default)
+        entry.grid(row=row, column=1, padx=5, pady=5)
+        entries.append(entry)
+
+    def run():
+        try:
+            seeds = parse_values(entries[0].get(), int)
+            image_strengths = parse_values(entries[1].get())
+            control_strengths = parse_values(entries[2].get())
+            margins = parse_margins(entries[3].get())
+            concurrency = max(1, int(entries[4].get()))
+            budget = float(entries[5].get()) if entries[5].get().strip() else None
+            for value in (image_strengths or []) + (control_strengths or []):
+                check_strength(value, 'Strength')
+        except ValueError as e:
+            messagebox.showerror("Error", str(e), parent=dialog)
+            return
+
+        params = read_form()
+        if params is None:
+            return
+        variants = expand_grid(params, seeds, image_strengths, control_strengths, margins)
+        estimate = forecast(variants, concurrency, get_scheduler().costs, cache=get_cache(), api_key=params['api_key'])
+        text = '\n'.join(format_forecast(estimate))
+        if budget is not None and estimate['credits'] > budget:
+            text += f"\n\nThe budget of {budget:g} credits covers part of it; the rest won't be sent."
+        if not messagebox.askokcancel("Run Sweep", text, parent=dialog):
+            return
+        dialog.destroy()
+        start_sweep(params, variants, concurrency, budget)
+
+    tk.Button(dialog, text="Run Sweep", command=run, width=25).grid(row=len(fields), column=0, columnspan=2, pady=10)
+
+
+def start_sweep(params, variants, concurrency, budget=None):
+    # Enough workers and connection slots to run the whole grid side by side, plus one kept for clicks
+    job_queue.ensure_workers(concurrency)
+    client = get_client()
+    client.set_max_in_flight(max(client.max_in_flight, concurrency + 1))
+    scheduler = get_scheduler()
+    scheduler.set_slots(max(scheduler.slots or 0, concurrency + 1))
+
+    credit_run = Run(f'sweep {len(sweeps) + 1}', budget=budget)
+    jobs = []
+    for variant in variants:
+        variant['sweep'] = True
+        description = f"{describe_job(variant['method'], variant)} [{variant_label(variant)}]"
+        jobs.append(submit_job(description, make_target(variant, credit_run), variant))
+    sweeps.append({'base': params, 'jobs': jobs})
+    update_status(f"Sweep of {len(jobs)} variants queued")
+
+
+def finish_sweeps():
+    """
+    Queue the contact sheet for every sweep whose jobs have all finished.
+    """
+    for sweep in list(sweeps):
+        if not all(job.finished for job in sweep['jobs']):
+            continue
+        sweeps.remove(sweep)
+        entries = [(job.result if job.status == 'done' else None, variant_label(job.params)) for job in sweep['jobs']]
+        if not any(path for path, _ in entries):
+            continue
+        sheet_path = sheet_filename(output_dir, sweep['base'])
+        submit_job(f"Contact sheet ({len(entries)} variants)",
+                   lambda job, entries=entries, sheet_path=sheet_path: make_contact_sheet(entries, sheet_path), {})
+
+
+def get_naming():
+    """
+    Scene/image indices (or the seed) used to name the output, read from the form.
+    """
+    if scenes and current_json_file:
+        return {'scene_index': current_scene_index,
+                'image_index': current_image_index,
+                'seed': int(seed_entry.get()),
+                'json_file': current_json_file}
+    return {'scene_index': None, 'image_index': None, 'seed': int(seed_entry.get()), 'json_file': None}
+
+
+def describe_job(method, params):
+    if params['scene_index'] is not None:
+        return f"{method} - scene {params['scene_index'] + 1}, image {params['image_index'] + 1}"
+    return f"{method} - seed {params['seed']}"
+
+
+def job_line(job):
+    text = f"#{job.id} [{job.status}] {job.description}"
+    if job.status == 'running' and job.progress:
+        text += f" ({job.progress})"
+    elif job.status == 'failed':
+        text += f": {job.error}"
+    return text
+
+
+def update_status(message=None):
+    stats = job_queue.stats()
+    text = f"Status: {stats['queued']} queued, {stats['running']} running"
+    if message:
+        text += f" | {message}"
+    elif not stats['queued'] and not stats['running']:
+        text = "Status: Ready"
+    summary = metrics.get_recorder().summary()
+    if summary:
+        text += f" | {summary}"
+    key_pool = get_key_pool()
+    if key_pool is not None:
+        text += f" | keys {key_pool.healthy()}/{len(key_pool)} ready"
+    text += f" | {get_scheduler().spent_today():g} credits today"
+    status_label.configure(text=text)
+
+
+def poll_jobs():
+    """
+    Pick up job changes from the workers. Runs on the Tk thread every 100 ms.
+    """
+    global warnings_shown
+    message = None
+    finished = False
+    job_ids = list(job_queue.jobs)
+    for job in job_queue.poll():
+        row = job_ids.index(job.id)
+        jobs_listbox.delete(row)
+        jobs_listbox.insert(row, job_line(job))
+
+        finished = finished or job.finished
+        if job.status == 'running' and job.progress:
+            message = f"#{job.id}: {job.progress}"
+        elif job.status == 'done':
+            if not job.params.get('sweep'):
+                display_image(job.result)
+            stats = get_cache().stats()
+            dedup = get_single_flight().stats()
+            message = (f"#{job.id}: saved as {job.result} (cache: {stats['hits']} hits, {stats['misses']} misses, "
+                       f"{dedup['coalesced'] + dedup['shared']} shared)")
+        elif job.status == 'failed':
+            message = f"#{job.id} failed: {job.error}"
+        elif job.status == 'cancelled':
+            message = f"#{job.id} cancelled"
+
+    warnings = get_scheduler().warnings
+    if len(warnings) > warnings_shown:
+        message = f"Budget: {warnings[-1]}"
+        warnings_shown = len(warnings)
+
+    finish_sweeps()
+    if message:
+        update_status(message)
+    if finished:
+        metrics.get_recorder().write_prometheus(str(metrics_dir / 'metrics.prom'))
+    root.after(100, poll_jobs)
+
+
+def cancel_selected_job():
+    selection = jobs_listbox.curselection()
+    job_ids = list(job_queue.jobs)
+    if selection:
+        job_queue.cancel(job_ids[selection[0]])
+    elif job_ids:
+        job_queue.cancel(job_ids[-1])  # Nothing selected: cancel the newest job
 
 
 def display_image(image_path):
+    from PIL import Image, ImageTk  # loaded on first display, not at startup
     try:
         # Load and display the image
-        img = Image.open(image_path)
-        img = img.resize((512, 512), Image.LANCZOS)  # Resize the image to fit the label
+        started = time.perf_counter()
+        with Image.open(image_path) as img:
+            img.draft('RGB', (512, 512))  # JPEGs can be decoded at reduced size
+            img = img.resize((512, 512), Image.LANCZOS, reducing_gap=3.0)  # Resize the image to fit the label
         img_tk = ImageTk.PhotoImage(img)
+        metrics.get_recorder().record({'endpoint': 'display', 'time': time.time(), 'path': str(image_path),
+                                       'phases': {'decode': time.perf_counter() - started}})
         image_label.configure(image=img_tk)
         image_label.image = img_tk  # Keep a reference to avoid garbage collection
     except Exception as e:
@@ -458,130 +638,10 @@ def update_method_selection(event=None):
         outpaint_up_entry.grid(row=10, column=1, padx=10, pady=5)
         outpaint_down_label.grid(row=11, column=0, padx=10, pady=5, sticky="e")
         outpaint_down_entry.grid(row=11, column=1, padx=10, pady=5)
-    
-
-
-# Create the main window
-root = tk.Tk()
-root.title("Image Generation App")
-root.geometry("800x700")  # Adjusted size for Outpaint parameters
-
-# Left Panel
-left_frame = tk.Frame(root, padx=10, pady=10)
-left_frame.pack(side="left", fill="y")
-
-# JSON File Selection
-load_json_button = tk.Button(left_frame, text="Load JSON File", command=load_json_file, width=25)
-load_json_button.grid(row=0, column=0, pady=5)
-
-# API Key Entry
-tk.Label(left_frame, text="API Key:").grid(row=1, column=0, padx=5, pady=5, sticky="e")
-api_key_entry = tk.Entry(left_frame, show="*", width=30)
-api_key_entry.grid(row=1, column=1, padx=5, pady=5)
-
-# Scene Selection
-tk.Label(left_frame, text="Scene Index:").grid(row=2, column=0, padx=5, pady=5, sticky="e")
-scene_index_combobox = ttk.Combobox(left_frame, state='readonly', width=27)
-scene_index_combobox.grid(row=2, column=1, padx=5, pady=5)
-scene_index_combobox.bind("<<ComboboxSelected>>", update_image_options)
-
-# Image Selection
-tk.Label(left_frame, text="Image Index:").grid(row=3, column=0, padx=5, pady=5, sticky="e")
-image_index_combobox = ttk.Combobox(left_frame, state='readonly', width=27)
-image_index_combobox.grid(row=3, column=1, padx=5, pady=5)
-image_index_combobox.bind("<<ComboboxSelected>>", update_prompt)
-
-
-# Prompt Text Area
-tk.Label(left_frame, text="Prompt:").grid(row=4, column=0, padx=5, pady=5, sticky="ne")
-prompt_text = tk.Text(left_frame, width=30, height=5, wrap="word")
-prompt_text.grid(row=4, column=1, padx=5, pady=5)
-# Prompt Text Area with Scrollbar
-prompt_frame = tk.Frame(left_frame)
-prompt_frame.grid(row=4, column=1, padx=5, pady=5)
-
-prompt_text = tk.Text(prompt_frame, width=30, height=5, wrap="word")
-prompt_text.pack(side="left", fill="both", expand=True)
-
-prompt_scrollbar = tk.Scrollbar(prompt_frame, command=prompt_text.yview)
-prompt_scrollbar.pack(side="right", fill="y")
 
-prompt_text.configure(yscrollcommand=prompt_scrollbar.set)
-
-
-# Negative Prompt Entry
-negative_prompt_label = tk.Label(left_frame, text="Negative Prompt:")
-negative_prompt_entry = tk.Entry(left_frame, width=30)
-
-# Save Prompt Button
-save_prompt_button = tk.Button(left_frame, text="Save Prompt Description", command=save_prompt, width=25)
-save_prompt_button.grid(row=6, column=0, columnspan=2, pady=10)
-
-# Image Generation Method
-tk.Label(left_frame, text="Generation Method:").grid(row=7, column=0, padx=5, pady=5, sticky="e")
-method_var = tk.StringVar(value="Image Generation")
-method_combobox = ttk.Combobox(left_frame, textvariable=method_var, state='readonly', width=27)
-method_combobox['values'] = ['Image Generation', 'Image-to-Image', 'Image with Structure', 'Outpaint']
-method_combobox.grid(row=7, column=1, padx=5, pady=5)
-method_combobox.bind("<<ComboboxSelected>>", update_method_selection)
-
-
-# Labels and Entries for Image Strength, Control Strength, and Outpaint Parameters
-image_strength_label = tk.Label(left_frame, text="Image Strength (0 to 1):")
-image_strength_entry = tk.Entry(left_frame, width=30)
-image_strength_entry.insert(0, '0.5')  # Default value
-
-control_strength_label = tk.Label(left_frame, text="Control Strength (0 to 1):")
-control_strength_entry = tk.Entry(left_frame, width=30)
-control_strength_entry.insert(0, '0.5')  # Default value
-
-# Outpaint Parameters
-outpaint_left_label = tk.Label(left_frame, text="Outpaint Left:")
-outpaint_left_entry = tk.Entry(left_frame, width=30)
-outpaint_left_entry.insert(0, '0')  # Default value
-
-outpaint_right_label = tk.Label(left_frame, text="Outpaint Right:")
-outpaint_right_entry = tk.Entry(left_frame, width=30)
-outpaint_right_entry.insert(0, '0')  # Default value
-
-outpaint_up_label = tk.Label(left_frame, text="Outpaint Up:")
-outpaint_up_entry = tk.Entry(left_frame, width=30)
-outpaint_up_entry.insert(0, '0')  # Default value
-
-outpaint_down_label = tk.Label(left_frame, text="Outpaint Down:")
-outpaint_down_entry = tk.Entry(left_frame, width=30)
-outpaint_down_entry.insert(0, '0')  # Default value
-
-# Seed Entry
-tk.Label(left_frame, text="Seed:").grid(row=12, column=0, padx=5, pady=5, sticky="e")
-seed_entry = tk.Entry(left_frame, width=30)
-seed_entry.grid(row=12, column=1, padx=5, pady=5)
-seed_entry.insert(0,'0')
-
-# Call update_method_selection to reflect the default selection when the program starts
-update_method_selection()  
-
-# Generate Image Button
-generate_image_button = tk.Button(left_frame, text="Generate Image", command=generate_image, width=25)
-generate_image_button.grid(row=14, column=0, columnspan=2, pady=10)
-
-
-# Center Panel
-center_frame = tk.Frame(root, padx=10, pady=10)
-center_frame.pack(side="left", fill="both", expand=True)
-
-# Image Display
-image_label = tk.Label(center_frame, bg="gray")
-image_label.pack(pady=10, fill="both", expand=True)
-
-# Bottom Panel
-bottom_frame = tk.Frame(root, padx=10, pady=10)
-bottom_frame.pack(side="bottom", fill="x")
-
-# Status Label
-status_label = tk.Label(bottom_frame, text="Status: Ready", anchor="w")
-status_label.pack(fill="x")
 
+def open_gallery():
+    Gallery(root, output_dir, on_select=display_image)
 
 
 def show_help():
@@ -629,11 +689,14 @@ def show_help():
         "       ]\n"
         "   }\n\n"
         "2. API Key:\n"
-        "   Enter the API key for the Stable Diffusion API.\n\n"
-        "3. Scene Index:\n"
-        "   Select a scene from the loaded JSON file.\n\n"
-        "4. Image Index:\n"
-        "   Select an image within the chosen scene.\n\n"
+        "   Enter the API key for the Stable Diffusion API. Leave it empty to spread jobs over the keys in "
+        "STABILITY_API_KEYS or the file named by STABILITY_API_KEYS_FILE; a key that is rate limited or "
+        "out of credits is rested while the others take over.\n\n"
+        "3. Find Prompt:\n"
+        "   Type words from a prompt to filter the list to the matching images (best matches first).\n\n"
+        "4. Scene.Image:\n"
+        "   Every image of the loaded JSON file as scene.image, with the start of its prompt. "
+        "Click a row (or use the arrow keys) to select it.\n\n"
         "5. Prompt:\n"
         "   Enter the description for generating the image.\n\n"
         "6. Negative Prompt:\n"
@@ -652,7 +715,23 @@ def show_help():
         "   Set expansion dimensions for each side (Left, Right, Up, Down).\n\n"
         "10. Seed:\n"
         "    Set a seed value for reproducibility.\n\n"
-        "Click 'Generate Image' to create the output based on the provided parameters."
+        "Click 'Generate Image' to create the output based on the provided parameters.\n\n"
+        "Results are cached in generated_images/.cache: asking for exactly the same prompt, settings, seed "
+        "and reference image again reuses the saved result instead of calling the API. Seed 0 (random) is never cached. "
+        "Untick 'Reuse cached results' to always call the API.\n\n"
+        "'Parameter Sweep...' renders the current prompt for every combination of the seeds, strengths "
+        "and outpaint margins you list, several requests at a time, and saves a labeled contact sheet "
+        "(generated_images/sweep_...png) when they are all done.\n\n"
+        "'Run Pipeline...' asks for a pipeline JSON file, a list of stages such as "
+        "[{\"method\": \"Image Generation\"}, {\"method\": \"Image with Structure\"}, "
+        "{\"method\": \"Outpaint\", \"left\": 512, \"right\": 512}], and runs it for the selected image. "
+        "Each stage's result goes straight into the next stage; only the last one is saved unless a "
+        "stage has \"save\": true.\n\n"
+        "'Open Gallery' shows every image in generated_images. Filter by scene, image or method and click "
+        "a thumbnail to show it in the main window.\n\n"
+        "Each click adds a job to the list under the image and returns right away, so you can keep "
+        "editing prompts and queue more images. The status bar shows how many jobs are queued and running. "
+        "Select a job and click 'Cancel Job' to cancel it, or 'Cancel All' to clear the queue."
     )
 
     # Insert instructions and disable editing
@@ -663,11 +742,179 @@ def show_help():
     close_button = tk.Button(help_window, text="Close", command=help_window.destroy, bg="#f0f0f0", font=("Arial", 10, "bold"))
     close_button.pack(pady=10)
 
-# Add the Help button next to the JSON button
-help_button = tk.Button(left_frame, text="Help", command=show_help, width=10, bg="#d9e8fb", font=("Arial", 10, "bold"))
-help_button.grid(row=0, column=1, padx=5, pady=5, sticky="e")
 
+if __name__ == '__main__':
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    metrics.configure_recorder(str(metrics_dir / 'traces.jsonl'))
+    job_queue = JobQueue(workers=2)
+    # Two batch slots for the workers, and one only clicks can use
+    configure_scheduler(slots=3, interactive_reserve=1, ledger_path=str(Path(output_dir) / 'credits.db'))
+
+    # Create the main window
+    root = tk.Tk()
+    root.title("Image Generation App")
+    root.geometry("800x700")  # Adjusted size for Outpaint parameters
+
+    # Left Panel
+    left_frame = tk.Frame(root, padx=10, pady=10)
+    left_frame.pack(side="left", fill="y")
+
+    # JSON File Selection
+    load_json_button = tk.Button(left_frame, text="Load JSON File", command=load_json_file, width=25)
+    load_json_button.grid(row=0, column=0, pady=5)
+
+    # API Key Entry
+    tk.Label(left_frame, text="API Key:").grid(row=1, column=0, padx=5, pady=5, sticky="e")
+    api_key_entry = tk.Entry(left_frame, show="*", width=30)
+    api_key_entry.grid(row=1, column=1, padx=5, pady=5)
+
+    # Prompt Search
+    tk.Label(left_frame, text="Find Prompt:").grid(row=2, column=0, padx=5, pady=5, sticky="e")
+    search_entry = tk.Entry(left_frame, width=30)
+    search_entry.grid(row=2, column=1, padx=5, pady=5)
+    search_entry.bind("<KeyRelease>", search_prompts)
+
+    # Scene / Image Selection
+    tk.Label(left_frame, text="Scene.Image:").grid(row=3, column=0, padx=5, pady=5, sticky="ne")
+    image_list = VirtualList(left_frame, on_select=select_position, rows=6, width=220)
+    image_list.grid(row=3, column=1, padx=5, pady=5)
+
+
+    # Prompt Text Area
+    tk.Label(left_frame, text="Prompt:").grid(row=4, column=0, padx=5, pady=5, sticky="ne")
+    prompt_text = tk.Text(left_frame, width=30, height=5, wrap="word")
+    prompt_text.grid(row=4, column=1, padx=5, pady=5)
+    # Prompt Text Area with Scrollbar
+    prompt_frame = tk.Frame(left_frame)
+    prompt_frame.grid(row=4, column=1, padx=5, pady=5)
+
+    prompt_text = tk.Text(prompt_frame, width=30, height=5, wrap="word")
+    prompt_text.pack(side="left", fill="both", expand=True)
+
+    prompt_scrollbar = tk.Scrollbar(prompt_frame, command=prompt_text.yview)
+    prompt_scrollbar.pack(side="right", fill="y")
+
+    prompt_text.configure(yscrollcommand=prompt_scrollbar.set)
+
+
+    # Negative Prompt Entry
+    negative_prompt_label = tk.Label(left_frame, text="Negative Prompt:")
+    negative_prompt_entry = tk.Entry(left_frame, width=30)
+
+    # Save Prompt Button
+    save_prompt_button = tk.Button(left_frame, text="Save Prompt Description", command=save_prompt, width=25)
+    save_prompt_button.grid(row=6, column=0, columnspan=2, pady=10)
+
+    # Image Generation Method
+    tk.Label(left_frame, text="Generation Method:").grid(row=7, column=0, padx=5, pady=5, sticky="e")
+    method_var = tk.StringVar(value="Image Generation")
+    method_combobox = ttk.Combobox(left_frame, textvariable=method_var, state='readonly', width=27)
+    method_combobox['values'] = METHODS
+    method_combobox.grid(row=7, column=1, padx=5, pady=5)
+    method_combobox.bind("<<ComboboxSelected>>", update_method_selection)
+
+
+    # Labels and Entries for Image Strength, Control Strength, and Outpaint Parameters
+    image_strength_label = tk.Label(left_frame, text="Image Strength (0 to 1):")
+    image_strength_entry = tk.Entry(left_frame, width=30)
+    image_strength_entry.insert(0, '0.5')  # Default value
+
+    control_strength_label = tk.Label(left_frame, text="Control Strength (0 to 1):")
+    control_strength_entry = tk.Entry(left_frame, width=30)
+    control_strength_entry.insert(0, '0.5')  # Default value
+
+    # Outpaint Parameters
+    outpaint_left_label = tk.Label(left_frame, text="Outpaint Left:")
+    outpaint_left_entry = tk.Entry(left_frame, width=30)
+    outpaint_left_entry.insert(0, '0')  # Default value
+
+    outpaint_right_label = tk.Label(left_frame, text="Outpaint Right:")
+    outpaint_right_entry = tk.Entry(left_frame, width=30)
+    outpaint_right_entry.insert(0, '0')  # Default value
+
+    outpaint_up_label = tk.Label(left_frame, text="Outpaint Up:")
+    outpaint_up_entry = tk.Entry(left_frame, width=30)
+    outpaint_up_entry.insert(0, '0')  # Default value
+
+    outpaint_down_label = tk.Label(left_frame, text="Outpaint Down:")
+    outpaint_down_entry = tk.Entry(left_frame, width=30)
+    outpaint_down_entry.insert(0, '0')  # Default value
+
+    # Seed Entry
+    tk.Label(left_frame, text="Seed:").grid(row=12, column=0, padx=5, pady=5, sticky="e")
+    seed_entry = tk.Entry(left_frame, width=30)
+    seed_entry.grid(row=12, column=1, padx=5, pady=5)
+    seed_entry.insert(0,'0')
+
+    # Call update_method_selection to reflect the default selection when the program starts
+    update_method_selection()  
+
+    # Result Cache Toggle
+    use_cache_var = tk.BooleanVar(value=get_cache().enabled)
+    use_cache_checkbutton = tk.Checkbutton(left_frame, text="Reuse cached results", variable=use_cache_var,
+                                           command=lambda: setattr(get_cache(), 'enabled', use_cache_var.get()))
+    use_cache_checkbutton.grid(row=13, column=1, padx=5, pady=5, sticky="w")
+
+    # Generate Image Button
+    generate_image_button = tk.Button(left_frame, text="Generate Image", command=generate_image, width=25)
+    generate_image_button.grid(row=14, column=0, columnspan=2, pady=10)
+
+    # Gallery Button
+    gallery_button = tk.Button(left_frame, text="Open Gallery", command=open_gallery, width=25)
+    gallery_button.grid(row=15, column=0, columnspan=2, pady=5)
+
+    # Sweep Button
+    sweep_button = tk.Button(left_frame, text="Parameter Sweep...", command=open_sweep, width=25)
+    sweep_button.grid(row=16, column=0, columnspan=2, pady=5)
+
+    # Run a multi-stage pipeline (e.g. generate -> structure -> outpaint) for the selected image
+    pipeline_button = tk.Button(left_frame, text="Run Pipeline...", command=run_pipeline, width=25)
+    pipeline_button.grid(row=17, column=0, columnspan=2, pady=5)
+
+    # Regenerate only the images whose prompt, settings or reference changed
+    rebuild_button = tk.Button(left_frame, text="Rebuild Changed Images", command=rebuild_changed, width=25)
+    rebuild_button.grid(row=18, column=0, columnspan=2, pady=5)
+
+
+    # Center Panel
+    center_frame = tk.Frame(root, padx=10, pady=10)
+    center_frame.pack(side="left", fill="both", expand=True)
+
+    # Image Display
+    image_label = tk.Label(center_frame, bg="gray")
+    image_label.pack(pady=10, fill="both", expand=True)
+
+    # Bottom Panel
+    bottom_frame = tk.Frame(root, padx=10, pady=10)
+    bottom_frame.pack(side="bottom", fill="x")
+
+    # Status Label
+    status_label = tk.Label(bottom_frame, text="Status: Ready", anchor="w")
+    status_label.pack(fill="x")
+
+    # Job List
+    jobs_frame = tk.Frame(center_frame)
+    jobs_frame.pack(fill="x")
+
+    jobs_listbox = tk.Listbox(jobs_frame, height=5)
+    jobs_listbox.pack(side="left", fill="x", expand=True)
+
+    jobs_scrollbar = tk.Scrollbar(jobs_frame, command=jobs_listbox.yview)
+    jobs_scrollbar.pack(side="left", fill="y")
+    jobs_listbox.configure(yscrollcommand=jobs_scrollbar.set)
+
+    jobs_buttons = tk.Frame(jobs_frame)
+    jobs_buttons.pack(side="left", padx=5)
+    tk.Button(jobs_buttons, text="Cancel Job", command=cancel_selected_job, width=12).pack(pady=2)
+    tk.Button(jobs_buttons, text="Cancel All", command=job_queue.cancel_all, width=12).pack(pady=2)
+
+
+    # Add the Help button next to the JSON button
+    help_button = tk.Button(left_frame, text="Help", command=show_help, width=10, bg="#d9e8fb", font=("Arial", 10, "bold"))
+    help_button.grid(row=0, column=1, padx=5, pady=5, sticky="e")
 
 
-# Run the main loop
-root.mainloop()
+    # Run the main loop
+    root.protocol("WM_DELETE_WINDOW", on_close)
+    root.after(100, poll_jobs)
+    root.mainloop()
@@ -0,0 +1,390 @@
+"""
+Headless batch renderer for scene JSON files.
+
+Renders every image_description of a {"scenes": [{"scene": [...]}]} file (or a
+range of scenes/images) with a bounded pool of concurrent requests, using the
+same request building and output naming as the GUI.
+
+Example:
+    python batch_render.py story.json --api-key sk-... --concurrency 8
+    python batch_render.py story.json --method "Image with Structure" --reference ref.png --scenes 2-4 --images 1
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import metrics
+from engine import collect_jobs, generate, load_scenes
+from http_client import configure_client
+from key_pool import configure_key_pool, get_key_pool, load_keys
+from output_sink import LAYOUTS, configure_sink
+from postprocess import PostProcessor, parse_steps
+from result_cache import configure_cache, get_cache
+from run_journal import DEFAULT_MAX_ATTEMPTS, BuildManifest, RunJournal, manifest_path, recorded, run_path
+from scheduler import (PRIORITIES, BudgetExceeded, Run, configure_scheduler, format_forecast, forecast, get_scheduler,
+                       load_costs, print_warning, recent_latencies, using)
+from single_flight import get_single_flight
+from stability_api import METHODS
+
+
+def parse_range(text):
+    """
+    Parse a 1-based range like "3", "2-5", "4-" or "1,3,7-9" into a list of (start, end)
+    pairs (end is None for open ranges). None or "" means everything.
+    """
+    if not text:
+        return None
+
+    ranges = []
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-', 1)
+            start = int(start) if start.strip() else 1
+            end = int(end) if end.strip() else None
+        else:
+            start = end = int(part)
+        if start < 1 or (end is not None and end < start):
+            raise ValueError(f"Invalid range: {part}")
+        ranges.append((start, end))
+    return ranges
+
+
+def render_job(api_key, job, output_dir, timeout=None, index=True):
+    """
+    Send one job and write the image (and, with index, its row in index.db).
+    Returns a result dict, never raises. A job the credit budget kept from being
+    sent comes back with 'deferred' set.
+    """
+    started = time.perf_counter()
+    result = {'scene_index': job['scene_index'], 'image_index': job['image_index'],
+              'filename': None, 'error': None, 'retries': 0}
+    method = job.get('method', 'Image Generation')
+    with metrics.trace(method=method, scene_index=job['scene_index'], image_index=job['image_index']):
+        try:
+            generated = generate(api_key, job, output_dir, timeout, index=index)
+            result['filename'] = generated['filename']
+            result['retries'] = generated['retries']
+        except Exception as e:
+            result['error'] = str(e)
+            if isinstance(e, BudgetExceeded):
+                result['deferred'] = True
+            metrics.annotate(error=str(e))
+
+    result['elapsed'] = time.perf_counter() - started
+    return result
+
+
+def render_jobs(api_key, jobs, output_dir='generated_images', concurrency=4, timeout=None, progress=None, journal=None,
+                render=render_job, post=None, credit_run=None):
+    """
+    Render the jobs with at most `concurrency` jobs running at once.
+    progress(result, done, total) is called as each job finishes.
+    With a RunJournal, jobs it already finished are skipped and every start and finish is logged.
+    render(api_key, job, output_dir, timeout) does one job (pipeline.render_pipeline_job chains several requests).
+    With a postprocess.PostProcessor, every saved file is handed to it; a full queue holds the job up.
+    API calls are charged to credit_run (a scheduler.Run); once its budget runs out the remaining
+    jobs aren't sent and come back with 'deferred' set, for the next run to pick up.
+    """
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+    results = [None] * len(jobs)
+    to_run = range(len(jobs))
+    if journal is not None:
+        to_run, skipped = journal.plan(jobs)
+        for index, result in skipped:
+            result.update(scene_index=jobs[index]['scene_index'], image_index=jobs[index]['image_index'],
+                          retries=0, elapsed=0.0)
+            results[index] = result
+
+    def run(job):
+        if credit_run is not None and credit_run.exhausted():
+            return {'scene_index': job['scene_index'], 'image_index': job['image_index'], 'filename': None,
+                    'error': f"not sent: {credit_run.stopped}", 'retries': 0, 'elapsed': 0.0, 'deferred': True}
+        if journal is not None:
+            journal.started(job)
+        with using(credit_run):
+            result = render(api_key, job, output_dir, timeout)
+        if result.get('deferred'):
+            pass  # stopped by the budget: left unfinished in the journal, so a later run sends it again
+        elif journal is not None:
+            journal.finished(job, result)
+        if post is not None:
+            for filename in result.get('saved') or [result['filename']]:
+                if filename:
+                    post.submit(filename)
+        return result
+
+    done = len(jobs) - len(to_run)
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        futures = {pool.submit(run, jobs[i]): i for i in to_run}
+        for future in as_completed(futures):
+            result = future.result()
+            results[futures[future]] = result
+            done += 1
+            if progress:
+                progress(result, done, len(jobs))
+
+    # Results come back in the same order as the jobs
+    return results
+
+
+def render_scene_file(json_path, api_key, settings=None, scene_range=None, image_range=None,
+                      output_dir='generated_images', concurrency=4, timeout=None, progress=None,
+                      resume=True, max_attempts=DEFAULT_MAX_ATTEMPTS, post=None, credit_run=None, scene_jobs=None):
+    """
+    Render every image in a scene JSON file. settings holds the request params shared by
+    all images (method, seed, negative_prompt, strengths, outpaint margins, reference_image).
+    A run journal under output_dir/.runs lets a restarted run pick up where it stopped;
+    resume=False starts the journal over. scene_jobs is what scene_file_jobs() returned for
+    the same arguments, if the caller already has it, so the file isn't parsed again.
+    """
+    jobs, journal_path = scene_jobs or scene_file_jobs(json_path, settings, scene_range, image_range, output_dir)
+    if not resume and os.path.exists(journal_path):
+        os.remove(journal_path)
+    journal = RunJournal(journal_path, max_attempts)
+    # Every new output is also its position's latest, for rebuild.py
+    manifest = BuildManifest(manifest_path(output_dir, json_path))
+    try:
+        return render_jobs(api_key, jobs, output_dir, concurrency, timeout, progress, journal,
+                           render=recorded(render_job, manifest), post=post, credit_run=credit_run)
+    finally:
+        journal.close()
+        manifest.close()
+
+
+def scene_file_jobs(json_path, settings=None, scene_range=None, image_range=None, output_dir='generated_images'):
+    """
+    The jobs for a scene JSON file, and the path of the run journal they're tracked in.
+    """
+    scenes = load_scenes(json_path)
+    settings = dict(settings or {}, json_file=str(json_path))
+    jobs = collect_jobs(scenes, settings, scene_range, image_range, Path(json_path).parent)
+    return jobs, run_path(output_dir, os.path.abspath(json_path), settings)
+
+
+def build_parser(add_help=True):
+    parser = argparse.ArgumentParser(description="Render every image of a scene JSON file.", add_help=add_help)
+    parser.add_argument('json_file', help="Scene JSON file")
+    parser.add_argument('--api-key', default=os.environ.get('STABILITY_API_KEY'),
+                        help="Stability API key (default: $STABILITY_API_KEY)")
+    parser.add_argument('--keys-file', help="File with one API key per line to spread requests over (see key_pool.py)")
+    parser.add_argument('--method', default='Image Generation', choices=METHODS)
+    parser.add_argument('--scenes', help="Scene range, e.g. 1-5 or 2,4,7-")
+    parser.add_argument('--images', help="Image range inside each scene")
+    parser.add_argument('--concurrency', type=int, default=4, help="Requests in flight at once")
+    parser.add_argument('--output-dir', default='generated_images')
+    parser.add_argument('--timeout', type=float, default=120, help="Per-request timeout in seconds")
+    parser.add_argument('--no-cache', action='store_true', help="Always call the API, ignoring cached results")
+    parser.add_argument('--cache-size', type=int, default=2048, help="Result cache size limit in MB")
+    parser.add_argument('--max-retries', type=int, default=4, help="Retries for 429/5xx and connection errors")
+    parser.add_argument('--max-attempts', type=int, default=DEFAULT_MAX_ATTEMPTS,
+                        help="Runs a failed image gets across restarts before it is given up")
+    parser.add_argument('--fresh', action='store_true', help="Forget earlier runs and render everything again")
+    parser.add_argument('--metrics-dir', help="Where to write traces.jsonl and metrics.prom (default: <output-dir>/metrics)")
+    parser.add_argument('--post', help="Post-processing steps for each saved image, e.g. webp,thumb:256,crop:16x9")
+    parser.add_argument('--post-workers', type=int, help="Post-processing processes (default: one per CPU)")
+    parser.add_argument('--layout', choices=LAYOUTS, default=os.environ.get('STABLECANVAS_LAYOUT') or 'flat',
+                        help="Output directories: flat, json (per JSON file), scene (per JSON file and scene) or date")
+    parser.add_argument('--archive', help="Append outputs to this .tar or .zip file instead (see output_sink.py)")
+    add_budget_arguments(parser)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--negative-prompt', default='')
+    parser.add_argument('--reference', help="Reference image for the image-based methods")
+    parser.add_argument('--image-strength', type=float, default=0.5)
+    parser.add_argument('--control-strength', type=float, default=0.5)
+    parser.add_argument('--left', type=int, default=0)
+    parser.add_argument('--right', type=int, default=0)
+    parser.add_argument('--up', type=int, default=0)
+    parser.add_argument('--down', type=int, default=0)
+    return parser
+
+
+def add_budget_arguments(parser):
+    parser.add_argument('--budget', type=float, help="Stop sending once this run has spent this many credits")
+    parser.add_argument('--soft-budget', type=float, help="Warn once this run has spent this many credits")
+    parser.add_argument('--daily-budget', type=float, help="Stop sending once today's spend (all runs) reaches this")
+    parser.add_argument('--daily-soft-budget', type=float, help="Warn once today's spend reaches this")
+    parser.add_argument('--costs', help="JSON file of credits per endpoint, e.g. {\"ultra\": 8} (see scheduler.py)")
+    parser.add_argument('--priority', choices=PRIORITIES, default='batch', help="Priority against other runs in this process")
+    parser.add_argument('--forecast', action='store_true', help="Print the credit and time forecast and exit")
+
+
+def configure_budget(args, name):
+    """
+    Set up the scheduler from the budget arguments. Returns the scheduler.Run to charge the run to.
+    """
+    costs = load_costs(args.costs) if args.costs else None
+    configure_scheduler(daily_budget=args.daily_budget, daily_soft_budget=args.daily_soft_budget,
+                        ledger_path=os.path.join(args.output_dir, 'credits.db'), costs=costs, on_warning=print_warning)
+    return Run(name, args.priority, budget=args.budget, soft_budget=args.soft_budget)
+
+
+def print_forecast(jobs, args, journal_path=None, metrics_dir=None):
+    """
+    Print what the jobs still to do will cost (leaving out ones an earlier run finished).
+    Returns the forecast.
+    """
+    if journal_path and os.path.exists(journal_path) and not args.fresh:
+        to_run, _ = RunJournal(journal_path).plan(jobs)
+        jobs = [jobs[index] for index in to_run]
+    latencies = recent_latencies(os.path.join(metrics_dir, 'traces.jsonl')) if metrics_dir else None
+    scheduler = get_scheduler()
+    result = forecast(jobs, args.concurrency, scheduler.costs, latencies, get_cache(), args.api_key)
+    print('\n'.join(format_forecast(result)))
+    if args.budget is not None and result['credits'] > args.budget:
+        print(f"The run budget of {args.budget:g} credits covers part of it; the rest is left for a later run.")
+    if scheduler.daily_budget is not None:
+        left = max(0.0, scheduler.daily_budget - scheduler.spent_today())
+        if result['credits'] > left:
+            print(f"Only {left:g} credits are left in today's budget.")
+    return result
+
+
+def tally(results):
+    """
+    How the jobs of a run ended: {'rendered', 'failed', 'deferred', 'skipped'}. 'skipped' are
+    jobs an earlier run finished or gave up on, so 'failed' only counts failures in this run.
+    """
+    counts = dict.fromkeys(('rendered', 'failed', 'deferred', 'skipped'), 0)
+    for result in results:
+        if result.get('skipped'):
+            counts['skipped'] += 1
+        elif result.get('deferred'):
+            counts['deferred'] += 1
+        else:
+            counts['failed' if result['error'] else 'rendered'] += 1
+    return counts
+
+
+def print_spend(credit_run, results):
+    """
+    Credits spent by the run and how many jobs the budget left unsent.
+    """
+    deferred = sum(1 for r in results if r.get('deferred'))
+    print(f"Credits: {credit_run.spent:g} spent on {credit_run.calls} calls, {get_scheduler().spent_today():g} today")
+    if deferred:
+        print(f"Stopped: {deferred} images not sent ({credit_run.stopped})")
+
+
+def settings_from_args(args):
+    return {
+        'method': args.method,
+        'seed': args.seed,
+        'negative_prompt': args.negative_prompt,
+        'reference_image': args.reference,
+        'image_strength': args.image_strength,
+        'control_strength': args.control_strength,
+        'left': args.left,
+        'right': args.right,
+        'up': args.up,
+        'down': args.down,
+    }
+
+
+def configure_output(args, post_steps=None):
+    """
+    The output sink for --layout/--archive. Raises ValueError for options that don't go together.
+    """
+    if args.archive and post_steps:
+        raise ValueError("--post works on files on disk, so it can't be combined with --archive.")
+    return configure_sink(args.layout, args.archive)
+
+
+def print_dedup():
+    """
+    How many requests were answered by an identical one already in flight.
+    """
+    stats = get_single_flight().stats()
+    if stats['enabled'] and stats['requests']:
+        print(f"Dedup: {stats['coalesced'] + stats['shared']} of {stats['requests']} requests shared an identical "
+              f"call ({stats['dedup_rate']:.0%}, {stats['shared']} from other runs)")
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        if args.keys_file:
+            configure_key_pool(load_keys(args.keys_file))
+            args.api_key = None  # every request draws from the pool
+        elif not args.api_key and get_key_pool() is None and not args.forecast:
+            print("API key is required (--api-key, STABILITY_API_KEY, --keys-file or STABILITY_API_KEYS).", file=sys.stderr)
+            return 2
+        post_steps = parse_steps(args.post) if args.post else None
+        credit_run = configure_budget(args, Path(args.json_file).stem)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+
+    def progress(result, done, total):
+        if result.get('deferred'):
+            return  # summed up at the end
+        name = f"scene {result['scene_index'] + 1} image {result['image_index'] + 1}"
+        status = result['filename'] or f"FAILED: {result['error']}"
+        print(f"[{done}/{total}] {name}: {status} ({result['elapsed']:.1f}s)")
+
+    configure_client(max_in_flight=args.concurrency, max_retries=args.max_retries,
+                     pool_size=max(32, args.concurrency), timeout=args.timeout)
+    cache = configure_cache(cache_dir=os.path.join(args.output_dir, '.cache'),
+                            max_bytes=args.cache_size * 1024 ** 2, enabled=not args.no_cache)
+    metrics_dir = args.metrics_dir or os.path.join(args.output_dir, 'metrics')
+    settings = settings_from_args(args)
+    try:
+        jobs, journal_path = scene_file_jobs(args.json_file, settings, parse_range(args.scenes),
+                                             parse_range(args.images), args.output_dir)
+        print_forecast(jobs, args, journal_path, metrics_dir)
+        if args.forecast:
+            return 0
+        sink = configure_output(args, post_steps)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    recorder = metrics.configure_recorder(os.path.join(metrics_dir, 'traces.jsonl'))
+
+    post = PostProcessor(post_steps, args.post_workers) if post_steps else None
+    started = time.perf_counter()
+    try:
+        results = render_scene_file(args.json_file, args.api_key, settings,
+                                    parse_range(args.scenes), parse_range(args.images),
+                                    args.output_dir, args.concurrency, args.timeout, progress,
+                                    resume=not args.fresh, max_attempts=args.max_attempts, post=post,
+                                    credit_run=credit_run, scene_jobs=(jobs, journal_path))
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    finally:
+        if post is not None:
+            post.close()
+        sink.close()
+
+    counts = tally(results)
+    print(f"Rendered {counts['rendered']}/{counts['rendered'] + counts['failed']} images "
+          f"in {time.perf_counter() - started:.1f}s")
+    if counts['skipped']:
+        print(f"Resumed: {counts['skipped']} images were already finished or given up in an earlier run")
+    stats = cache.stats()
+    if stats['enabled']:
+        print(f"Cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%})")
+    print_dedup()
+    print_spend(credit_run, results)
+    key_pool = get_key_pool() if args.api_key is None else None
+    if key_pool is not None:
+        for key in key_pool.stats():
+            print(f"Key {key['name']}: {key['requests']} requests, {key['failures']} rejected")
+    summary = recorder.summary()
+    if summary:
+        print(f"Latency: {summary}")
+    if post is not None:
+        print('\n'.join(post.report()))
+    recorder.write_prometheus(os.path.join(metrics_dir, 'metrics.prom'))
+    recorder.close()
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
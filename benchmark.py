@@ -0,0 +1,318 @@
+"""
+End-to-end throughput benchmarks for the generation paths, run against the
+local mock server (mock_server.py), so no API key or network is needed.
+
+For the single-image, batch and sweep workloads at each concurrency level it
+reports requests/sec, p50/p95/p99 latency, peak RSS and bytes written, and
+can save the results as JSON to compare runs.
+
+--load-images / --load compare loading a storyboard with json.load (what the
+app did before) against scene_model's streaming loader: load time, time to
+the first scene, and peak and retained memory, each loader in a fresh process.
+
+Example:
+    python benchmark.py --images 64 --concurrency 1,4,16 --latency lognormal:-1,0.3 --save
+    python benchmark.py --compare bench_results/old.json bench_results/new.json
+    python benchmark.py --load-images 100000
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import mock_server
+import stability_api
+from batch_render import render_job, render_scene_file
+from http_client import configure_client
+from result_cache import configure_cache
+from scene_model import load_storyboard
+from sweep import expand_grid, run_sweep
+
+WORKLOADS = ['single', 'batch', 'sweep']
+LOADERS = ['json', 'stream']
+RESULTS_DIR = 'bench_results'
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    low = int(k)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (k - low)
+
+
+def reset_peak_rss():
+    # Linux lets us reset the high-water mark so each run gets its own peak
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """
+    Peak resident set size in bytes (since the last reset where supported).
+    """
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def current_rss():
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def dir_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def write_story(path, images, scene_size=10, metadata=False):
+    """
+    A storyboard of `images` images. With metadata, each image also carries the kind of
+    extra fields generated storyboards have (camera, tags, characters, notes).
+    """
+    scenes = []
+    for start in range(0, images, scene_size):
+        scene = []
+        for i in range(start, min(images, start + scene_size)):
+            image = {'image_description': f'benchmark frame {i}, retro comic style'}
+            if metadata:
+                image['image_description'] += f', a wide establishing shot of the harbor at dusk, take {i % 7}'
+                image.update(camera={'lens': (24, 35, 50, 85)[i % 4], 'angle': 'low', 'movement': 'dolly'},
+                             tags=['harbor', 'dusk', f'shot-{i % 12}'], duration=2.5, notes='from the shot list',
+                             characters=[{'name': 'Ava', 'pose': 'standing'}])
+            scene.append(image)
+        scenes.append({'scene': scene})
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump({'title': 'benchmark', 'scenes': scenes}, file)
+
+
+def load_once(loader, json_path):
+    """
+    Load json_path with one loader and measure it. Meant to run in a fresh process.
+    """
+    gc.collect()
+    baseline = current_rss()
+    reset_peak_rss()
+    started = time.perf_counter()
+    first = []
+    if loader == 'json':
+        with open(json_path, 'r', encoding='utf-8') as file:
+            data = json.load(file)
+        images = sum(len(scene.get('scene', [])) for scene in data['scenes'])
+    else:
+        data = load_storyboard(json_path, on_scene=lambda index: first or first.append(time.perf_counter() - started))
+        images = len(data.descriptions)
+    seconds = time.perf_counter() - started
+    peak = peak_rss()
+    gc.collect()
+    retained = current_rss()
+    return {
+        'loader': loader,
+        'images': images,
+        'seconds': round(seconds, 4),
+        'first_scene_seconds': round(first[0], 4) if first else round(seconds, 4),
+        'peak_bytes': peak - baseline if baseline else peak,
+        'retained_bytes': retained - baseline if baseline and retained else None,
+    }
+
+
+def run_load_benchmarks(json_path):
+    runs = []
+    for loader in LOADERS:
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--load-one', loader, json_path],
+                                check=True, capture_output=True, text=True).stdout
+        run = json.loads(output)
+        runs.append(run)
+        retained = '-' if run['retained_bytes'] is None else f"{run['retained_bytes'] / 1024 ** 2:.0f}MB"
+        print(f"{loader:>6} {run['images']} images  load {run['seconds']:.2f}s  first scene "
+              f"{format_ms(run['first_scene_seconds'])}  peak +{run['peak_bytes'] / 1024 ** 2:.0f}MB  "
+              f"retained +{retained}")
+    return {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {'json_file': json_path, 'size': os.path.getsize(json_path)},
+        'runs': runs,
+    }
+
+
+def run_workload(workload, images, concurrency, work_dir, api_key='benchmark'):
+    output_dir = os.path.join(work_dir, f'{workload}_{concurrency}')
+    os.makedirs(output_dir)
+    configure_client(max_in_flight=concurrency, pool_size=max(32, concurrency), backoff_base=0.1)
+
+    reset_peak_rss()
+    started = time.perf_counter()
+    if workload == 'single':
+        # One request at a time, like clicking Generate and waiting
+        results = [render_job(api_key, {'prompt': f'single {i}', 'seed': i + 1, 'scene_index': None, 'image_index': None},
+                              output_dir) for i in range(images)]
+    elif workload == 'batch':
+        story = os.path.join(work_dir, 'story.json')
+        write_story(story, images)
+        results = render_scene_file(story, api_key, {'seed': 1}, output_dir=output_dir, concurrency=concurrency)
+    else:
+        base = {'method': 'Image Generation', 'prompt': 'benchmark sweep', 'scene_index': None, 'image_index': None}
+        variants = expand_grid(base, seeds=list(range(1, images + 1)))
+        results, _ = run_sweep(api_key, base, variants, output_dir, concurrency)
+    wall = time.perf_counter() - started
+
+    latencies = [r['elapsed'] for r in results if not r['error']]
+    return {
+        'workload': workload,
+        'concurrency': 1 if workload == 'single' else concurrency,
+        'images': images,
+        'wall_seconds': round(wall, 4),
+        'requests_per_second': round(len(results) / wall, 3) if wall else None,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'errors': sum(1 for r in results if r['error']),
+        'retries': sum(r.get('retries', 0) for r in results),
+        'peak_rss_bytes': peak_rss(),
+        'bytes_written': dir_bytes(output_dir),
+    }
+
+
+def run_benchmarks(workloads, images, concurrency_levels, latency, rate_429=0.0, rate_500=0.0, image_size=1024):
+    config = mock_server.MockConfig(latency, rate_429, rate_500, retry_after=0, image_size=image_size)
+    server, base_url = mock_server.start_server(config)
+    stability_api.set_api_base(base_url)
+    configure_cache(enabled=False)  # measure the API path, not the result cache
+
+    work_dir = tempfile.mkdtemp(prefix='stablecanvas_bench_')
+    runs = []
+    try:
+        for workload in workloads:
+            levels = [1] if workload == 'single' else concurrency_levels
+            for concurrency in levels:
+                run = run_workload(workload, images, concurrency, work_dir)
+                runs.append(run)
+                print_run(run)
+    finally:
+        server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {'images': images, 'concurrency': concurrency_levels, 'latency': latency,
+                   'rate_429': rate_429, 'rate_500': rate_500, 'image_size': image_size},
+        'mock_stats': config.stats,
+        'runs': runs,
+    }
+
+
+def format_ms(seconds):
+    return '-' if seconds is None else f'{seconds * 1000:.0f}ms'
+
+
+def print_run(run):
+    print(f"{run['workload']:>6} c={run['concurrency']:<3} {run['requests_per_second']:>8.2f} req/s  "
+          f"p50 {format_ms(run['p50']):>7}  p95 {format_ms(run['p95']):>7}  p99 {format_ms(run['p99']):>7}  "
+          f"rss {run['peak_rss_bytes'] / 1024 ** 2:.0f}MB  written {run['bytes_written'] / 1024 ** 2:.1f}MB  "
+          f"errors {run['errors']}  retries {run['retries']}")
+
+
+def compare(old_path, new_path):
+    with open(old_path) as file:
+        old = {(r['workload'], r['concurrency']): r for r in json.load(file)['runs']}
+    with open(new_path) as file:
+        new = json.load(file)['runs']
+
+    for run in new:
+        before = old.get((run['workload'], run['concurrency']))
+        if before is None:
+            continue
+        change = (run['requests_per_second'] / before['requests_per_second'] - 1) * 100
+        print(f"{run['workload']:>6} c={run['concurrency']:<3} req/s {before['requests_per_second']:.2f} -> "
+              f"{run['requests_per_second']:.2f} ({change:+.1f}%)  p95 {format_ms(before['p95'])} -> {format_ms(run['p95'])}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the generation paths against the mock API.")
+    parser.add_argument('--workloads', default=','.join(WORKLOADS), help="Comma-separated: single,batch,sweep")
+    parser.add_argument('--images', type=int, default=32, help="Images per run")
+    parser.add_argument('--concurrency', default='1,4,16', help="Concurrency levels for batch and sweep")
+    parser.add_argument('--latency', default='lognormal:-1.2,0.3', help="Mock latency, see mock_server.py")
+    parser.add_argument('--rate-429', type=float, default=0.0)
+    parser.add_argument('--rate-500', type=float, default=0.0)
+    parser.add_argument('--image-size', type=int, default=1024)
+    parser.add_argument('--save', nargs='?', const='', help="Save results as JSON (default: bench_results/bench_<time>.json)")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="Compare two saved result files")
+    parser.add_argument('--load', metavar='JSON_FILE', help="Benchmark loading this storyboard instead")
+    parser.add_argument('--load-images', type=int, help="Benchmark loading a generated storyboard of this many images")
+    parser.add_argument('--load-one', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return 0
+    if args.load_one:
+        print(json.dumps(load_once(*args.load_one)))
+        return 0
+
+    if args.load or args.load_images:
+        work_dir = None
+        json_path = args.load
+        if not json_path:
+            work_dir = tempfile.mkdtemp(prefix='stablecanvas_bench_')
+            json_path = os.path.join(work_dir, 'story.json')
+            write_story(json_path, args.load_images, scene_size=50, metadata=True)
+            print(f"Generated {args.load_images} images ({os.path.getsize(json_path) / 1024 ** 2:.0f}MB)")
+        try:
+            results = run_load_benchmarks(json_path)
+        finally:
+            if work_dir:
+                shutil.rmtree(work_dir, ignore_errors=True)
+    else:
+        workloads = [w.strip() for w in args.workloads.split(',') if w.strip()]
+        unknown = set(workloads) - set(WORKLOADS)
+        if unknown:
+            parser.error(f"unknown workloads: {', '.join(sorted(unknown))}")
+
+        levels = [int(c) for c in args.concurrency.split(',')]
+        results = run_benchmarks(workloads, args.images, levels, args.latency, args.rate_429, args.rate_500,
+                                 args.image_size)
+
+    if args.save is not None:
+        path = args.save or os.path.join(RESULTS_DIR, f"bench_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.json")
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=4)
+        print(f"Saved {path}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,455 @@
+"""
+Large-canvas outpainting: grow a source image to a target size (a panorama,
+a poster) with as few Outpaint calls as the endpoint's limits allow.
+
+The plan works in rounds. While the filled area still fits in one upload, a
+single call adds all four margins at once. After that the canvas grows in
+strips: left and right first, then up and down across the full new width.
+Each strip is cut into overlapping segments no longer than the upload limit.
+Every call in a round is independent, so they run concurrently.
+
+Each tile's new pixels are feathered into the canvas over the seam. That
+covers the strip of old pixels the tile was given as context, and the overlap
+with neighbouring tiles. The canvas is a memory-mapped RGBA file under
+.canvas/, so memory stays at a few tiles whatever the final resolution.
+
+At the end the run is compared with growing by a fixed step (512 px per side
+per call, one call at a time, like repeated manual outpaints) in calls and
+estimated time.
+
+Example:
+    python canvas_planner.py photo.png --size 6000x2000 --prompt "misty mountains" --seed 7
+    python canvas_planner.py photo.png --size 6000x2000 --plan-only
+"""
+import argparse
+import io
+import math
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import metrics
+from http_client import configure_client
+from image_index import get_index
+from key_pool import configure_key_pool, get_key_pool, load_keys
+from stability_api import REFERENCE_MAX_SIZE, build_outpaint_request, make_filename, outpaint_url, post_request, save_output
+
+# What one Outpaint call can take: the context upload is kept within the size we never
+# have to shrink, each margin within the API's range, the result within its pixel cap
+MAX_CONTEXT = min(REFERENCE_MAX_SIZE)
+MAX_MARGIN = 2000
+MAX_OUTPUT_PIXELS = 9437184
+MIN_CONTEXT = 64
+
+OVERLAP = 128  # shared by neighbouring segments of a strip
+BLEND = 64  # old pixels next to a seam that are feathered into the new ones
+NAIVE_STEP = 512
+
+
+class Tile:
+    def __init__(self, context, margins):
+        self.context = context  # (x0, y0, x1, y1) of already filled canvas sent as the image
+        self.margins = margins  # (left, right, up, down)
+
+    @property
+    def box(self):
+        x0, y0, x1, y1 = self.context
+        left, right, up, down = self.margins
+        return (x0 - left, y0 - up, x1 + right, y1 + down)
+
+    def __repr__(self):
+        return f'Tile(context={self.context}, margins={self.margins})'
+
+
+def _segments(start, end, limit):
+    """
+    Split [start, end) into the fewest pieces no longer than limit, overlapping by OVERLAP.
+    """
+    length = end - start
+    if length <= limit:
+        return [(start, end)]
+    count = math.ceil((length - OVERLAP) / (limit - OVERLAP))
+    size = math.ceil((length + (count - 1) * OVERLAP) / count)
+    return [(start + round(i * (length - size) / (count - 1)), start + round(i * (length - size) / (count - 1)) + size)
+            for i in range(count)]
+
+
+def _fit_margins(width, height, margins, sides=(0, 1, 2, 3)):
+    """
+    Scale the margins at the given sides down evenly until the result is within
+    MAX_OUTPUT_PIXELS. Returns None if even dropping them isn't enough.
+    """
+    def scaled(factor):
+        return tuple(int(margin * factor) if side in sides else margin for side, margin in enumerate(margins))
+
+    def area(margins):
+        left, right, up, down = margins
+        return (width + left + right) * (height + up + down)
+
+    if area(margins) <= MAX_OUTPUT_PIXELS:
+        return margins
+    if area(scaled(0)) > MAX_OUTPUT_PIXELS:
+        return None
+    low, high = 0.0, 1.0
+    for _ in range(30):
+        middle = (low + high) / 2
+        low, high = (middle, high) if area(scaled(middle)) <= MAX_OUTPUT_PIXELS else (low, middle)
+    return scaled(low)
+
+
+def plan_tiles(source_size, target_size, offset=None, max_margin=MAX_MARGIN, combine=True):
+    """
+    Rounds of tiles that grow the source (placed at offset, centred by default) to the
+    target size. Tiles within a round don't depend on each other. With combine=False no
+    call extends more than one side (the naive plan).
+    """
+    width, height = source_size
+    target_width, target_height = target_size
+    if width > target_width or height > target_height:
+        raise ValueError(f"The target {target_width}x{target_height} is smaller than the source {width}x{height}.")
+    if width < MIN_CONTEXT or height < MIN_CONTEXT:
+        raise ValueError(f"The source must be at least {MIN_CONTEXT} px on each side.")
+    if offset is None:
+        offset = ((target_width - width) // 2, (target_height - height) // 2)
+    x0, y0 = offset
+    if x0 < 0 or y0 < 0 or x0 + width > target_width or y0 + height > target_height:
+        raise ValueError("The source doesn't fit inside the target at that offset.")
+    return _plan((x0, y0, x0 + width, y0 + height), target_size, max_margin, combine)
+
+
+def _plan(filled, target_size, max_margin, combine):
+    x0, y0, x1, y1 = filled
+    target_width, target_height = target_size
+    rounds = []
+    while (x0, y0, x1, y1) != (0, 0, target_width, target_height):
+        left, right, up, down = (min(need, max_margin) for need in
+                                 (x0, target_width - x1, y0, target_height - y1))
+        if combine and x1 - x0 <= MAX_CONTEXT and y1 - y0 <= MAX_CONTEXT:
+            # Everything filled so far fits in one upload: extend every side in one call.
+            # If the result would be too big, try shrinking the margins evenly, or only the
+            # horizontal or only the vertical ones, and keep whichever leaves the fewest calls.
+            best = None
+            for sides in ((0, 1, 2, 3), (0, 1), (2, 3)):
+                margins = _fit_margins(x1 - x0, y1 - y0, (left, right, up, down), sides)
+                if margins is None or not any(margins):
+                    continue
+                rest = _plan((x0 - margins[0], y0 - margins[2], x1 + margins[1], y1 + margins[3]),
+                             target_size, max_margin, combine)
+                if best is None or (count_calls(rest), len(rest)) < (count_calls(best[1]), len(best[1])):
+                    best = (margins, rest)
+            if best is not None:
+                return rounds + [[Tile((x0, y0, x1, y1), best[0])]] + best[1]
+
+        tiles = []
+        if left or right:
+            # Left and right strips, in segments down the edge
+            depth = min(MAX_CONTEXT, x1 - x0)
+            segments = _segments(y0, y1, MAX_CONTEXT)
+            cap = MAX_OUTPUT_PIXELS // max(bottom - top for top, bottom in segments) - depth
+            left, right = min(left, cap), min(right, cap)
+            for top, bottom in segments:
+                if left:
+                    tiles.append(Tile((x0, top, x0 + depth, bottom), (left, 0, 0, 0)))
+                if right:
+                    tiles.append(Tile((x1 - depth, top, x1, bottom), (0, right, 0, 0)))
+            x0, x1 = x0 - left, x1 + right
+        else:
+            # Then top and bottom strips, in segments across the full width
+            depth = min(MAX_CONTEXT, y1 - y0)
+            segments = _segments(x0, x1, MAX_CONTEXT)
+            cap = MAX_OUTPUT_PIXELS // max(end - start for start, end in segments) - depth
+            up, down = min(up, cap), min(down, cap)
+            for start, end in segments:
+                if up:
+                    tiles.append(Tile((start, y0, end, y0 + depth), (0, 0, up, 0)))
+                if down:
+                    tiles.append(Tile((start, y1 - depth, end, y1), (0, 0, 0, down)))
+            y0, y1 = y0 - up, y1 + down
+        rounds.append(tiles)
+    return rounds
+
+
+def count_calls(rounds):
+    return sum(len(tiles) for tiles in rounds)
+
+
+def _blend_box(tile):
+    """
+    The part of a tile's box its result can change: the new pixels plus BLEND px of context
+    along the seam. Deeper context keeps the canvas pixels and isn't touched.
+    """
+    bx0, by0, bx1, by1 = tile.box
+    cx0, cy0, cx1, cy1 = tile.context
+    left, right, up, down = tile.margins
+    if left and not right:
+        bx1 = min(bx1, cx0 + BLEND)
+    if right and not left:
+        bx0 = max(bx0, cx1 - BLEND)
+    if up and not down:
+        by1 = min(by1, cy0 + BLEND)
+    if down and not up:
+        by0 = max(by0, cy1 - BLEND)
+    return bx0, by0, bx1, by1
+
+
+def _png(pixels):
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def _weights(np, tile, composited, box):
+    """
+    Per-pixel weight of the tile's result over box: 1 on new pixels, fading to 0 across
+    BLEND px of the context next to each seam and across overlaps with earlier tiles.
+    """
+    bx0, by0, bx1, by1 = tile.box
+    cx0, cy0, cx1, cy1 = tile.context
+    left, right, up, down = tile.margins
+    xs = np.arange(box[0], box[2], dtype=np.float32)[None, :]
+    ys = np.arange(box[1], box[3], dtype=np.float32)[:, None]
+
+    # Distance into the context from each side that was extended
+    inside = np.zeros((box[3] - box[1], box[2] - box[0]), dtype=np.float32)
+    for extended, distance in ((left, xs - cx0), (right, cx1 - 1 - xs), (up, ys - cy0), (down, cy1 - 1 - ys)):
+        if extended:
+            inside = np.maximum(inside, np.clip(1 - distance / BLEND, 0, 1))
+    in_context = (xs >= cx0) & (xs < cx1) & (ys >= cy0) & (ys < cy1)
+    weights = np.where(in_context, inside, 1).astype(np.float32)
+
+    # Ramp in from any neighbour of this round that was already composited
+    for ox0, oy0, ox1, oy1 in composited:
+        ix0, iy0, ix1, iy1 = max(bx0, ox0), max(by0, oy0), min(bx1, ox1), min(by1, oy1)
+        if ix0 >= ix1 or iy0 >= iy1:
+            continue
+        if abs((oy0 + oy1) - (by0 + by1)) > abs((ox0 + ox1) - (bx0 + bx1)):  # stacked vertically
+            ramp = (ys - iy0 + 1) / (iy1 - iy0 + 1) if oy0 < by0 else (iy1 - ys) / (iy1 - iy0 + 1)
+        else:
+            ramp = (xs - ix0 + 1) / (ix1 - ix0 + 1) if ox0 < bx0 else (ix1 - xs) / (ix1 - ix0 + 1)
+        overlap = (xs >= ix0) & (xs < ix1) & (ys >= iy0) & (ys < iy1)
+        weights = np.where(overlap, weights * np.clip(ramp, 0, 1), weights)
+    return weights[:, :, None]
+
+
+class Canvas:
+    """
+    An RGBA canvas backed by a memory-mapped file, so only the tiles being worked on are in memory.
+    """
+    def __init__(self, path, size):
+        import numpy as np
+
+        self.np = np
+        self.path = path
+        self.width, self.height = size
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.pixels = np.memmap(path, dtype=np.uint8, mode='w+', shape=(self.height, self.width, 4))
+        self._lock = threading.Lock()
+
+    def paste(self, image, offset):
+        x, y = offset
+        array = self.np.asarray(image.convert('RGBA'))
+        self.pixels[y:y + array.shape[0], x:x + array.shape[1]] = array
+
+    def crop(self, box):
+        """
+        A copy of a region's RGB pixels, to upload as a tile's context.
+        """
+        x0, y0, x1, y1 = box
+        return self.np.array(self.pixels[y0:y1, x0:x1, :3])
+
+    def blend(self, tile, image_bytes, composited):
+        """
+        Feather a tile's result into the canvas. The result is resized to the tile's box if the
+        API returned another size.
+        """
+        from PIL import Image
+
+        np = self.np
+        bx0, by0, bx1, by1 = tile.box
+        x0, y0, x1, y1 = _blend_box(tile)
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            img = img.convert('RGB')
+            if img.size != (bx1 - bx0, by1 - by0):
+                img = img.resize((bx1 - bx0, by1 - by0), Image.LANCZOS)
+            # Kept as uint8 until the lock is held, so concurrent decodes stay small
+            new = np.asarray(img.crop((x0 - bx0, y0 - by0, x1 - bx0, y1 - by0)))
+        with self._lock:
+            weights = _weights(np, tile, composited, (x0, y0, x1, y1))
+            region = self.pixels[y0:y1, x0:x1]
+            old = region[:, :, :3].astype(np.float32)
+            region[:, :, :3] = (old + (new - old) * weights + 0.5).astype(np.uint8)
+            region[:, :, 3] = 255
+            composited.append(tile.box)
+
+    def write_png(self, file):
+        from PIL import Image
+
+        self.pixels.flush()
+        # frombuffer reads the memory map in place instead of copying it
+        image = Image.frombuffer('RGBA', (self.width, self.height), self.pixels, 'raw', 'RGBA', 0, 1)
+        image.save(file, format='PNG')
+
+    def close(self):
+        del self.pixels
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def run_plan(api_key, source_path, target_size, prompt='', seed=0, offset=None, output_dir='generated_images',
+             concurrency=4, timeout=None, progress=None):
+    """
+    Outpaint source_path up to target_size. progress(round_number, rounds, tile, done, total)
+    is called as tiles finish. Returns {'filename', 'calls', 'rounds', 'elapsed', 'latencies'};
+    raises if a call fails.
+    """
+    from PIL import Image
+
+    with Image.open(source_path) as source:
+        source.load()
+    rounds = plan_tiles(source.size, target_size, offset)
+    if offset is None:
+        offset = ((target_size[0] - source.width) // 2, (target_size[1] - source.height) // 2)
+
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    canvas_path = os.path.join(output_dir, '.canvas', f'{Path(source_path).stem}_{os.getpid()}.rgba')
+    canvas = Canvas(canvas_path, target_size)
+    started = time.perf_counter()
+    latencies = []
+    try:
+        canvas.paste(source, offset)
+        del source
+
+        def send(tile, context, number):
+            with metrics.trace(method='Outpaint', tile=number):
+                # Encoded here so the round's contexts compress in parallel
+                request = build_outpaint_request(api_key, _png(context), '.png', *tile.margins,
+                                                 prompt=prompt, seed=seed)
+                response = post_request(request, timeout=timeout)
+                if response.status_code != 200:
+                    raise RuntimeError(f"Error {response.status_code}: {response.text}")
+                if 'image' not in response.headers.get('Content-Type', ''):
+                    raise RuntimeError(f"Unexpected response type: {response.headers.get('Content-Type', '')}")
+                latencies.append(getattr(response, 'latency', 0.0))
+                return response.content
+
+        total = count_calls(rounds)
+        done = 0
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            for round_number, tiles in enumerate(rounds, 1):
+                composited = []
+                # Every context comes from the canvas as it was before this round's seams are blended
+                contexts = [canvas.crop(tile.context) for tile in tiles]
+                futures = {pool.submit(send, tile, context, done + i + 1): tile
+                           for i, (tile, context) in enumerate(zip(tiles, contexts))}
+                for future in as_completed(futures):
+                    tile = futures[future]
+                    canvas.blend(tile, future.result(), composited)
+                    done += 1
+                    if progress:
+                        progress(round_number, len(rounds), tile, done, total)
+
+        filename = make_filename(output_dir, '.png', 'Outpaint', seed=seed)
+        filename = save_output(filename, canvas.write_png)
+    finally:
+        canvas.close()
+
+    elapsed = time.perf_counter() - started
+    get_index(output_dir).record(filename, {'method': 'Outpaint', 'prompt': prompt, 'seed': seed,
+                                            'reference_image': str(source_path), 'canvas': list(target_size),
+                                            'calls': total},
+                                 endpoint=outpaint_url, latency=elapsed, size=os.path.getsize(filename))
+    return {'filename': filename, 'calls': total, 'rounds': len(rounds), 'elapsed': elapsed, 'latencies': latencies}
+
+
+def compare(source_size, target_size, offset=None, step=NAIVE_STEP):
+    """
+    Calls for the plan and for growing by a fixed step, one side per call.
+    """
+    planned = plan_tiles(source_size, target_size, offset)
+    naive = plan_tiles(source_size, target_size, offset, max_margin=step, combine=False)
+    return {'calls': count_calls(planned), 'rounds': len(planned), 'naive_calls': count_calls(naive)}
+
+
+def parse_size(text):
+    width, _, height = text.lower().partition('x')
+    return int(width), int(height)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Outpaint an image to a large canvas in as few calls as possible.")
+    parser.add_argument('source', help="Image to grow")
+    parser.add_argument('--size', required=True, help="Target canvas, e.g. 6000x2000")
+    parser.add_argument('--offset', help="Where the source goes on the canvas, e.g. 0,500 (default: centred)")
+    parser.add_argument('--prompt', default='')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--api-key', default=os.environ.get('STABILITY_API_KEY'),
+                        help="Stability API key (default: $STABILITY_API_KEY)")
+    parser.add_argument('--keys-file', help="File with one API key per line (see key_pool.py)")
+    parser.add_argument('--concurrency', type=int, default=4, help="Tiles in flight at once")
+    parser.add_argument('--output-dir', default='generated_images')
+    parser.add_argument('--timeout', type=float, default=120, help="Per-request timeout in seconds")
+    parser.add_argument('--naive-step', type=int, default=NAIVE_STEP, help="Fixed step to compare against")
+    parser.add_argument('--plan-only', action='store_true', help="Print the plan without calling the API")
+    args = parser.parse_args(argv)
+
+    try:
+        from PIL import Image
+
+        with Image.open(args.source) as source:
+            source_size = source.size
+        target_size = parse_size(args.size)
+        offset = tuple(int(part) for part in args.offset.split(',')) if args.offset else None
+        rounds = plan_tiles(source_size, target_size, offset)
+        comparison = compare(source_size, target_size, offset, args.naive_step)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+
+    print(f"Plan: {comparison['calls']} calls in {comparison['rounds']} rounds "
+          f"(fixed {args.naive_step} px steps: {comparison['naive_calls']} calls)")
+    if args.plan_only:
+        for number, tiles in enumerate(rounds, 1):
+            print(f"  round {number}: " + ', '.join(f"{tile.context} +{tile.margins}" for tile in tiles))
+        return 0
+
+    try:
+        if args.keys_file:
+            configure_key_pool(load_keys(args.keys_file))
+            args.api_key = None
+        elif not args.api_key and get_key_pool() is None:
+            print("API key is required (--api-key, STABILITY_API_KEY, --keys-file or STABILITY_API_KEYS).", file=sys.stderr)
+            return 2
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    configure_client(max_in_flight=args.concurrency, pool_size=max(32, args.concurrency), timeout=args.timeout)
+
+    def progress(round_number, rounds, tile, done, total):
+        print(f"[{done}/{total}] round {round_number}/{rounds}: {tile.box}")
+
+    try:
+        result = run_plan(args.api_key, args.source, target_size, args.prompt, args.seed, offset, args.output_dir,
+                          args.concurrency, args.timeout, progress)
+    except (OSError, RuntimeError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+    mean = sum(result['latencies']) / len(result['latencies']) if result['latencies'] else 0.0
+    naive_time = comparison['naive_calls'] * mean
+    print(f"Saved {result['filename']} ({target_size[0]}x{target_size[1]}) with {result['calls']} calls "
+          f"in {result['elapsed']:.1f}s")
+    print(f"Fixed {args.naive_step} px steps would take {comparison['naive_calls']} calls, "
+          f"about {naive_time:.1f}s one after another: {comparison['naive_calls'] - result['calls']} calls "
+          f"and ~{max(0.0, naive_time - result['elapsed']):.1f}s saved")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
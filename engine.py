@@ -0,0 +1,103 @@
+"""
+The generation engine, without any GUI.
+
+Everything a generation needs is passed in explicitly: a params dict (method,
+prompt, seed, strengths, margins, reference image, scene/image position) and
+the API key. The GUI, the batch renderer and the workers all go through
+generate(), so they build, send, check, name and index outputs the same way.
+
+Nothing heavy is imported up front: requests is loaded with the first HTTP
+client and PIL with the first reference image, so importing this module (or
+running a CLI's --help) costs a few milliseconds.
+
+Example:
+    import engine
+    scenes = engine.load_scenes('story.json')
+    for job in engine.collect_jobs(scenes, {'method': 'Image Generation', 'seed': 7}):
+        print(engine.generate(api_key, job)['filename'])
+"""
+from pathlib import Path
+
+from image_index import record_output
+from scene_model import load_storyboard
+from stability_api import build_request, make_filename, post_request, response_body, save_output
+
+
+def load_scenes(json_path):
+    """
+    The scenes of a scene JSON file, held compactly (see scene_model.py) but indexed like
+    the lists and dicts json.load would give. Raises ValueError for invalid files.
+    """
+    return load_storyboard(json_path).scenes
+
+
+def in_range(number, ranges):
+    if ranges is None:
+        return True
+    return any(start <= number and (end is None or number <= end) for start, end in ranges)
+
+
+def collect_jobs(scenes, settings, scene_range=None, image_range=None, base_dir='.'):
+    """
+    Turn the scenes into a list of job dicts (the request params plus scene/image indices).
+    An image entry may have its own "reference_image", relative to the JSON file.
+    scene_range/image_range are lists of 1-based (start, end) pairs, as from batch_render.parse_range.
+    """
+    jobs = []
+    for scene_index, scene in enumerate(scenes):
+        if not in_range(scene_index + 1, scene_range):
+            continue
+        for image_index, image in enumerate(scene.get('scene', [])):
+            if not in_range(image_index + 1, image_range):
+                continue
+
+            params = dict(settings)
+            params['prompt'] = image.get('image_description', '')
+            if image.get('reference_image'):
+                params['reference_image'] = str(Path(base_dir) / image['reference_image'])
+            params['scene_index'] = scene_index
+            params['image_index'] = image_index
+            jobs.append(params)
+    return jobs
+
+
+def generate(api_key, params, output_dir='generated_images', timeout=None, index=True, check=None, progress=None):
+    """
+    Build the request for params, send it, and save (and index) the image.
+    check() is called between steps and may raise to cancel; progress(text) reports the step.
+    Returns {'filename', 'retries', 'latency', 'from_cache', 'coalesced'}; raises on any failure.
+    coalesced means an identical request already in flight answered this one.
+    """
+    if progress:
+        progress('preparing request')
+    request = build_request(api_key, params)
+    if check:
+        check()
+
+    if progress:
+        progress('waiting for API')
+    response = post_request(request, timeout=timeout, stream=True)
+    try:
+        if response.status_code != 200:
+            raise RuntimeError(f"Error {response.status_code}: {response.text}")
+        content_type = response.headers.get('Content-Type', '')
+        if 'image' not in content_type:
+            raise RuntimeError(f"Unexpected response type: {content_type}")
+        if check:
+            check()
+
+        from_cache = getattr(response, 'from_cache', False)
+        coalesced = getattr(response, 'coalesced', False)
+        if progress:
+            progress('saving from cache' if from_cache else 'saving shared result' if coalesced else 'saving')
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+        filename = make_filename(output_dir, '.png', params.get('method', 'Image Generation'),
+                                 params.get('scene_index'), params.get('image_index'), params.get('seed', 0))
+        filename = save_output(filename, response_body(response), params, content_type)
+    finally:
+        if getattr(response, 'streamed', False):
+            response.close()  # hands the connection back even if the body was never read
+    if index:
+        record_output(filename, request, response, params, output_dir)
+    return {'filename': filename, 'retries': getattr(response, 'retries', 0),
+            'latency': getattr(response, 'latency', None), 'from_cache': from_cache, 'coalesced': coalesced}
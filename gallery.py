@@ -0,0 +1,265 @@
+"""
+Gallery of generated outputs.
+
+Only the thumbnails of the rows on screen are decoded. Thumbnails come from an
+on-disk cache (generated_images/.thumbs, keyed by path and mtime) and are made
+on background threads; the Tk PhotoImages for them live in a small LRU so
+memory stays flat however far you scroll.
+"""
+import hashlib
+import os
+import queue
+import tkinter as tk
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from tkinter import ttk
+
+from image_index import is_copy, parse_filename
+from output_sink import scan_outputs
+from stability_api import METHODS
+
+THUMB_SIZE = 128
+CELL_SIZE = THUMB_SIZE + 24  # room for the caption
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+
+
+def list_outputs(output_dir, scene=None, image=None, method=None):
+    """
+    App-named images in output_dir and its shard directories, newest first, as (path, info)
+    pairs. Only filenames are read, nothing is decoded. scene and image are 1-based.
+    """
+    outputs = []
+    for directory, entries in scan_outputs(output_dir):
+        names = {entry.name for entry in entries}
+        for entry in entries:
+            if not entry.name.lower().endswith(IMAGE_EXTENSIONS) or is_copy(entry.name, names):
+                continue
+            info = parse_filename(entry.name)
+            if info is None:
+                continue
+            if scene is not None and info['scene_index'] != scene:
+                continue
+            if image is not None and info['image_index'] != image:
+                continue
+            if method and info['method'] != method:
+                continue
+            outputs.append((f'{directory}/{entry.name}', info))
+
+    outputs.sort(key=lambda item: (item[1]['created_at'], item[0]), reverse=True)
+    return outputs
+
+
+class ThumbnailCache:
+    def __init__(self, cache_dir, size=THUMB_SIZE):
+        self.cache_dir = cache_dir
+        self.size = size
+
+    def thumb_path(self, image_path):
+        stat = os.stat(image_path)
+        key = hashlib.sha1(f'{os.path.abspath(image_path)}|{stat.st_mtime_ns}|{self.size}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], f'{key}.png')
+
+    def load(self, image_path):
+        """
+        The thumbnail as a PIL image, made and cached on first use. Safe to call from any thread.
+        """
+        from PIL import Image  # loaded when the gallery first shows something, not at startup
+        thumb_path = self.thumb_path(image_path)
+        try:
+            with Image.open(thumb_path) as thumb:
+                thumb.load()
+                return thumb
+        except (FileNotFoundError, OSError):
+            pass
+
+        with Image.open(image_path) as img:
+            img.draft('RGB', (self.size, self.size))  # lets JPEG decode at reduced size
+            img.thumbnail((self.size, self.size), Image.LANCZOS, reducing_gap=2.0)
+            thumb = img.convert('RGBA' if img.mode in ('RGBA', 'LA', 'P') else 'RGB')
+
+        os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+        temp_path = f'{thumb_path}.{os.getpid()}.tmp'
+        thumb.save(temp_path, format='PNG')
+        os.replace(temp_path, thumb_path)
+        return thumb
+
+
+class Gallery(tk.Toplevel):
+    """
+    Scrollable grid of outputs. on_select(path) is called when a thumbnail is clicked.
+    """
+
+    def __init__(self, master, output_dir, on_select=None, max_photos=300, workers=4):
+        super().__init__(master)
+        self.title("Generated Images")
+        self.geometry("760x620")
+
+        self.output_dir = output_dir
+        self.on_select = on_select
+        self.thumbs = ThumbnailCache(os.path.join(output_dir, '.thumbs'))
+        self.max_photos = max_photos
+        self.photos = OrderedDict()  # path -> PhotoImage, least recently used first
+        self.loading = set()
+        self.failed = set()
+        self.closed = False
+        self.loaded = queue.Queue()
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.items = []
+        self.offset = 0
+        self.columns = 1
+
+        # Filters
+        filters = tk.Frame(self, padx=5, pady=5)
+        filters.pack(fill="x")
+        tk.Label(filters, text="Scene:").pack(side="left")
+        self.scene_entry = tk.Entry(filters, width=6)
+        self.scene_entry.pack(side="left", padx=5)
+        tk.Label(filters, text="Image:").pack(side="left")
+        self.image_entry = tk.Entry(filters, width=6)
+        self.image_entry.pack(side="left", padx=5)
+        tk.Label(filters, text="Method:").pack(side="left")
+        self.method_var = tk.StringVar(value="All")
+        method_combobox = ttk.Combobox(filters, textvariable=self.method_var, state='readonly', width=20)
+        method_combobox['values'] = ['All'] + METHODS
+        method_combobox.pack(side="left", padx=5)
+        tk.Button(filters, text="Apply", command=self.refresh, width=8).pack(side="left", padx=5)
+        self.count_label = tk.Label(filters, anchor="e")
+        self.count_label.pack(side="right")
+
+        # Grid
+        body = tk.Frame(self)
+        body.pack(fill="both", expand=True)
+        self.canvas = tk.Canvas(body, bg="gray20", highlightthickness=0)
+        self.canvas.pack(side="left", fill="both", expand=True)
+        self.scrollbar = tk.Scrollbar(body, command=self.yview)
+        self.scrollbar.pack(side="right", fill="y")
+
+        self.canvas.bind("<Configure>", lambda event: self.redraw())
+        self.canvas.bind("<MouseWheel>", lambda event: self.yview('scroll', -1 if event.delta > 0 else 1, 'units'))
+        self.canvas.bind("<Button-4>", lambda event: self.yview('scroll', -1, 'units'))
+        self.canvas.bind("<Button-5>", lambda event: self.yview('scroll', 1, 'units'))
+        self.canvas.bind("<Button-1>", self.click)
+        self.protocol("WM_DELETE_WINDOW", self.close)
+
+        self.refresh()
+        self.after(50, self.poll_loaded)
+
+    def _int_filter(self, entry):
+        text = entry.get().strip()
+        return int(text) if text.isdigit() else None
+
+    def refresh(self):
+        method = self.method_var.get()
+        self.items = list_outputs(self.output_dir, self._int_filter(self.scene_entry),
+                                  self._int_filter(self.image_entry), None if method == 'All' else method)
+        self.count_label.configure(text=f"{len(self.items)} images")
+        self.offset = 0
+        self.redraw()
+
+    def total_height(self):
+        rows = (len(self.items) + self.columns - 1) // self.columns
+        return rows * CELL_SIZE
+
+    def yview(self, *args):
+        height = max(1, self.canvas.winfo_height())
+        total = self.total_height()
+        if args[0] == 'moveto':
+            self.offset = float(args[1]) * total
+        elif args[0] == 'scroll':
+            step = CELL_SIZE if args[2] == 'units' else height
+            self.offset += int(args[1]) * step
+        self.offset = int(max(0, min(self.offset, total - height)))
+        self.redraw()
+
+    def redraw(self):
+        """
+        Draw only the rows inside the visible area.
+        """
+        width = max(1, self.canvas.winfo_width())
+        height = max(1, self.canvas.winfo_height())
+        self.columns = max(1, width // CELL_SIZE)
+        total = self.total_height()
+        self.offset = int(max(0, min(self.offset, total - height)))
+
+        if total > 0:
+            self.scrollbar.set(self.offset / total, min(1.0, (self.offset + height) / total))
+        else:
+            self.scrollbar.set(0, 1)
+
+        self.canvas.delete("all")
+        first_row = self.offset // CELL_SIZE
+        last_row = (self.offset + height) // CELL_SIZE
+        for row in range(first_row, last_row + 1):
+            for column in range(self.columns):
+                position = row * self.columns + column
+                if position >= len(self.items):
+                    return
+                self.draw_cell(position, column * CELL_SIZE, row * CELL_SIZE - self.offset)
+
+    def draw_cell(self, position, x, y):
+        path, info = self.items[position]
+        photo = self.photos.get(path)
+        if photo is not None:
+            self.photos.move_to_end(path)
+            self.canvas.create_image(x + CELL_SIZE // 2, y + 4 + THUMB_SIZE // 2, image=photo)
+        else:
+            self.canvas.create_rectangle(x + 12, y + 4, x + 12 + THUMB_SIZE, y + 4 + THUMB_SIZE, outline="gray40")
+            self.request_thumbnail(path)
+
+        if info['scene_index'] is not None:
+            caption = f"S{info['scene_index']} I{info['image_index']}"
+        else:
+            caption = f"seed {info['seed']}"
+        if info['method'] and info['method'] != 'Image Generation':
+            caption += f" {info['method'].split()[-1]}"
+        self.canvas.create_text(x + CELL_SIZE // 2, y + THUMB_SIZE + 14, text=caption, fill="white", font=("Arial", 8))
+
+    def request_thumbnail(self, path):
+        if path in self.loading or path in self.failed:
+            return
+        self.loading.add(path)
+
+        def load():
+            try:
+                self.loaded.put((path, self.thumbs.load(path)))
+            except Exception:
+                self.loaded.put((path, None))
+
+        self.pool.submit(load)
+
+    def poll_loaded(self):
+        # PhotoImages have to be made on the Tk thread
+        if self.closed:
+            return
+        from PIL import ImageTk
+        changed = False
+        while True:
+            try:
+                path, thumb = self.loaded.get_nowait()
+            except queue.Empty:
+                break
+            self.loading.discard(path)
+            if thumb is None:
+                self.failed.add(path)
+                continue
+            self.photos[path] = ImageTk.PhotoImage(thumb)
+            while len(self.photos) > self.max_photos:
+                self.photos.popitem(last=False)
+            changed = True
+
+        if changed:
+            self.redraw()
+        self.after(50, self.poll_loaded)
+
+    def click(self, event):
+        column = event.x // CELL_SIZE
+        row = (event.y + self.offset) // CELL_SIZE
+        position = row * self.columns + column
+        if column < self.columns and 0 <= position < len(self.items) and self.on_select:
+            self.on_select(self.items[position][0])
+
+    def close(self):
+        self.closed = True
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.photos.clear()
+        self.destroy()
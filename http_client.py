@@ -0,0 +1,226 @@
+"""
+Shared HTTP client for the Stability AI endpoints.
+
+Every request goes through one requests.Session so connections (and their TLS
+handshakes) are reused per host. The number of requests in flight per endpoint
+is capped, and transient failures (429, 5xx, connection errors) are retried
+with jittered exponential backoff, honoring the server's Retry-After header.
+
+requests is imported when the first client is created, not with this module,
+so scripts that never send anything start quickly.
+"""
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import metrics
+from key_pool import KEY_FAILURE_CODES
+
+# Status codes worth retrying
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def parse_retry_after(value):
+    """
+    Return the Retry-After header as seconds, or None if it is missing or invalid.
+    The header can be a number of seconds or an HTTP date.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class TimedBody:
+    """
+    A prepared request body sent in chunks, noting when the last chunk went out
+    so upload time can be told apart from the server's processing time.
+    """
+    def __init__(self, body, chunk_size=64 * 1024):
+        self.body = body
+        self.chunk_size = chunk_size
+        self.sent_at = None
+
+    def __iter__(self):
+        for start in range(0, len(self.body), self.chunk_size):
+            yield self.body[start:start + self.chunk_size]
+        self.sent_at = time.perf_counter()
+
+
+class StabilityClient:
+    def __init__(self, max_in_flight=4, max_retries=4, backoff_base=1.0, backoff_max=30.0,
+                 max_retry_after=120.0, pool_size=32, timeout=120):
+        self.max_in_flight = max_in_flight  # per endpoint
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_retry_after = max_retry_after
+        self.timeout = timeout
+
+        import requests #pip install requests
+        from requests.adapters import HTTPAdapter
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._slots_free = threading.Condition()
+        self._in_flight = {}
+
+    def _acquire(self, url):
+        # max_in_flight is read on every call so it can be raised while requests are running
+        with self._slots_free:
+            while self._in_flight.get(url, 0) >= self.max_in_flight:
+                self._slots_free.wait()
+            self._in_flight[url] = self._in_flight.get(url, 0) + 1
+
+    def _release(self, url):
+        with self._slots_free:
+            self._in_flight[url] -= 1
+            self._slots_free.notify_all()
+
+    def set_max_in_flight(self, max_in_flight):
+        with self._slots_free:
+            self.max_in_flight = max_in_flight
+            self._slots_free.notify_all()
+
+    def in_flight(self):
+        with self._slots_free:
+            return sum(self._in_flight.values())
+
+    def backoff_delay(self, attempt, response=None):
+        """
+        Seconds to wait before retry number `attempt` (starting at 1).
+        Uses Retry-After when the server sent one, otherwise full-jitter exponential backoff.
+        """
+        if response is not None:
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if retry_after is not None:
+                return min(retry_after, self.max_retry_after)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+    def send(self, url, headers, files, data, timeout, stream=False):
+        """
+        One attempt. Records upload, time to first byte and download into the current trace.
+        With stream, the body of a successful image response is left unread and
+        response.streamed is set: the caller reads it in chunks (iter_content) and closes it.
+        """
+        import requests
+        prepared = self.session.prepare_request(
+            requests.Request('POST', url, headers=headers, files=files, data=data))
+        settings = self.session.merge_environment_settings(prepared.url, {}, None, None, None)
+        settings['stream'] = True
+        body = None
+        if isinstance(prepared.body, bytes):
+            # Content-Length is already set, so the iterable goes out unchunked
+            body = prepared.body = TimedBody(prepared.body)
+
+        started = time.perf_counter()
+        response = self.session.send(prepared, timeout=timeout, **settings)
+        headers_at = time.perf_counter()
+        response.streamed = (stream and response.status_code == 200
+                             and 'image' in response.headers.get('Content-Type', ''))
+        sent_at = body.sent_at if body is not None and body.sent_at else started
+        metrics.add_phase('upload', sent_at - started)
+        metrics.add_phase('ttfb', headers_at - sent_at)
+        if not response.streamed:
+            response.content  # read the body now so the connection goes back to the pool
+            metrics.add_phase('download', time.perf_counter() - headers_at)
+        return response
+
+    def post(self, url, headers=None, files=None, data=None, timeout=None, key_pool=None, stream=False):
+        """
+        POST with retries. Returns the last response (which may still be an error);
+        raises the last exception if every attempt failed to connect.
+        The number of retries used is stored on response.retries. stream is passed
+        to send(); only a successful image response is left unread.
+
+        With a key_pool, each attempt draws a key from it (the key's own concurrency cap
+        replaces the per-endpoint one) and a 401/402/429 moves straight on to another key.
+        """
+        import requests
+
+        timeout = timeout or self.timeout
+        max_retries = self.max_retries + (len(key_pool) if key_pool else 0)
+        attempt = 0
+        while True:
+            response = None
+            error = None
+            key = None
+            if key_pool is not None:
+                key = key_pool.acquire(self.max_retry_after)
+                attempt_headers = dict(headers or {}, Authorization=f'Bearer {key.secret}')
+            else:
+                attempt_headers = headers
+                self._acquire(url)
+            try:
+                response = self.send(url, attempt_headers, files, data, timeout, stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            finally:
+                if key is None:
+                    self._release(url)
+                else:
+                    status = response.status_code if response is not None else None
+                    retry_after = parse_retry_after(response.headers.get('Retry-After')) if status == 429 else None
+                    key_pool.release(key, status, retry_after)
+
+            failover = key is not None and response is not None and response.status_code in KEY_FAILURE_CODES
+            retryable = error is not None or failover or response.status_code in RETRY_STATUS_CODES
+            if not retryable or attempt >= max_retries:
+                metrics.annotate(retries=attempt)
+                if key is not None:
+                    metrics.annotate(key=key.name)
+                if error is not None:
+                    metrics.annotate(error=type(error).__name__)
+                    raise error
+                response.retries = attempt
+                metrics.annotate(status=response.status_code)
+                if not response.streamed:
+                    metrics.annotate(bytes=len(response.content))
+                return response
+
+            attempt += 1
+            if not failover:
+                # Sleep outside the slot so waiting requests don't block others
+                time.sleep(self.backoff_delay(attempt, response))
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    The client shared by the GUI and the batch renderer.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = StabilityClient()
+        return _client
+
+
+def configure_client(**settings):
+    """
+    Replace the shared client, e.g. configure_client(max_in_flight=8, max_retries=6).
+    """
+    global _client
+    with _client_lock:
+        old = _client
+        _client = StabilityClient(**settings)
+    if old is not None:
+        old.session.close()
+    return _client
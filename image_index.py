@@ -0,0 +1,305 @@
+"""
+SQLite index of every generated image and the parameters that produced it.
+
+A row is written on every successful save (GUI and batch). Query it by scene,
+image, method, seed and time range, or rebuild it from the filenames already in
+generated_images/.
+
+Example:
+    python image_index.py rebuild
+    python image_index.py query --scene 12 --method "Image with Structure" --seed 42
+"""
+import argparse
+import atexit
+import json
+import os
+import queue
+import re
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+from output_sink import scan_outputs, split_archive_path
+from stability_api import METHOD_TAGS, request_fields
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    created_at REAL NOT NULL,
+    json_file TEXT,
+    scene_index INTEGER,
+    image_index INTEGER,
+    method TEXT,
+    seed INTEGER,
+    prompt TEXT,
+    endpoint TEXT,
+    params TEXT,
+    latency REAL,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS images_scene ON images (scene_index, image_index);
+CREATE INDEX IF NOT EXISTS images_method ON images (method, created_at);
+CREATE INDEX IF NOT EXISTS images_seed ON images (seed);
+CREATE INDEX IF NOT EXISTS images_created ON images (created_at);
+"""
+
+# Filename tag -> method, the reverse of stability_api.METHOD_TAGS
+TAG_METHODS = {tag: method for method, tag in METHOD_TAGS.items()}
+
+TIMESTAMP = r'(?P<timestamp>\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})(?:_\d+)?'
+TAGS = r'(?P<tag>_sample_1|_structure|_outpaint)?'
+SCENE_NAME = re.compile(r'^scene_(?P<scene>\d+)_image_(?P<image>\d+)' + TAGS + '_' + TIMESTAMP + r'\.\w+$')
+SEED_NAME = re.compile(r'^generated_image_(?P<seed>-?\d+)' + TAGS + '_' + TIMESTAMP + r'\.\w+$')
+
+
+def is_copy(name, names):
+    """
+    True for a WebP/JPEG copy that postprocess.py made of a PNG output also in names.
+    """
+    stem, suffix = os.path.splitext(name)
+    return suffix.lower() != '.png' and f'{stem}.png' in names
+
+
+def parse_filename(filename):
+    """
+    Recover scene/image indices (1-based, as in the name), method, seed and time from an
+    output filename. Returns None for files that weren't named by the app.
+    """
+    name = os.path.basename(filename)
+    match = SCENE_NAME.match(name) or SEED_NAME.match(name)
+    if not match:
+        return None
+
+    groups = match.groupdict()
+    info = {
+        'method': TAG_METHODS.get(groups['tag'] or ''),
+        'created_at': datetime.strptime(groups['timestamp'], '%Y-%m-%d_%H-%M-%S').timestamp(),
+        'scene_index': int(groups['scene']) if groups.get('scene') else None,
+        'image_index': int(groups['image']) if groups.get('image') else None,
+        'seed': int(groups['seed']) if groups.get('seed') else None,
+    }
+    return info
+
+
+class ImageIndex:
+    def __init__(self, db_path):
+        self.db_path = str(db_path)
+        Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+
+    def record(self, path, params, json_file=None, scene_index=None, image_index=None,
+               endpoint=None, latency=None, size=None, created_at=None):
+        """
+        Add (or replace) the row for one saved image.
+        scene_index and image_index are stored 1-based, the way they appear in filenames.
+        """
+        seed = params.get('seed')
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO images (path, created_at, json_file, scene_index, image_index, method, '
+                'seed, prompt, endpoint, params, latency, size) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (str(path), created_at or time.time(), json_file,
+                 None if scene_index is None else scene_index + 1,
+                 None if image_index is None else image_index + 1,
+                 params.get('method'), None if seed in (None, '') else int(seed), params.get('prompt'),
+                 endpoint, json.dumps(params, ensure_ascii=False, sort_keys=True), latency, size))
+
+    def forget(self, paths):
+        """
+        Drop the rows for deleted files.
+        """
+        with self._lock, self._db:
+            self._db.executemany('DELETE FROM images WHERE path = ?', [(str(path),) for path in paths])
+
+    def query(self, scene=None, image=None, method=None, seed=None, since=None, until=None,
+              json_file=None, limit=None):
+        """
+        Rows matching every given filter, newest first. scene/image are 1-based;
+        since/until are Unix timestamps.
+        """
+        clauses, values = [], []
+        for column, value in (('scene_index', scene), ('image_index', image), ('method', method),
+                              ('seed', seed), ('json_file', json_file)):
+            if value is not None:
+                clauses.append(f'{column} = ?')
+                values.append(value)
+        if since is not None:
+            clauses.append('created_at >= ?')
+            values.append(since)
+        if until is not None:
+            clauses.append('created_at <= ?')
+            values.append(until)
+
+        sql = 'SELECT * FROM images'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY created_at DESC'
+        if limit:
+            sql += f' LIMIT {int(limit)}'
+
+        with self._lock:
+            rows = self._db.execute(sql, values).fetchall()
+        return [dict(row) for row in rows]
+
+    def find(self, path):
+        with self._lock:
+            row = self._db.execute('SELECT * FROM images WHERE path = ?', (str(path),)).fetchone()
+        return dict(row) if row else None
+
+    def rebuild(self, output_dir):
+        """
+        Backfill rows for app-named files in output_dir (and its shard directories) that
+        aren't indexed yet. Only what the filename tells us is known for those. Returns the
+        number added.
+        """
+        rows = []
+        for directory, entries in scan_outputs(output_dir):
+            names = {entry.name for entry in entries}
+            for entry in entries:
+                if is_copy(entry.name, names):
+                    continue
+                info = parse_filename(entry.name)
+                if info is None:
+                    continue
+                path = f'{directory}/{entry.name}'
+                params = {'method': info['method'], 'seed': info['seed'], 'backfilled': True}
+                rows.append((path, info['created_at'], info['scene_index'], info['image_index'],
+                             info['method'], info['seed'], json.dumps(params, sort_keys=True), entry.stat().st_size))
+
+        with self._lock, self._db:
+            before = self._db.total_changes
+            self._db.executemany(
+                'INSERT OR IGNORE INTO images (path, created_at, scene_index, image_index, method, seed, params, size) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            return self._db.total_changes - before
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(output_dir='generated_images'):
+    """
+    The index stored as index.db inside output_dir.
+    """
+    with _indexes_lock:
+        if output_dir not in _indexes:
+            _indexes[output_dir] = ImageIndex(os.path.join(output_dir, 'index.db'))
+        return _indexes[output_dir]
+
+
+HASH_BATCH = 64  # saved images hashed together by the background thread
+
+_hash_queue = None
+_hash_queue_lock = threading.Lock()
+
+
+def hash_later(path, output_dir='generated_images'):
+    """
+    Queue a saved image for its perceptual hashes (see similarity.py), computed in batches
+    on a background thread so decoding stays off the request threads. What's still queued
+    when the process exits is hashed first; anything missed is picked up by an update.
+    """
+    global _hash_queue
+    if split_archive_path(path)[0] is not None:
+        return  # archive members are only hashed once extracted
+    with _hash_queue_lock:
+        if _hash_queue is None:
+            _hash_queue = queue.Queue()
+            threading.Thread(target=_hash_worker, args=(_hash_queue,), name='image-hasher', daemon=True).start()
+            atexit.register(_hash_queue.join)
+    _hash_queue.put((output_dir, str(path)))
+
+
+def _hash_worker(pending):
+    while True:
+        batch = [pending.get()]
+        while len(batch) < HASH_BATCH:
+            try:
+                batch.append(pending.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            from similarity import get_hash_index  # loads NumPy, so only once something is saved
+            by_dir = {}
+            for output_dir, path in batch:
+                by_dir.setdefault(output_dir, []).append(path)
+            for output_dir, paths in by_dir.items():
+                for path, error in get_hash_index(output_dir).add_many(paths):
+                    print(f"Warning: couldn't hash {path}: {error}", file=sys.stderr)
+        except Exception as e:
+            print(f"Warning: couldn't hash {len(batch)} images: {e}", file=sys.stderr)
+        finally:
+            for _ in batch:
+                pending.task_done()
+
+
+def record_output(path, request, response, params, output_dir='generated_images'):
+    """
+    Index a saved output and queue it for hashing. params is the job dict (method,
+    reference_image, json_file, scene_index, image_index); the request fields are stored as sent.
+    """
+    fields = request_fields(request)
+    fields['method'] = params.get('method', 'Image Generation')
+    if params.get('reference_image'):
+        fields['reference_image'] = str(params['reference_image'])
+    get_index(output_dir).record(path, fields, json_file=params.get('json_file'),
+                                 scene_index=params.get('scene_index'), image_index=params.get('image_index'),
+                                 endpoint=request['url'], latency=getattr(response, 'latency', None),
+                                 size=getattr(response, 'size', None) or len(response.content))
+    hash_later(path, output_dir)
+
+
+def parse_time(text):
+    return datetime.fromisoformat(text).timestamp() if text else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query or rebuild the generated image index.")
+    parser.add_argument('--output-dir', default='generated_images')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('rebuild', help="Index existing files from their names")
+
+    query = commands.add_parser('query', help="List indexed images")
+    query.add_argument('--scene', type=int)
+    query.add_argument('--image', type=int)
+    query.add_argument('--method')
+    query.add_argument('--seed', type=int)
+    query.add_argument('--json-file')
+    query.add_argument('--since', help="ISO date/time, e.g. 2024-10-01 or 2024-10-01T12:00")
+    query.add_argument('--until', help="ISO date/time")
+    query.add_argument('--limit', type=int)
+    query.add_argument('--json', action='store_true', help="Print full rows as JSON lines")
+
+    args = parser.parse_args(argv)
+    index = get_index(args.output_dir)
+
+    if args.command == 'rebuild':
+        print(f"Indexed {index.rebuild(args.output_dir)} new files")
+        return 0
+
+    rows = index.query(args.scene, args.image, args.method, args.seed,
+                       parse_time(args.since), parse_time(args.until), args.json_file, args.limit)
+    for row in rows:
+        if args.json:
+            print(json.dumps(row, ensure_ascii=False))
+        else:
+            print(f"{row['path']}  {row['method']}  seed={row['seed']}  {row['prompt'] or ''}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
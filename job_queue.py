@@ -0,0 +1,185 @@
+"""
+Background job queue for the GUI.
+
+Jobs run on worker threads so the Tk event loop never blocks on an API call.
+Workers never touch Tk: every status change is put on an event queue that the
+GUI drains with poll() from a root.after() callback.
+
+Queued jobs run by priority (see scheduler.PRIORITIES), so a click goes ahead
+of the rest of a sweep. An express worker only takes interactive jobs, so a
+click starts at once even while every other worker is busy with a sweep.
+"""
+import itertools
+import queue
+import threading
+import time
+
+from scheduler import PRIORITIES
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, job_id, description, target, params=None, priority='batch'):
+        self.id = job_id
+        self.description = description
+        self.target = target  # called as target(job) on a worker thread
+        self.params = params or {}
+        self.priority = priority
+        self.status = 'queued'  # queued, running, done, failed, cancelled
+        self.progress = ''
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._cancel = threading.Event()
+        self._events = None
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def check_cancelled(self):
+        """
+        Called by the job between steps; raises JobCancelled if the job was cancelled.
+        """
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    def set_progress(self, text):
+        self.progress = text
+        if self._events is not None:
+            self._events.put(self)
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed', 'cancelled')
+
+
+class JobQueue:
+    def __init__(self, workers=2, express_workers=1):
+        self._pending = queue.PriorityQueue()  # (priority, id, job)
+        self._express = queue.Queue()  # interactive jobs again, for the express workers
+        self._events = queue.Queue()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.jobs = {}
+        self._threads = []
+        self._express_threads = []
+        for number in range(express_workers):
+            thread = threading.Thread(target=self._work, args=(self._express,), name=f'job-express-{number + 1}',
+                                      daemon=True)
+            thread.start()
+            self._express_threads.append(thread)
+        self.ensure_workers(workers)
+
+    def ensure_workers(self, workers):
+        """
+        Start more worker threads if there are fewer than `workers` (never stops any).
+        """
+        with self._lock:
+            while len(self._threads) < workers:
+                thread = threading.Thread(target=self._work, args=(self._pending,),
+                                          name=f'job-worker-{len(self._threads) + 1}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, description, target, params=None, priority='batch'):
+        job = Job(next(self._ids), description, target, params, priority)
+        job._events = self._events
+        with self._lock:
+            self.jobs[job.id] = job
+        self._pending.put((PRIORITIES[priority], job.id, job))
+        if priority == 'interactive':
+            self._express.put((PRIORITIES[priority], job.id, job))
+        self._events.put(job)
+        return job
+
+    def cancel(self, job_id):
+        """
+        Cancel a queued or running job. A running job stops at its next step; if its
+        API call is already in flight, the response is discarded.
+        """
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.finished:
+                return
+            job.cancel()
+            # Under the lock, so a worker can't claim the job between the check and the change
+            if job.status == 'queued':
+                job.status = 'cancelled'
+                job.finished_at = time.time()
+        self._events.put(job)
+
+    def cancel_all(self):
+        for job_id in list(self.jobs):
+            self.cancel(job_id)
+
+    def stats(self):
+        with self._lock:
+            statuses = [job.status for job in self.jobs.values()]
+        return {status: statuses.count(status) for status in ('queued', 'running', 'done', 'failed', 'cancelled')}
+
+    def poll(self):
+        """
+        Return the jobs that changed since the last call (each at most once).
+        Meant to be called from the UI thread.
+        """
+        changed = {}
+        while True:
+            try:
+                job = self._events.get_nowait()
+            except queue.Empty:
+                break
+            changed[job.id] = job
+        return list(changed.values())
+
+    def _claim(self, job):
+        # An interactive job is on two queues; whichever worker gets it first runs it
+        with self._lock:
+            if job.status != 'queued':
+                return False
+            if job.cancelled:
+                job.status = 'cancelled'
+                job.finished_at = time.time()
+                self._events.put(job)
+                return False
+            job.status = 'running'
+            job.started_at = time.time()
+            return True
+
+    def _work(self, source):
+        while True:
+            _, _, job = source.get()
+            if job is None:
+                break
+            if not self._claim(job):
+                continue
+            self._events.put(job)
+            try:
+                job.result = job.target(job)
+                self._finish(job, 'cancelled' if job.cancelled else 'done')
+            except JobCancelled:
+                self._finish(job, 'cancelled')
+            except Exception as e:
+                job.error = str(e)
+                self._finish(job, 'failed')
+
+    def _finish(self, job, status):
+        with self._lock:
+            job.status = status
+            job.finished_at = time.time()
+        self._events.put(job)
+
+    def shutdown(self):
+        self.cancel_all()
+        for _ in self._threads:
+            self._pending.put((float('inf'), next(self._ids), None))
+        for _ in self._express_threads:
+            self._express.put((float('inf'), next(self._ids), None))
@@ -0,0 +1,212 @@
+"""
+A pool of Stability API keys shared by interactive and batch jobs.
+
+Each key has its own token-bucket rate limit and concurrency cap. A key that
+answers 401 (invalid), 402 (out of credits) or 429 (rate limited) is taken out
+of rotation for a cooldown, and the request moves on to a healthy key.
+
+Keys are read from STABILITY_API_KEYS (comma-separated), or from a file named by
+STABILITY_API_KEYS_FILE / --keys-file with one key per line:
+
+    sk-aaaa...                                  # defaults
+    sk-bbbb... rate=5 burst=20 concurrency=2 name=team-b
+"""
+import os
+import threading
+import time
+
+# Seconds a key sits out after each failure; 429 uses Retry-After when the server sends one
+COOLDOWNS = {401: 300.0, 402: 600.0, 429: 10.0}
+KEY_FAILURE_CODES = set(COOLDOWNS)
+
+# The API allows 150 requests per 10 seconds per account
+DEFAULT_RATE = 15.0
+DEFAULT_BURST = 150
+DEFAULT_CONCURRENCY = 4
+
+
+class NoKeyAvailable(RuntimeError):
+    pass
+
+
+def mask(secret):
+    return f'{secret[:3]}...{secret[-4:]}' if len(secret) > 10 else '***'
+
+
+class ApiKey:
+    def __init__(self, secret, rate=DEFAULT_RATE, burst=DEFAULT_BURST, concurrency=DEFAULT_CONCURRENCY, name=None):
+        self.secret = secret
+        self.name = name or mask(secret)
+        self.rate = rate  # tokens per second
+        self.burst = burst
+        self.concurrency = concurrency
+        self.tokens = float(burst)
+        self.refilled_at = time.monotonic()
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.last_status = None
+        self.requests = 0
+        self.failures = 0
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+
+    def ready_in(self, now):
+        """
+        Seconds until this key can take a request (0 if it can now).
+        """
+        if now < self.cooldown_until:
+            return self.cooldown_until - now
+        if self.in_flight >= self.concurrency:
+            return None  # waits for a release, not for time
+        if self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+        return 0.0
+
+
+class KeyPool:
+    def __init__(self, keys):
+        if not keys:
+            raise ValueError("A key pool needs at least one key")
+        self.keys = list(keys)
+        self._changed = threading.Condition()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def acquire(self, max_wait=120.0):
+        """
+        Take a key for one request, waiting for a token, a free slot or the end of a
+        cooldown. Raises NoKeyAvailable if every key is cooling down for longer than max_wait.
+        """
+        with self._changed:
+            while True:
+                now = time.monotonic()
+                waits = []
+                best = None
+                for key in self.keys:
+                    key.refill(now)
+                    wait = key.ready_in(now)
+                    if wait == 0.0:
+                        # Least loaded first, then the one with the most tokens left
+                        if best is None or (key.in_flight / key.concurrency, -key.tokens) < \
+                                (best.in_flight / best.concurrency, -best.tokens):
+                            best = key
+                    elif wait is not None:
+                        waits.append(wait)
+
+                if best is not None:
+                    best.tokens -= 1
+                    best.in_flight += 1
+                    best.requests += 1
+                    return best
+
+                # Busy keys free up when a request finishes; cooling keys only with time
+                busy = any(key.in_flight >= key.concurrency and now >= key.cooldown_until for key in self.keys)
+                soonest = min(waits) if waits else None
+                if not busy and (soonest is None or soonest > max_wait):
+                    raise NoKeyAvailable(f"No API key available: {self._describe(now)}")
+                self._changed.wait(soonest)
+
+    def release(self, key, status=None, retry_after=None):
+        """
+        Return a key after a request. 401/402/429 put it in cooldown.
+        """
+        with self._changed:
+            key.in_flight -= 1
+            key.last_status = status
+            if status in KEY_FAILURE_CODES:
+                key.failures += 1
+                cooldown = retry_after if status == 429 and retry_after is not None else COOLDOWNS[status]
+                key.cooldown_until = max(key.cooldown_until, time.monotonic() + cooldown)
+            self._changed.notify_all()
+
+    def healthy(self):
+        now = time.monotonic()
+        with self._changed:
+            return sum(1 for key in self.keys if now >= key.cooldown_until)
+
+    def _stats(self, now):
+        return [{'name': key.name, 'requests': key.requests, 'failures': key.failures,
+                 'in_flight': key.in_flight, 'last_status': key.last_status,
+                 'cooldown': round(max(0.0, key.cooldown_until - now), 1)} for key in self.keys]
+
+    def _describe(self, now):
+        parts = []
+        for key in self._stats(now):
+            state = f"cooling {key['cooldown']:.0f}s after {key['last_status']}" if key['cooldown'] else 'ok'
+            parts.append(f"{key['name']} {state}")
+        return ', '.join(parts)
+
+    def stats(self):
+        with self._changed:
+            return self._stats(time.monotonic())
+
+    def describe(self):
+        with self._changed:
+            return self._describe(time.monotonic())
+
+
+def parse_key_line(line):
+    """
+    "sk-... rate=5 burst=20 concurrency=2 name=x" -> ApiKey, or None for blank/comment lines.
+    """
+    line = line.split('#', 1)[0].strip()
+    if not line:
+        return None
+    secret, *options = line.split()
+    settings = {}
+    for option in options:
+        name, _, value = option.partition('=')
+        if name == 'rate':
+            settings[name] = float(value)
+        elif name in ('burst', 'concurrency'):
+            settings[name] = int(value)
+        elif name == 'name':
+            settings[name] = value
+        else:
+            raise ValueError(f"Unknown key option: {option}")
+    return ApiKey(secret, **settings)
+
+
+def load_keys(path=None):
+    """
+    Keys from the file at path, else STABILITY_API_KEYS_FILE, else STABILITY_API_KEYS.
+    Returns an empty list if none are configured.
+    """
+    path = path or os.environ.get('STABILITY_API_KEYS_FILE')
+    if path:
+        with open(path, encoding='utf-8') as file:
+            return [key for key in map(parse_key_line, file) if key is not None]
+    return [ApiKey(secret.strip()) for secret in os.environ.get('STABILITY_API_KEYS', '').split(',') if secret.strip()]
+
+
+_pool = None
+_pool_loaded = False
+_pool_lock = threading.Lock()
+
+
+def get_key_pool():
+    """
+    The shared pool, loaded from the environment on first use; None if no keys are configured.
+    """
+    global _pool, _pool_loaded
+    with _pool_lock:
+        if not _pool_loaded:
+            keys = load_keys()
+            _pool = KeyPool(keys) if keys else None
+            _pool_loaded = True
+        return _pool
+
+
+def configure_key_pool(keys):
+    """
+    Replace the shared pool with these keys (ApiKey objects or plain strings).
+    """
+    global _pool, _pool_loaded
+    with _pool_lock:
+        keys = [key if isinstance(key, ApiKey) else ApiKey(key) for key in keys]
+        _pool = KeyPool(keys) if keys else None
+        _pool_loaded = True
+        return _pool
@@ -0,0 +1,257 @@
+"""
+Timing instrumentation for API calls and output writes.
+
+Each generation runs inside a trace (one per job, per thread). Code along the
+way records phases into the current trace: reference preprocessing, upload,
+server time to first byte, download and disk write. Finished traces go into
+per-endpoint histograms in memory and, optionally, one JSON line each in a
+trace file. The histograms can be written out as a Prometheus text snapshot.
+
+Example:
+    python metrics.py generated_images/metrics/traces.jsonl        # summary table
+    python metrics.py generated_images/metrics/traces.jsonl --prometheus
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.5, 4.0, 6.0, 10.0, 15.0, 30.0, 60.0, float('inf'))
+PHASES = ('reference', 'upload', 'ttfb', 'download', 'write', 'decode', 'total')
+
+_local = threading.local()
+
+
+class Trace:
+    def __init__(self, **fields):
+        self.started = time.perf_counter()
+        self.fields = dict(fields)  # endpoint, status, bytes, retries, cache, ...
+        self.phases = {}
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def as_dict(self):
+        data = dict(self.fields)
+        data['time'] = time.time()
+        data['phases'] = {name: round(seconds, 6) for name, seconds in self.phases.items()}
+        return data
+
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+
+def annotate(**fields):
+    """
+    Add fields (endpoint, status, bytes, retries...) to the current trace, if any.
+    """
+    trace = current_trace()
+    if trace is not None:
+        trace.fields.update(fields)
+
+
+def add_phase(phase, seconds):
+    trace = current_trace()
+    if trace is not None:
+        trace.add(phase, seconds)
+
+
+@contextmanager
+def timed(phase):
+    """
+    Time a block as `phase` of the current trace. Does nothing outside a trace.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase(phase, time.perf_counter() - started)
+
+
+@contextmanager
+def trace(**fields):
+    """
+    Collect one request's timings on this thread and hand them to the recorder at the end.
+    """
+    previous = current_trace()
+    _local.trace = Trace(**fields)
+    try:
+        yield _local.trace
+    finally:
+        finished = _local.trace
+        _local.trace = previous
+        finished.add('total', time.perf_counter() - finished.started)
+        get_recorder().record(finished.as_dict())
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Estimate a quantile by interpolating inside the bucket it falls in.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                low = BUCKETS[i - 1] if i else 0.0
+                high = BUCKETS[i] if BUCKETS[i] != float('inf') else low * 2 or 1.0
+                return low + (high - low) * (rank - seen) / count
+            seen += count
+        return BUCKETS[-2]
+
+
+class Recorder:
+    def __init__(self, trace_path=None):
+        self.trace_path = trace_path
+        self.histograms = {}  # (endpoint, phase) -> Histogram
+        self.statuses = {}  # (endpoint, status) -> count
+        self.bytes = {}  # endpoint -> response bytes
+        self.retries = {}  # endpoint -> retries
+        self._lock = threading.Lock()
+        self._file = None
+
+    def record(self, data):
+        endpoint = data.get('endpoint') or 'none'
+        with self._lock:
+            for phase, seconds in data['phases'].items():
+                self.histograms.setdefault((endpoint, phase), Histogram()).observe(seconds)
+            if 'status' in data:
+                key = (endpoint, data['status'])
+                self.statuses[key] = self.statuses.get(key, 0) + 1
+            if 'bytes' in data:
+                self.bytes[endpoint] = self.bytes.get(endpoint, 0) + data['bytes']
+            if 'retries' in data:
+                self.retries[endpoint] = self.retries.get(endpoint, 0) + data['retries']
+
+            if self.trace_path:
+                if self._file is None:
+                    os.makedirs(os.path.dirname(self.trace_path) or '.', exist_ok=True)
+                    self._file = open(self.trace_path, 'a', encoding='utf-8')
+                self._file.write(json.dumps(data, ensure_ascii=False) + '\n')
+                self._file.flush()
+
+    def summary(self):
+        """
+        One line for the status bar: median total and time to first byte per endpoint.
+        """
+        parts = []
+        with self._lock:
+            for (endpoint, phase), histogram in sorted(self.histograms.items()):
+                if phase != 'total' or endpoint == 'none':
+                    continue
+                ttfb = self.histograms.get((endpoint, 'ttfb'))
+                text = f"{endpoint} p50 {histogram.quantile(0.5):.1f}s"
+                if ttfb and ttfb.count:
+                    text += f" (server {ttfb.quantile(0.5):.1f}s)"
+                parts.append(f"{text} x{histogram.count}")
+        return ' · '.join(parts)
+
+    def prometheus(self):
+        """
+        The current histograms and counters in Prometheus text exposition format.
+        """
+        lines = ['# HELP stablecanvas_phase_seconds Time spent in each phase of a generation.',
+                 '# TYPE stablecanvas_phase_seconds histogram']
+        with self._lock:
+            for (endpoint, phase), histogram in sorted(self.histograms.items()):
+                labels = f'endpoint="{endpoint}",phase="{phase}"'
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                    lines.append(f'stablecanvas_phase_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+                lines.append(f'stablecanvas_phase_seconds_sum{{{labels}}} {histogram.total:.6f}')
+                lines.append(f'stablecanvas_phase_seconds_count{{{labels}}} {histogram.count}')
+
+            lines += ['# HELP stablecanvas_responses_total Responses by endpoint and status code.',
+                      '# TYPE stablecanvas_responses_total counter']
+            for (endpoint, status), count in sorted(self.statuses.items(), key=str):
+                lines.append(f'stablecanvas_responses_total{{endpoint="{endpoint}",status="{status}"}} {count}')
+
+            lines += ['# HELP stablecanvas_response_bytes_total Response bytes received.',
+                      '# TYPE stablecanvas_response_bytes_total counter']
+            for endpoint, total in sorted(self.bytes.items()):
+                lines.append(f'stablecanvas_response_bytes_total{{endpoint="{endpoint}"}} {total}')
+
+            lines += ['# HELP stablecanvas_retries_total Retried requests.',
+                      '# TYPE stablecanvas_retries_total counter']
+            for endpoint, total in sorted(self.retries.items()):
+                lines.append(f'stablecanvas_retries_total{{endpoint="{endpoint}"}} {total}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            file.write(self.prometheus())
+        os.replace(temp_path, path)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+_recorder = Recorder()
+
+
+def get_recorder():
+    return _recorder
+
+
+def configure_recorder(trace_path=None):
+    """
+    Start a fresh recorder, writing one JSON line per trace to trace_path if given.
+    """
+    global _recorder
+    _recorder.close()
+    _recorder = Recorder(trace_path)
+    return _recorder
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarize a JSONL trace file.")
+    parser.add_argument('trace_file')
+    parser.add_argument('--prometheus', action='store_true', help="Print a Prometheus text snapshot instead")
+    args = parser.parse_args(argv)
+
+    recorder = Recorder()
+    with open(args.trace_file, encoding='utf-8') as file:
+        for line in file:
+            if line.strip():
+                recorder.record(json.loads(line))
+
+    if args.prometheus:
+        sys.stdout.write(recorder.prometheus())
+        return 0
+
+    print(f"{'endpoint':<12}{'phase':<11}{'count':>7}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for (endpoint, phase), histogram in sorted(recorder.histograms.items()):
+        print(f"{endpoint:<12}{phase:<11}{histogram.count:>7}"
+              + ''.join(f"{histogram.quantile(q):>8.3f}s" for q in (0.5, 0.95, 0.99)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,281 @@
+"""
+Local stand-in for the four Stability AI endpoints the app uses.
+
+It checks the multipart fields each generate_* function sends and answers
+with real PNG bytes after a configurable delay. It can also inject 429 and
+5xx errors (with Retry-After) to exercise the retry logic.
+
+Example:
+    python mock_server.py --port 8123 --latency lognormal:-0.5,0.4 --rate-429 0.05 --rate-500 0.02
+    STABILITY_API_BASE=http://127.0.0.1:8123 python batch_render.py story.json --api-key test
+"""
+import argparse
+import json
+import math
+import random
+import struct
+import sys
+import threading
+import time
+import zlib
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Path -> (required fields, allowed fields), matching what stability_api.build_*_request sends
+ENDPOINTS = {
+    '/v2beta/stable-image/generate/core': (
+        {'prompt'},
+        {'prompt', 'negative_prompt', 'output_format', 'size', 'seed', 'aspect_ratio'}),
+    '/v2beta/stable-image/generate/ultra': (
+        {'prompt', 'image', 'strength'},
+        {'prompt', 'image', 'strength', 'output_format', 'aspect_ratio', 'seed', 'negative_prompt'}),
+    '/v2beta/stable-image/control/structure': (
+        {'prompt', 'image'},
+        {'prompt', 'image', 'negative_prompt', 'output_format', 'size', 'control_strength', 'seed'}),
+    '/v2beta/stable-image/edit/outpaint': (
+        {'image'},
+        {'image', 'left', 'right', 'up', 'down', 'prompt', 'seed', 'output_format', 'creativity'}),
+}
+FLOAT_FIELDS = {'strength': (0, 1), 'control_strength': (0, 1), 'creativity': (0, 1)}
+INT_FIELDS = {'seed': (0, 4294967294), 'left': (0, 2000), 'right': (0, 2000), 'up': (0, 2000), 'down': (0, 2000)}
+IMAGE_TYPES = {'image/png', 'image/jpeg', 'image/webp'}
+
+
+def make_png(width, height, rgb):
+    """
+    A valid, solid-color RGB PNG built with zlib only.
+    """
+    def chunk(kind, payload):
+        return struct.pack('>I', len(payload)) + kind + payload + struct.pack('>I', zlib.crc32(kind + payload) & 0xffffffff)
+
+    row = b'\x00' + bytes(rgb) * width
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(row * height, 6))
+            + chunk(b'IEND', b''))
+
+
+def parse_latency(spec):
+    """
+    Turn a latency spec into a function returning seconds:
+    fixed:0.5, uniform:0.2,1.5, normal:1.0,0.2 or lognormal:mu,sigma (of ln seconds).
+    """
+    kind, _, args = spec.partition(':')
+    values = [float(v) for v in args.split(',') if v] if args else []
+    if kind == 'fixed':
+        return lambda: values[0] if values else 0.0
+    if kind == 'uniform':
+        return lambda: random.uniform(values[0], values[1])
+    if kind == 'normal':
+        return lambda: max(0.0, random.gauss(values[0], values[1]))
+    if kind == 'lognormal':
+        return lambda: math.exp(random.gauss(values[0], values[1]))
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def parse_multipart(content_type, body):
+    """
+    Multipart form fields as {name: (value, filename, content_type)}; value is bytes for files.
+    """
+    message = BytesParser(policy=HTTP).parsebytes(
+        b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + body)
+    if not message.is_multipart():
+        raise ValueError("Expected multipart/form-data")
+
+    fields = {}
+    for part in message.iter_parts():
+        name = part.get_param('name', header='content-disposition')
+        filename = part.get_filename()
+        payload = part.get_payload(decode=True) or b''
+        if filename is None:
+            payload = payload.decode('utf-8')
+        fields[name] = (payload, filename, part.get_content_type())
+    return fields
+
+
+def validate(path, headers, fields):
+    """
+    Return an error message for a request the real API would reject, or None.
+    """
+    if not headers.get('Authorization', '').startswith('Bearer ') or len(headers['Authorization']) <= 7:
+        return 'missing or malformed Authorization header'
+    if 'image/' not in headers.get('Accept', '') and headers.get('Accept') != '*/*':
+        return f"Accept must ask for images, got {headers.get('Accept')!r}"
+
+    required, allowed = ENDPOINTS[path]
+    missing = required - set(fields)
+    if missing:
+        return f"missing fields: {sorted(missing)}"
+    unknown = set(fields) - allowed
+    if unknown:
+        return f"unexpected fields: {sorted(unknown)}"
+
+    for name, (low, high) in FLOAT_FIELDS.items():
+        if name in fields:
+            try:
+                value = float(fields[name][0])
+            except ValueError:
+                return f"{name} must be a number"
+            if not low <= value <= high:
+                return f"{name} must be between {low} and {high}"
+    for name, (low, high) in INT_FIELDS.items():
+        if name in fields and fields[name][0] != '':
+            try:
+                value = int(fields[name][0])
+            except ValueError:
+                return f"{name} must be an integer"
+            if not low <= value <= high:
+                return f"{name} must be between {low} and {high}"
+
+    if 'image' in fields:
+        content, filename, content_type = fields['image']
+        if filename is None or not content:
+            return 'image must be an uploaded file'
+        if content_type not in IMAGE_TYPES:
+            return f"unsupported image type {content_type}"
+    if 'output_format' in fields and fields['output_format'][0] not in ('png', 'jpeg', 'webp'):
+        return 'output_format must be png, jpeg or webp'
+    return None
+
+
+class MockConfig:
+    def __init__(self, latency='fixed:0', rate_429=0.0, rate_500=0.0, retry_after=1, image_size=1024,
+                 exhausted_keys=()):
+        self.latency = parse_latency(latency) if isinstance(latency, str) else latency
+        self.exhausted_keys = set(exhausted_keys)  # answered with 402, as if out of credits
+        self.rate_429 = rate_429
+        self.rate_500 = rate_500
+        self.retry_after = retry_after
+        self.image_size = image_size
+        self.stats = {'requests': 0, 'ok': 0, 'rejected': 0, '402': 0, '429': 0, '5xx': 0}
+        self._lock = threading.Lock()
+        self._images = {}
+
+    def count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def image(self, seed):
+        # A handful of colors, each encoded once
+        key = seed % 8
+        with self._lock:
+            if key not in self._images:
+                rgb = ((key * 97) % 256, (key * 57 + 80) % 256, (key * 31 + 160) % 256)
+                self._images[key] = make_png(self.image_size, self.image_size, rgb)
+            return self._images[key]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real API
+    config = None  # set by make_server
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, extra_headers=None):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (extra_headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        config = self.config
+        config.count('requests')
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        if self.path not in ENDPOINTS:
+            self.send_json(404, {'name': 'not_found', 'errors': [f'no endpoint {self.path}']})
+            return
+
+        try:
+            fields = parse_multipart(self.headers.get('Content-Type', ''), body)
+        except ValueError as e:
+            config.count('rejected')
+            self.send_json(400, {'name': 'bad_request', 'errors': [str(e)]})
+            return
+
+        error = validate(self.path, self.headers, fields)
+        if error:
+            config.count('rejected')
+            self.send_json(400, {'name': 'bad_request', 'errors': [error]})
+            return
+
+        if self.headers['Authorization'][7:] in config.exhausted_keys:
+            config.count('402')
+            self.send_json(402, {'name': 'payment_required', 'errors': ['insufficient credits']})
+            return
+
+        time.sleep(config.latency())
+
+        roll = random.random()
+        if roll < config.rate_429:
+            config.count('429')
+            self.send_json(429, {'name': 'rate_limit_exceeded', 'errors': ['slow down']},
+                           {'Retry-After': str(config.retry_after)})
+            return
+        if roll < config.rate_429 + config.rate_500:
+            config.count('5xx')
+            self.send_json(random.choice([500, 502, 503]), {'name': 'server_error', 'errors': ['injected failure']})
+            return
+
+        seed = fields.get('seed', ('0',))[0]
+        content = config.image(int(seed) if seed else 0)
+        config.count('ok')
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('finish-reason', 'SUCCESS')
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def make_server(host='127.0.0.1', port=0, config=None):
+    handler = type('ConfiguredMockHandler', (MockHandler,), {'config': config or MockConfig()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def start_server(config=None, host='127.0.0.1', port=0):
+    """
+    Start the mock server on a background thread. Returns (server, base_url);
+    call server.shutdown() to stop it.
+    """
+    server = make_server(host, port, config)
+    thread = threading.Thread(target=server.serve_forever, name='mock-stability-api', daemon=True)
+    thread.start()
+    return server, f'http://{host}:{server.server_port}'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a local mock of the Stability AI endpoints.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8123)
+    parser.add_argument('--latency', default='fixed:0.5',
+                        help="fixed:S, uniform:MIN,MAX, normal:MEAN,SD or lognormal:MU,SIGMA")
+    parser.add_argument('--rate-429', type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument('--rate-500', type=float, default=0.0, help="Fraction answered with 500/502/503")
+    parser.add_argument('--retry-after', type=int, default=1, help="Retry-After seconds sent with 429s")
+    parser.add_argument('--image-size', type=int, default=1024)
+    parser.add_argument('--exhausted-keys', default='', help="Comma-separated API keys answered with 402")
+    args = parser.parse_args(argv)
+
+    config = MockConfig(args.latency, args.rate_429, args.rate_500, args.retry_after, args.image_size,
+                        [key for key in args.exhausted_keys.split(',') if key])
+    server = make_server(args.host, args.port, config)
+    print(f"Mock Stability API on http://{args.host}:{server.server_port} (STABILITY_API_BASE)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(config.stats))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
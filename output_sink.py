@@ -0,0 +1,429 @@
+"""
+Where saved outputs go.
+
+Every output is written to a hidden temporary file next to its final name,
+flushed to disk, checked, and only then renamed into place. A crash or a full
+disk never leaves half a PNG under an app name. A response is only saved if its
+Content-Type says image and its first bytes are the signature of the format
+it's named as (an HTML error page served with a 200 is rejected, not saved as
+scene_1_image_1_....png). With the result cache off, a generated image is
+copied from the connection to the temporary file a chunk at a time as it
+downloads, and checked on its first chunk, so it is never held in memory whole.
+
+Layouts (--layout, or STABLECANVAS_LAYOUT for the GUI):
+
+    flat      generated_images/scene_1_image_2_....png (as before)
+    json      generated_images/story/scene_1_image_2_....png, one directory per JSON file
+    scene     generated_images/story/scene_1/..., per JSON file and scene
+    date      generated_images/2026/10/18/..., per day
+
+With hundreds of thousands of outputs in one directory every listing gets slow;
+the sharded layouts keep each directory small. The gallery, the image index and
+the hash index look through the shard directories too.
+
+For bulk runs, --archive out.tar appends every output to one tar (or .zip) file
+instead, with a line per member in out.tar.index.jsonl giving where its bytes
+start, so read_member() can fetch one image without scanning the archive. A tar
+keeps everything up to the last whole member if the run dies (the torn tail is
+cut off when it's opened again); a zip is only readable once the run closes it.
+
+Example:
+    python batch_render.py story.json --layout scene
+    python batch_render.py story.json --archive generated_images/story.tar
+"""
+import io
+import json
+import os
+import tarfile
+import threading
+import time
+import zipfile
+from datetime import datetime
+from pathlib import Path
+
+import metrics
+
+LAYOUTS = ('flat', 'json', 'scene', 'date')
+ARCHIVE_SUFFIXES = ('.tar', '.zip')
+
+# First bytes of each output format
+SIGNATURES = {
+    '.png': (b'\x89PNG\r\n\x1a\n',),
+    '.jpg': (b'\xff\xd8\xff',),
+    '.jpeg': (b'\xff\xd8\xff',),
+    '.webp': (b'RIFF',),
+}
+CHUNK_SIZE = 1024 * 1024
+
+
+def check_content_type(content_type):
+    """
+    Raises ValueError unless the response's Content-Type is an image type.
+    """
+    if content_type is not None and 'image' not in content_type:
+        raise ValueError(f"Unexpected response type: {content_type or 'none'}")
+
+
+def check_signature(head, suffix):
+    """
+    Raises ValueError unless head (the first bytes of a file) matches the format named by suffix.
+    """
+    signatures = SIGNATURES.get(suffix.lower())
+    if signatures and not any(head.startswith(signature) for signature in signatures):
+        raise ValueError(f"Response is not a {suffix.lstrip('.').upper()} image (starts with {bytes(head[:8])!r})")
+
+
+def write_chunks(file, chunks, suffix):
+    """
+    Copy an iterable of byte chunks (e.g. a response body as it downloads) to file,
+    checking the first bytes against the format named by suffix before writing on.
+    Returns the number of bytes written.
+    """
+    head = b''
+    size = 0
+    checked = False
+    for chunk in chunks:
+        if not checked:
+            head += chunk
+            if len(head) < 16:
+                continue  # too short to tell yet
+            check_signature(head, suffix)
+            checked = True
+            chunk, head = head, b''
+        file.write(chunk)
+        size += len(chunk)
+    if not checked:
+        check_signature(head, suffix)
+        file.write(head)
+        size += len(head)
+    return size
+
+
+def _write(file, content):
+    if callable(content):
+        content(file)
+        return
+    view = memoryview(content)
+    for start in range(0, len(view), CHUNK_SIZE):
+        file.write(view[start:start + CHUNK_SIZE])
+
+
+def _publish(temp_path, path):
+    """
+    Give the finished temp file its final name, atomically, unless that name is taken
+    (FileExistsError).
+    """
+    if os.name == 'nt':
+        os.rename(temp_path, path)  # never replaces on Windows
+        return
+    try:
+        os.link(temp_path, path)  # fails if path exists, unlike rename
+    except FileExistsError:
+        raise
+    except OSError:
+        # Filesystem without hard links: a small window where two writers could race
+        if os.path.lexists(path):
+            raise FileExistsError(path)
+        os.replace(temp_path, path)
+        return
+    os.unlink(temp_path)
+
+
+def write_atomic(filename, content, content_type=None):
+    """
+    Write content (bytes, or a function that writes to the open file) under filename
+    without overwriting anything: if the name is taken a counter is added, e.g.
+    ..._12-00-01_2.png. Nothing appears under the name until the file is complete and
+    checked. Returns the name actually used; raises ValueError for a non-image.
+    """
+    check_content_type(content_type)
+    directory, name = os.path.split(filename)
+    temp_path = os.path.join(directory, f'.{name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    stem, suffix = os.path.splitext(filename)
+    try:
+        with metrics.timed('write'):
+            with open(temp_path, 'w+b') as file:
+                _write(file, content)
+                file.flush()
+                os.fsync(file.fileno())
+                file.seek(0)
+                check_signature(file.read(16), suffix)
+
+            candidate = filename
+            counter = 1
+            while True:
+                try:
+                    _publish(temp_path, candidate)
+                    return candidate
+                except FileExistsError:
+                    counter += 1
+                    candidate = f"{stem}_{counter}{suffix}"
+    finally:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+
+
+def shard(params, layout, when=None):
+    """
+    Subdirectory (with '/' separators, '' for none) an output goes in under a layout.
+    """
+    params = params or {}
+    if layout == 'date':
+        return (when or datetime.now()).strftime('%Y/%m/%d')
+    if layout in ('json', 'scene'):
+        parts = [Path(params['json_file']).stem] if params.get('json_file') else []
+        if layout == 'scene' and params.get('scene_index') is not None:
+            parts.append(f"scene_{params['scene_index'] + 1}")
+        return '/'.join(parts)
+    return ''
+
+
+class DirectorySink:
+    def __init__(self, layout='flat'):
+        if layout not in LAYOUTS:
+            raise ValueError(f"Unknown layout: {layout} (use {', '.join(LAYOUTS)})")
+        self.layout = layout
+
+    def path_for(self, filename, params=None):
+        """
+        Where filename (output_dir/name, as from make_filename) goes under this layout.
+        """
+        subdirectory = shard(params, self.layout)
+        if not subdirectory:
+            return filename
+        directory, name = os.path.split(filename)
+        return f'{directory}/{subdirectory}/{name}' if directory else f'{subdirectory}/{name}'
+
+    def save(self, filename, content, params=None, content_type=None):
+        path = self.path_for(filename, params)
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        return write_atomic(path, content, content_type)
+
+    def close(self):
+        pass
+
+
+def _padded(size):
+    return -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+
+class ArchiveSink:
+    """
+    Appends outputs to one .tar or .zip file. save() returns "<archive>/<member>",
+    which output_exists() and read_output() understand.
+    """
+    def __init__(self, path, layout='flat'):
+        self.path = str(path)
+        self.kind = 'zip' if self.path.lower().endswith('.zip') else 'tar'
+        self.index_path = f'{self.path}.index.jsonl'
+        self.layout = layout
+        self._lock = threading.Lock()
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        _trim_index(self.index_path)
+        members = load_archive_index(self.path)
+        self.names = set(members)
+        self._file = None
+        exists = os.path.exists(self.path) and os.path.getsize(self.path) > 0
+        if self.kind == 'zip':
+            self._archive = zipfile.ZipFile(self.path, 'a', compression=zipfile.ZIP_STORED)
+        elif exists and not members:
+            self._archive = tarfile.open(self.path, 'a', format=tarfile.PAX_FORMAT)  # no index: scan it
+        else:
+            # Carry on right after the last indexed member. That drops the end-of-archive
+            # blocks of a closed run, or a member torn by a crash, without reading the headers.
+            end = max((entry['offset'] + _padded(entry['size']) for entry in members.values()), default=0)
+            self._file = open(self.path, 'r+b' if exists else 'w+b')
+            self._file.seek(end)
+            self._file.truncate()
+            self._archive = tarfile.open(fileobj=self._file, mode='w', format=tarfile.PAX_FORMAT)
+        self._index = open(self.index_path, 'a', encoding='utf-8')
+
+    def save(self, filename, content, params=None, content_type=None):
+        check_content_type(content_type)
+        if callable(content):
+            buffer = io.BytesIO()
+            content(buffer)
+            content = buffer.getvalue()
+        check_signature(content[:16], os.path.splitext(filename)[1])
+
+        name = os.path.basename(filename)
+        subdirectory = shard(params, self.layout)
+        if subdirectory:
+            name = f'{subdirectory}/{name}'
+        with metrics.timed('write'), self._lock:
+            stem, suffix = os.path.splitext(name)
+            counter = 1
+            while name in self.names:
+                counter += 1
+                name = f'{stem}_{counter}{suffix}'
+            offset = self._append(name, content)
+            self.names.add(name)
+            entry = {'name': name, 'offset': offset, 'size': len(content), 'time': round(time.time(), 3)}
+            for field in ('json_file', 'scene_index', 'image_index'):
+                if (params or {}).get(field) is not None:
+                    entry[field] = params[field]
+            self._index.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self._index.flush()
+        return f'{self.path}/{name}'
+
+    def _append(self, name, content):
+        """
+        Add one member and flush it to disk. Returns the offset of its data in the archive.
+        """
+        if self.kind == 'tar':
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mtime = time.time()
+            self._archive.addfile(info, io.BytesIO(content))
+            fileobj = self._archive.fileobj
+            offset = self._archive.offset - _padded(len(content))
+        else:
+            info = zipfile.ZipInfo(name, time.localtime()[:6])
+            self._archive.writestr(info, content)
+            fileobj = self._archive.fp
+            # Stored uncompressed (PNGs are compressed already), right after the local header
+            offset = info.header_offset + 30 + len(info.filename.encode('utf-8')) + len(info.extra)
+        fileobj.flush()
+        os.fsync(fileobj.fileno())
+        return offset
+
+    def close(self):
+        with self._lock:
+            if self._archive is not None:
+                self._archive.close()
+                self._archive = None
+                self._index.close()
+                if self._file is not None:
+                    self._file.close()
+
+
+def _trim_index(index_path):
+    # Drop a line torn by a crash, so the next entry starts on a line of its own
+    try:
+        with open(index_path, 'r+b') as file:
+            content = file.read()
+            if content and not content.endswith(b'\n'):
+                file.truncate(content.rfind(b'\n') + 1)
+    except FileNotFoundError:
+        pass
+
+
+def load_archive_index(archive_path):
+    """
+    Member name -> {'name', 'offset', 'size', ...} from an archive's index file.
+    """
+    members = {}
+    try:
+        with open(f'{archive_path}.index.jsonl', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # torn last line from a crash
+                members[entry['name']] = entry
+    except FileNotFoundError:
+        pass
+    return members
+
+
+def split_archive_path(path):
+    """
+    (archive, member) for a path returned by ArchiveSink.save, else (None, None).
+    """
+    path = str(path).replace('\\', '/')
+    for suffix in ARCHIVE_SUFFIXES:
+        position = path.lower().find(suffix + '/')
+        if position >= 0:
+            end = position + len(suffix)
+            return path[:end], path[end + 1:]
+    return None, None
+
+
+def read_member(archive_path, name):
+    """
+    The bytes of one archive member, read straight from the offset in the index.
+    """
+    entry = load_archive_index(archive_path).get(name)
+    if entry is None:
+        raise FileNotFoundError(f"{name} is not in {archive_path}")
+    with open(archive_path, 'rb') as file:
+        file.seek(entry['offset'])
+        content = file.read(entry['size'])
+    if len(content) != entry['size']:
+        raise OSError(f"{archive_path} is truncated")
+    return content
+
+
+def read_output(path):
+    """
+    The bytes of a saved output, on disk or in an archive.
+    """
+    archive, member = split_archive_path(path)
+    if archive is not None and not os.path.exists(path):
+        return read_member(archive, member)
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+def output_exists(path):
+    """
+    os.path.exists for saved outputs, including members of an archive.
+    """
+    if os.path.exists(path):
+        return True
+    archive, member = split_archive_path(path)
+    return archive is not None and member in load_archive_index(archive)
+
+
+def scan_outputs(output_dir):
+    """
+    (directory, file entries) for output_dir and each shard directory under it, skipping
+    dot directories (.cache, .thumbs, .runs). directory is joined with '/' like saved paths.
+    """
+    pending = [str(output_dir)]
+    while pending:
+        directory = pending.pop()
+        try:
+            with os.scandir(directory) as entries:
+                entries = list(entries)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        files = []
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir():
+                pending.append(f'{directory}/{entry.name}')
+            elif entry.is_file():
+                files.append(entry)
+        yield directory, files
+
+
+_sink = None
+_sink_lock = threading.Lock()
+
+
+def get_sink():
+    """
+    The sink save_output writes through. Set STABLECANVAS_LAYOUT to shard outputs.
+    """
+    global _sink
+    with _sink_lock:
+        if _sink is None:
+            _sink = DirectorySink(os.environ.get('STABLECANVAS_LAYOUT') or 'flat')
+        return _sink
+
+
+def configure_sink(layout='flat', archive=None):
+    """
+    Send outputs to layout, or into the archive file if one is given. Closes the previous sink.
+    """
+    global _sink
+    sink = ArchiveSink(archive, layout) if archive else DirectorySink(layout)
+    with _sink_lock:
+        if _sink is not None:
+            _sink.close()
+        _sink = sink
+        return _sink
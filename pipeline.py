@@ -0,0 +1,261 @@
+"""
+Multi-stage pipelines: text-to-image, then a structure or image-to-image pass,
+then an outpaint, chained per frame.
+
+A pipeline is a list of stages, each a method plus the params it overrides:
+
+    {"stages": [
+        {"method": "Image Generation"},
+        {"method": "Image with Structure", "control_strength": 0.6},
+        {"method": "Outpaint", "left": 512, "right": 512}
+    ]}
+
+Each stage's response bytes are the next stage's upload, without touching
+disk. Only the final image is saved, plus any stage marked "save": true (or
+every stage with --save-intermediate). Frames run concurrently, so stage 2 of
+one frame overlaps with stage 1 of the next. A scene in the storyboard can
+carry its own "pipeline" to override the default one.
+
+Example:
+    python pipeline.py story.json --pipeline widescreen.json --concurrency 6
+"""
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+import metrics
+from batch_render import (build_parser, configure_budget, configure_output, parse_range, print_dedup, print_forecast,
+                          print_spend, render_jobs, settings_from_args, tally)
+from engine import collect_jobs, load_scenes
+from http_client import configure_client
+from image_index import record_output
+from key_pool import configure_key_pool, get_key_pool, load_keys
+from postprocess import PostProcessor, parse_steps
+from result_cache import configure_cache
+from run_journal import RunJournal, run_path
+from scheduler import BudgetExceeded
+from stability_api import METHODS, build_request, make_filename, post_request, save_output
+
+STAGE_FIELDS = {'method', 'prompt', 'negative_prompt', 'seed', 'image_strength', 'control_strength',
+                'left', 'right', 'up', 'down', 'save'}
+
+
+def load_pipeline(source):
+    """
+    Stages from a JSON file path, a {"stages": [...]} dict or a list. Raises ValueError if invalid.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'r', encoding='utf-8') as file:
+            source = json.load(file)
+    stages = source.get('stages') if isinstance(source, dict) else source
+    check_pipeline(stages)
+    return stages
+
+
+def check_pipeline(stages):
+    if not isinstance(stages, list) or not stages:
+        raise ValueError("A pipeline needs a non-empty list of stages.")
+    for number, stage in enumerate(stages, 1):
+        if not isinstance(stage, dict) or stage.get('method') not in METHODS:
+            raise ValueError(f"Stage {number}: method must be one of {', '.join(METHODS)}")
+        unknown = set(stage) - STAGE_FIELDS
+        if unknown:
+            raise ValueError(f"Stage {number}: unknown fields {', '.join(sorted(unknown))}")
+        if number > 1 and stage['method'] == 'Image Generation':
+            raise ValueError(f"Stage {number}: Image Generation can only be the first stage")
+
+
+def describe_pipeline(stages):
+    return ' -> '.join(stage['method'] for stage in stages)
+
+
+def render_pipeline_job(api_key, job, output_dir, timeout=None, before_stage=None, save_intermediate=False):
+    """
+    Run job['pipeline'] for one frame, handing each response to the next stage in memory.
+    before_stage(number, stage) is called before each request (the GUI uses it for progress
+    and cancellation). Returns a result dict like batch_render.render_job, with the final
+    image as 'filename' and every saved file in 'saved'; never raises.
+    """
+    started = time.perf_counter()
+    stages = job['pipeline']
+    result = {'scene_index': job['scene_index'], 'image_index': job['image_index'],
+              'filename': None, 'saved': [], 'error': None, 'retries': 0}
+    previous = None
+    for number, stage in enumerate(stages, 1):
+        if before_stage is not None:
+            before_stage(number, stage)
+        params = dict(job, **{name: value for name, value in stage.items() if name != 'save'})
+        params.pop('pipeline')
+        params['pipeline_stage'] = number
+        if previous is not None:
+            params['reference_bytes'] = previous
+            params['reference_image'] = None
+
+        with metrics.trace(method=params['method'], stage=number, scene_index=job['scene_index'],
+                           image_index=job['image_index']):
+            try:
+                request = build_request(api_key, params)
+                response = post_request(request, timeout=timeout)
+                result['retries'] += getattr(response, 'retries', 0)
+                if response.status_code != 200:
+                    raise RuntimeError(f"Error {response.status_code}: {response.text}")
+                if 'image' not in response.headers.get('Content-Type', ''):
+                    raise RuntimeError(f"Unexpected response type: {response.headers.get('Content-Type', '')}")
+
+                if number == len(stages) or stage.get('save') or save_intermediate:
+                    filename = make_filename(output_dir, '.png', params['method'], job['scene_index'],
+                                             job['image_index'], params.get('seed', 0))
+                    filename = save_output(filename, response.content, params,
+                                           response.headers.get('Content-Type', ''))
+                    record_output(filename, request, response, params, output_dir)
+                    result['saved'].append(filename)
+                    result['filename'] = filename
+            except Exception as e:
+                metrics.annotate(error=str(e))
+                result['error'] = f"stage {number} ({stage['method']}): {e}"
+                result['filename'] = None
+                if isinstance(e, BudgetExceeded):
+                    result['deferred'] = True
+                break
+        previous = response.content
+
+    result['elapsed'] = time.perf_counter() - started
+    return result
+
+
+def collect_pipeline_jobs(scenes, settings, pipeline, scene_range=None, image_range=None, base_dir='.'):
+    """
+    batch_render.collect_jobs, with each job carrying its scene's pipeline (or the default one).
+    """
+    jobs = collect_jobs(scenes, settings, scene_range, image_range, base_dir)
+    for job in jobs:
+        stages = scenes[job['scene_index']].get('pipeline', pipeline)
+        if stages is None:
+            raise ValueError(f"Scene {job['scene_index'] + 1} has no pipeline and no default was given.")
+        stages = stages.get('stages') if isinstance(stages, dict) else stages
+        check_pipeline(stages)
+        if stages[0]['method'] != 'Image Generation' and not job.get('reference_image'):
+            raise ValueError(f"Scene {job['scene_index'] + 1}: the first stage needs a reference image.")
+        job['pipeline'] = stages
+    return jobs
+
+
+def run_pipelines(api_key, json_path, pipeline=None, settings=None, scene_range=None, image_range=None,
+                  output_dir='generated_images', concurrency=4, timeout=None, progress=None,
+                  save_intermediate=False, resume=True, post=None, credit_run=None, scene_jobs=None):
+    """
+    Run the pipeline for every frame of a scene JSON file. Returns results in storyboard order.
+    scene_jobs is what pipeline_file_jobs() returned for the same arguments, if the caller
+    already has it, so the file isn't parsed again.
+    """
+    jobs, journal_path = scene_jobs or pipeline_file_jobs(json_path, pipeline, settings, scene_range, image_range,
+                                                          output_dir)
+
+    def render(api_key, job, output_dir, timeout):
+        return render_pipeline_job(api_key, job, output_dir, timeout, save_intermediate=save_intermediate)
+
+    if not resume and os.path.exists(journal_path):
+        os.remove(journal_path)
+    journal = RunJournal(journal_path)
+    try:
+        return render_jobs(api_key, jobs, output_dir, concurrency, timeout, progress, journal, render, post,
+                           credit_run)
+    finally:
+        journal.close()
+
+
+def pipeline_file_jobs(json_path, pipeline=None, settings=None, scene_range=None, image_range=None,
+                       output_dir='generated_images'):
+    """
+    The pipeline jobs for a scene JSON file, and the path of the run journal they're tracked in.
+    """
+    scenes = load_scenes(json_path)
+    settings = dict(settings or {}, json_file=str(json_path))
+    jobs = collect_pipeline_jobs(scenes, settings, pipeline, scene_range, image_range, Path(json_path).parent)
+    return jobs, run_path(output_dir, os.path.abspath(json_path), dict(settings, pipeline=pipeline))
+
+
+def main(argv=None):
+    parser = build_parser()
+    parser.description = "Run a multi-stage pipeline for every image of a scene JSON file."
+    parser.add_argument('--pipeline', help="Pipeline JSON file (scenes may also carry their own \"pipeline\")")
+    parser.add_argument('--save-intermediate', action='store_true', help="Save every stage's output, not just the last")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.keys_file:
+            configure_key_pool(load_keys(args.keys_file))
+            args.api_key = None
+        elif not args.api_key and get_key_pool() is None and not args.forecast:
+            print("API key is required (--api-key, STABILITY_API_KEY, --keys-file or STABILITY_API_KEYS).", file=sys.stderr)
+            return 2
+        pipeline = load_pipeline(args.pipeline) if args.pipeline else None
+        post_steps = parse_steps(args.post) if args.post else None
+        credit_run = configure_budget(args, Path(args.json_file).stem)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+
+    # Every frame can have a request in flight on each endpoint at once
+    configure_client(max_in_flight=args.concurrency, max_retries=args.max_retries,
+                     pool_size=max(32, args.concurrency), timeout=args.timeout)
+    configure_cache(cache_dir=os.path.join(args.output_dir, '.cache'),
+                    max_bytes=args.cache_size * 1024 ** 2, enabled=not args.no_cache)
+    metrics_dir = args.metrics_dir or os.path.join(args.output_dir, 'metrics')
+    settings = settings_from_args(args)
+    del settings['method']  # each stage names its own
+    try:
+        jobs, journal_path = pipeline_file_jobs(args.json_file, pipeline, settings, parse_range(args.scenes),
+                                                parse_range(args.images), args.output_dir)
+        print_forecast(jobs, args, journal_path, metrics_dir)
+        if args.forecast:
+            return 0
+        sink = configure_output(args, post_steps)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    recorder = metrics.configure_recorder(os.path.join(metrics_dir, 'traces.jsonl'))
+
+    def progress(result, done, total):
+        if result.get('deferred'):
+            return  # summed up at the end
+        name = f"scene {result['scene_index'] + 1} image {result['image_index'] + 1}"
+        status = ', '.join(result['saved']) if not result['error'] else f"FAILED: {result['error']}"
+        print(f"[{done}/{total}] {name}: {status} ({result['elapsed']:.1f}s)")
+
+    post = PostProcessor(post_steps, args.post_workers) if post_steps else None
+    started = time.perf_counter()
+    try:
+        results = run_pipelines(args.api_key, args.json_file, pipeline, settings, parse_range(args.scenes),
+                                parse_range(args.images), args.output_dir, args.concurrency, args.timeout,
+                                progress, args.save_intermediate, resume=not args.fresh, post=post,
+                                credit_run=credit_run, scene_jobs=(jobs, journal_path))
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    finally:
+        if post is not None:
+            post.close()
+        sink.close()
+
+    counts = tally(results)
+    print(f"Finished {counts['rendered']}/{counts['rendered'] + counts['failed']} frames "
+          f"in {time.perf_counter() - started:.1f}s")
+    if counts['skipped']:
+        print(f"Resumed: {counts['skipped']} frames were already finished or given up in an earlier run")
+    print_dedup()
+    print_spend(credit_run, results)
+    summary = recorder.summary()
+    if summary:
+        print(f"Latency: {summary}")
+    if post is not None:
+        print('\n'.join(post.report()))
+    recorder.write_prometheus(os.path.join(metrics_dir, 'metrics.prom'))
+    recorder.close()
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,289 @@
+"""
+Post-processing of saved outputs: WebP/JPEG copies, thumbnails and
+aspect-ratio crops, written next to each original by a pool of processes.
+
+Steps are a comma-separated list:
+
+    webp[:quality]    image.webp (quality 90 by default)
+    jpeg[:quality]    image.jpg (92)
+    thumb[:size]      image_thumb256.jpg, longest side `size` pixels (256)
+    crop:WxH          image_16x9.png, the largest centred W:H crop
+
+A derived file at least as new as its original is up to date and skipped
+(--force redoes it). Decoding and encoding happen in worker processes, so they
+use every core without holding the GIL the network threads need. submit()
+blocks while max_pending images are waiting, so a fast renderer slows down to
+the speed post-processing keeps up with instead of queueing without limit.
+CPU time per step is reported at the end and recorded as 'postprocess' in the
+request metrics.
+
+Example:
+    python postprocess.py generated_images --steps webp,thumb:256,crop:16x9
+    python batch_render.py story.json --post webp,jpeg:85,thumb
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+import metrics
+
+DEFAULTS = {'webp': 90, 'jpeg': 92, 'thumb': 256}
+
+
+def parse_steps(text):
+    """
+    "webp,jpeg:85,thumb:256,crop:16x9" -> [('webp', 90), ('jpeg', 85), ('thumb', 256), ('crop', (16, 9))].
+    Raises ValueError for unknown steps or bad values.
+    """
+    steps = []
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        kind, _, value = part.partition(':')
+        if kind == 'crop':
+            width, _, height = value.partition('x')
+            try:
+                ratio = (int(width), int(height))
+            except ValueError:
+                raise ValueError(f"crop needs a ratio like crop:16x9, not {part!r}")
+            if min(ratio) < 1:
+                raise ValueError(f"Invalid crop ratio: {value}")
+            steps.append(('crop', ratio))
+        elif kind in DEFAULTS:
+            number = int(value) if value else DEFAULTS[kind]
+            if kind != 'thumb' and not 1 <= number <= 100:
+                raise ValueError(f"{kind} quality must be 1-100, not {number}")
+            if number < 1:
+                raise ValueError(f"Invalid thumbnail size: {number}")
+            steps.append((kind, number))
+        else:
+            raise ValueError(f"Unknown post-processing step: {kind} (use webp, jpeg, thumb or crop)")
+    if not steps:
+        raise ValueError("No post-processing steps given.")
+    return steps
+
+
+def step_name(step):
+    kind, value = step
+    if kind == 'thumb':
+        return f'thumb{value}'
+    if kind == 'crop':
+        return f'crop{value[0]}x{value[1]}'
+    return kind
+
+
+def derived_path(path, step):
+    """
+    Where a step writes its output for the image at path: next to it, named after it.
+    """
+    path = Path(path)
+    kind, value = step
+    if kind == 'webp':
+        return path.with_suffix('.webp')
+    if kind == 'jpeg':
+        return path.with_suffix('.jpg')
+    if kind == 'thumb':
+        return path.with_name(f'{path.stem}_thumb{value}.jpg')
+    return path.with_name(f'{path.stem}_{value[0]}x{value[1]}{path.suffix}')
+
+
+def is_derived(path):
+    """
+    True for files written by a step (so a directory scan doesn't process them again).
+    """
+    stem = Path(path).stem
+    tail = stem.rsplit('_', 1)[-1]
+    if tail.startswith('thumb') and tail[5:].isdigit():
+        return True
+    width, _, height = tail.partition('x')
+    return width.isdigit() and height.isdigit()
+
+
+def _crop_box(width, height, ratio):
+    want_w, want_h = ratio
+    if width * want_h > height * want_w:
+        new_width = height * want_w // want_h
+        left = (width - new_width) // 2
+        return (left, 0, left + new_width, height)
+    new_height = width * want_h // want_w
+    top = (height - new_height) // 2
+    return (0, top, width, top + new_height)
+
+
+def _save(img, out_path, file_format, **options):
+    # Write to a temporary name and rename, so a reader never sees half a file
+    temp_path = f'{out_path}.{os.getpid()}.tmp'
+    img.save(temp_path, format=file_format, **options)
+    os.replace(temp_path, out_path)
+
+
+def run_steps(path, steps, force=False):
+    """
+    Do every step for one image (runs in a worker process).
+    Returns one {'step', 'output', 'cpu', 'skipped'} per step, plus a 'decode' entry when
+    the image had to be opened.
+    """
+    from PIL import Image
+
+    source_mtime = os.stat(path).st_mtime
+    todo = []
+    results = []
+    for step in steps:
+        out_path = derived_path(path, step)
+        try:
+            up_to_date = not force and os.stat(out_path).st_mtime >= source_mtime
+        except OSError:
+            up_to_date = False
+        if up_to_date:
+            results.append({'step': step_name(step), 'output': str(out_path), 'cpu': 0.0, 'skipped': True})
+        else:
+            todo.append((step, out_path))
+    if not todo:
+        return results
+
+    started = time.process_time()
+    with Image.open(path) as img:
+        img.load()
+    results.append({'step': 'decode', 'output': None, 'cpu': time.process_time() - started, 'skipped': False})
+
+    for step, out_path in todo:
+        started = time.process_time()
+        kind, value = step
+        if kind == 'webp':
+            _save(img if img.mode in ('RGB', 'RGBA') else img.convert('RGBA'), out_path, 'WEBP',
+                  quality=value, method=4)
+        elif kind == 'jpeg':
+            _save(img.convert('RGB'), out_path, 'JPEG', quality=value)
+        elif kind == 'thumb':
+            thumb = img.convert('RGB')
+            thumb.thumbnail((value, value), Image.LANCZOS, reducing_gap=2.0)
+            _save(thumb, out_path, 'JPEG', quality=85)
+        else:
+            _save(img.crop(_crop_box(img.width, img.height, value)), out_path, img.format or 'PNG')
+        results.append({'step': step_name(step), 'output': str(out_path),
+                        'cpu': time.process_time() - started, 'skipped': False})
+    return results
+
+
+class PostProcessor:
+    def __init__(self, steps, workers=None, max_pending=None, force=False, on_done=None):
+        # Imported here so the CLIs start without multiprocessing unless --post is used
+        from concurrent.futures import ProcessPoolExecutor
+
+        self.steps = steps
+        self.force = force
+        self.on_done = on_done  # on_done(path, results), called from a pool thread
+        workers = workers or os.cpu_count() or 1
+        self._pool = ProcessPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(max_pending or 2 * workers)
+        self._lock = threading.Lock()
+        self.totals = {}  # step name -> {'written', 'skipped', 'cpu'}
+        self.images = 0
+        self.errors = []
+        self.started = time.perf_counter()
+
+    def submit(self, path):
+        """
+        Queue the steps for one saved image; blocks while max_pending images are waiting.
+        """
+        self._slots.acquire()
+        try:
+            future = self._pool.submit(run_steps, str(path), self.steps, self.force)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda future: self._finished(str(path), future))
+        return future
+
+    def _finished(self, path, future):
+        self._slots.release()
+        try:
+            results = future.result()
+        except Exception as e:
+            with self._lock:
+                self.errors.append(f"{path}: {e}")
+            return
+
+        phases = {}
+        with self._lock:
+            self.images += 1
+            for result in results:
+                totals = self.totals.setdefault(result['step'], {'written': 0, 'skipped': 0, 'cpu': 0.0})
+                totals['skipped' if result['skipped'] else 'written'] += 1
+                totals['cpu'] += result['cpu']
+                if not result['skipped']:
+                    phases[result['step']] = result['cpu']
+        if phases:
+            metrics.get_recorder().record({'endpoint': 'postprocess', 'time': time.time(), 'path': path,
+                                           'phases': phases})
+        if self.on_done:
+            self.on_done(path, results)
+
+    def close(self, wait=True):
+        self._pool.shutdown(wait=wait, cancel_futures=not wait)
+
+    def report(self):
+        """
+        Lines for the end of a run: written/skipped and CPU time per step.
+        """
+        with self._lock:
+            lines = [f"Post-processed {self.images} images in {time.perf_counter() - self.started:.1f}s"
+                     + (f", {len(self.errors)} failed" if self.errors else '')]
+            for name, totals in sorted(self.totals.items()):
+                each = totals['cpu'] / totals['written'] if totals['written'] else 0.0
+                if name == 'decode':
+                    lines.append(f"  decode: {totals['written']} images, {totals['cpu']:.1f}s CPU ({each * 1000:.0f} ms each)")
+                    continue
+                lines.append(f"  {name}: {totals['written']} written, {totals['skipped']} up to date, "
+                             f"{totals['cpu']:.1f}s CPU ({each * 1000:.0f} ms each)")
+            lines.extend(f"  FAILED {error}" for error in self.errors[:10])
+        return lines
+
+
+def find_images(paths):
+    """
+    Original outputs under the given files/directories (not the derived files, not the caches).
+    """
+    for path in map(Path, paths):
+        if path.is_file():
+            yield path
+            continue
+        for candidate in sorted(path.rglob('*')):
+            if any(part.startswith('.') for part in candidate.relative_to(path).parts):
+                continue  # .cache, .thumbs, .runs
+            if candidate.suffix.lower() == '.png' and not is_derived(candidate):
+                yield candidate
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Make WebP/JPEG copies, thumbnails and crops of saved outputs.")
+    parser.add_argument('paths', nargs='+', help="Images or directories (PNG outputs are processed)")
+    parser.add_argument('--steps', required=True, help="e.g. webp,jpeg:85,thumb:256,crop:16x9")
+    parser.add_argument('--workers', type=int, help="Processes (default: one per CPU)")
+    parser.add_argument('--force', action='store_true', help="Redo files that look up to date")
+    args = parser.parse_args(argv)
+
+    try:
+        steps = parse_steps(args.steps)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+
+    post = PostProcessor(steps, args.workers, force=args.force)
+    try:
+        for path in find_images(args.paths):
+            post.submit(path)
+    except KeyboardInterrupt:
+        post.close(wait=False)
+        return 130
+    post.close()
+    print('\n'.join(post.report()))
+    return 1 if post.errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,96 @@
+"""
+In-memory full-text index over every image_description of a storyboard.
+
+Built once when a JSON file is loaded and updated in place when a prompt is
+saved. Queries match words by prefix ("light" finds "lighthouse"), all query
+words must match, and results that contain the query as a phrase come first.
+If no word matches, it falls back to a plain substring scan.
+"""
+import re
+from bisect import bisect_left
+from collections import defaultdict
+
+TOKEN = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return set(TOKEN.findall(text.lower()))
+
+
+class PromptIndex:
+    def __init__(self, scenes=None):
+        self.texts = {}  # (scene_index, image_index) -> description
+        self.positions = []  # every (scene_index, image_index), in storyboard order
+        self._postings = defaultdict(set)  # word -> {(scene_index, image_index)}
+        self._vocabulary = []
+        self._vocabulary_dirty = False
+        if scenes is not None:
+            self.build(scenes)
+
+    def build(self, scenes):
+        self.texts.clear()
+        self._postings.clear()
+        self.positions = []
+        for scene_index, scene in enumerate(scenes):
+            for image_index, image in enumerate(scene.get('scene', [])):
+                self.add(scene_index, image_index, image.get('image_description', ''))
+
+    def add(self, scene_index, image_index, text):
+        """
+        Append a position after the ones already indexed (while a file is still loading).
+        """
+        position = (scene_index, image_index)
+        self.positions.append(position)
+        self.texts[position] = text
+        for word in tokenize(text):
+            self._postings[word].add(position)
+        self._vocabulary_dirty = True
+
+    def update(self, scene_index, image_index, text):
+        position = (scene_index, image_index)
+        old_words = tokenize(self.texts.get(position, ''))
+        new_words = tokenize(text)
+        for word in old_words - new_words:
+            self._postings[word].discard(position)
+            if not self._postings[word]:
+                del self._postings[word]
+                self._vocabulary_dirty = True
+        for word in new_words - old_words:
+            if word not in self._postings:
+                self._vocabulary_dirty = True
+            self._postings[word].add(position)
+        self.texts[position] = text
+
+    def _words_with_prefix(self, prefix):
+        if self._vocabulary_dirty:
+            self._vocabulary = sorted(self._postings)
+            self._vocabulary_dirty = False
+        start = bisect_left(self._vocabulary, prefix)
+        for word in self._vocabulary[start:]:
+            if not word.startswith(prefix):
+                break
+            yield word
+
+    def search(self, query, limit=None):
+        """
+        Positions matching query, best matches first, then in storyboard order.
+        """
+        query = query.strip().lower()
+        if not query:
+            return []
+
+        matches = None
+        for token in TOKEN.findall(query):
+            found = set()
+            for word in self._words_with_prefix(token):
+                found |= self._postings[word]
+            matches = found if matches is None else matches & found
+            if not matches:
+                break
+
+        if not matches:
+            # Nothing matched word by word: try the query as a substring anywhere
+            matches = {position for position, text in self.texts.items() if query in text.lower()}
+
+        results = sorted(matches, key=lambda position: (query not in self.texts[position].lower(), position))
+        return results[:limit] if limit else results
@@ -0,0 +1,250 @@
+"""
+Make-style incremental rebuilds of a scene JSON file.
+
+Every scene/image position remembers what produced its latest output: a hash
+of its image_description, of the settings it was rendered with (method, seed,
+strengths, margins...) and of the reference image's content. A rebuild
+compares each position with the JSON file as it is now and sends only the
+stale ones: new images, changed prompts, changed settings, a reference image
+whose pixels changed (touching it isn't enough) or an output that was
+deleted. Everything else is left alone, so editing three prompts in a
+1,000-image storyboard costs three calls.
+
+The record is kept in output_dir/.runs/<name>_<hash>.build.jsonl. The batch
+renderer and the app's "Rebuild Changed Images" button write to it too, and
+positions a batch run finished before the record existed are taken from its
+run journal, so the first rebuild after a batch doesn't redo everything.
+
+With --watch, the JSON file and its reference images are checked every
+--interval seconds and each save triggers a rebuild of what changed.
+
+Example:
+    python rebuild.py story.json --forecast        # list what is stale, send nothing
+    python rebuild.py story.json --watch --concurrency 4
+"""
+import os
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+
+import metrics
+from batch_render import (build_parser, configure_budget, configure_output, parse_range, print_dedup, print_forecast,
+                          print_spend, render_job, render_jobs, scene_file_jobs, settings_from_args, tally)
+from http_client import configure_client
+from key_pool import configure_key_pool, get_key_pool, load_keys
+from output_sink import output_exists
+from postprocess import PostProcessor, parse_steps
+from result_cache import configure_cache
+from run_journal import BuildManifest, RunJournal, job_key, manifest_path, recorded
+
+# Order the reasons are listed in
+REASONS = ('new', 'output missing', 'prompt changed', 'settings changed', 'reference changed', 'forced')
+
+DEFAULT_INTERVAL = 1.0
+
+LISTED = 20  # stale images listed by --forecast
+
+
+def stale_reasons(entry, fingerprint):
+    if entry is None:
+        return ['new']
+    if not entry.get('filename') or not output_exists(entry['filename']):
+        return ['output missing']
+    return [f'{part} changed' for part in ('prompt', 'settings', 'reference') if entry.get(part) != fingerprint[part]]
+
+
+def stale_jobs(jobs, manifest, journal_path=None):
+    """
+    The jobs whose latest output wasn't made from what they ask for now, as a list of
+    (job, fingerprint, reasons). A position the record doesn't know yet is taken from the
+    batch run journal at journal_path if that finished it with the same params.
+    """
+    journal = RunJournal(journal_path) if journal_path and os.path.exists(journal_path) else None
+    stale, adopted = [], []
+    for job in jobs:
+        fingerprint = manifest.fingerprint(job)
+        entry = manifest.targets.get((job['scene_index'], job['image_index']))
+        if entry is None and journal is not None:
+            state = journal.states.get(job_key(job))
+            if state and state['state'] == 'done' and state['filename'] and output_exists(state['filename']):
+                adopted.append((job, fingerprint, state['filename']))
+                continue
+        reasons = stale_reasons(entry, fingerprint)
+        if reasons:
+            stale.append((job, fingerprint, reasons))
+    if adopted:
+        manifest.record_many(adopted)
+    return stale
+
+
+def describe_stale(stale, total):
+    """
+    One line like "3 of 1000 images stale (2 new, 1 prompt changed)".
+    """
+    if not stale:
+        return f"All {total} images up to date"
+    counts = Counter(reason for _, _, reasons in stale for reason in reasons)
+    details = ', '.join(f'{counts[reason]} {reason}' for reason in REASONS if counts[reason])
+    return f"{len(stale)} of {total} images stale ({details})"
+
+
+def rebuild_jobs(api_key, stale, manifest, output_dir='generated_images', concurrency=4, timeout=None, progress=None,
+                 post=None, credit_run=None):
+    """
+    Render the stale jobs (from stale_jobs) and record each output that comes back.
+    Failed and deferred jobs stay stale for the next rebuild.
+    """
+    return render_jobs(api_key, [job for job, _, _ in stale], output_dir, concurrency, timeout, progress,
+                       render=recorded(render_job, manifest), post=post, credit_run=credit_run)
+
+
+def watched_files(json_path, jobs):
+    paths = {os.path.abspath(json_path)}
+    paths.update(os.path.abspath(job['reference_image']) for job in jobs if job.get('reference_image'))
+    return sorted(paths)
+
+
+def file_state(paths):
+    """
+    (size, mtime) of each path, None for missing ones; changes when any of them is saved.
+    """
+    state = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            state.append((stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            state.append(None)
+    return state
+
+
+def watch(json_path, build, interval=DEFAULT_INTERVAL):
+    """
+    Call build() now and again after every save of the JSON file or a reference image, until
+    Ctrl+C. build() returns the jobs it looked at (to know which references to watch), or None
+    if the file couldn't be read, e.g. halfway through a save.
+    """
+    paths = [os.path.abspath(json_path)]
+    while True:
+        state = file_state(paths)
+        jobs = build()
+        if jobs is not None:
+            paths = watched_files(json_path, jobs)
+            if len(paths) > len(state):
+                state = file_state(paths)  # new references count from now, not from before the build
+        print(f"Watching {len(paths)} files (Ctrl+C to stop)")
+        while file_state(paths) == state:
+            time.sleep(interval)
+        # Let the editor finish writing before reading the file
+        changed = file_state(paths)
+        time.sleep(interval)
+        while file_state(paths) != changed:
+            changed = file_state(paths)
+            time.sleep(interval)
+
+
+def main(argv=None):
+    parser = build_parser()
+    parser.description = "Render only the images of a scene JSON file that changed since their latest output."
+    parser.add_argument('--watch', action='store_true', help="Keep running and rebuild whenever the files are saved")
+    parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL, help="Seconds between checks with --watch")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.keys_file:
+            configure_key_pool(load_keys(args.keys_file))
+            args.api_key = None
+        elif not args.api_key and get_key_pool() is None and not args.forecast:
+            print("API key is required (--api-key, STABILITY_API_KEY, --keys-file or STABILITY_API_KEYS).", file=sys.stderr)
+            return 2
+        post_steps = parse_steps(args.post) if args.post else None
+        credit_run = configure_budget(args, Path(args.json_file).stem)
+        sink = None if args.forecast else configure_output(args, post_steps)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+
+    configure_client(max_in_flight=args.concurrency, max_retries=args.max_retries,
+                     pool_size=max(32, args.concurrency), timeout=args.timeout)
+    configure_cache(cache_dir=os.path.join(args.output_dir, '.cache'),
+                    max_bytes=args.cache_size * 1024 ** 2, enabled=not args.no_cache)
+    metrics_dir = args.metrics_dir or os.path.join(args.output_dir, 'metrics')
+    recorder = metrics.configure_recorder(os.path.join(metrics_dir, 'traces.jsonl'))
+    settings = settings_from_args(args)
+    manifest = BuildManifest(manifest_path(args.output_dir, args.json_file))
+    post = PostProcessor(post_steps, args.post_workers) if post_steps and not args.forecast else None
+    failed = 0
+    results = []
+
+    def progress(result, done, total):
+        if result.get('deferred'):
+            return  # summed up at the end
+        name = f"scene {result['scene_index'] + 1} image {result['image_index'] + 1}"
+        status = result['filename'] or f"FAILED: {result['error']}"
+        print(f"[{done}/{total}] {name}: {status} ({result['elapsed']:.1f}s)")
+
+    def build():
+        nonlocal failed
+        started = time.perf_counter()
+        try:
+            jobs, journal_path = scene_file_jobs(args.json_file, settings, parse_range(args.scenes),
+                                                 parse_range(args.images), args.output_dir)
+        except (OSError, ValueError) as e:
+            print(f"Error: {e}", file=sys.stderr)
+            return None
+        if args.fresh:
+            stale = [(job, manifest.fingerprint(job), ['forced']) for job in jobs]
+        else:
+            stale = stale_jobs(jobs, manifest, journal_path)
+        print(f"{describe_stale(stale, len(jobs))} (checked in {(time.perf_counter() - started) * 1000:.0f} ms)")
+        if args.forecast:
+            for job, _, reasons in stale[:LISTED]:
+                print(f"  scene {job['scene_index'] + 1} image {job['image_index'] + 1}: {', '.join(reasons)}")
+            if len(stale) > LISTED:
+                print(f"  ... and {len(stale) - LISTED} more")
+        if not stale:
+            return jobs
+        print_forecast([job for job, _, _ in stale], args, metrics_dir=metrics_dir)
+        if args.forecast or credit_run.exhausted():
+            return jobs
+
+        started = time.perf_counter()
+        done = rebuild_jobs(args.api_key, stale, manifest, args.output_dir, args.concurrency, args.timeout,
+                            progress, post, credit_run)
+        counts = tally(done)
+        failed += counts['failed']
+        results.extend(done)
+        print(f"Rebuilt {counts['rendered']}/{counts['rendered'] + counts['failed']} images "
+              f"in {time.perf_counter() - started:.1f}s")
+        return jobs
+
+    try:
+        if args.watch and not args.forecast:
+            watch(args.json_file, build, args.interval)
+        elif build() is None:
+            return 2
+    except KeyboardInterrupt:
+        print("Stopped watching")
+    finally:
+        if post is not None:
+            post.close()
+        if sink is not None:
+            sink.close()
+        manifest.close()
+
+    if results:
+        print_dedup()
+        print_spend(credit_run, results)
+        summary = recorder.summary()
+        if summary:
+            print(f"Latency: {summary}")
+        if post is not None:
+            print('\n'.join(post.report()))
+        recorder.write_prometheus(os.path.join(metrics_dir, 'metrics.prom'))
+    recorder.close()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+"""
+In-memory preparation of reference images for upload.
+
+A reference is decoded once, shrunk to the endpoint's limits and encoded once;
+the prepared bytes are kept in a bounded LRU keyed by the file's identity
+(path, size, mtime) so a seed sweep over one reference does the work once.
+Nothing is written next to the user's files.
+"""
+import io
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+# Pillow format names for the extensions the API accepts
+SAVE_FORMATS = {'.png': 'PNG', '.jpg': 'JPEG', '.jpeg': 'JPEG', '.webp': 'WEBP'}
+
+DEFAULT_MAX_BYTES = 256 * 1024 ** 2  # 256 MB of prepared uploads
+
+
+def file_identity(image_path):
+    stat = os.stat(image_path)
+    return (os.path.abspath(image_path), stat.st_size, stat.st_mtime_ns)
+
+
+def prepare_image(raw_bytes, file_extension, max_size):
+    """
+    Return the bytes to upload: the original bytes if the image is within max_size,
+    otherwise a LANCZOS thumbnail encoded in the same format.
+    """
+    from PIL import Image  # imported on first use to keep startup fast
+
+    with Image.open(io.BytesIO(raw_bytes)) as img:
+        if img.width <= max_size[0] and img.height <= max_size[1]:
+            return raw_bytes
+
+        img.thumbnail(max_size, Image.LANCZOS)  # Use Image.LANCZOS for high-quality resizing
+        save_format = SAVE_FORMATS[file_extension]
+        if save_format == 'JPEG' and img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        buffer = io.BytesIO()
+        img.save(buffer, format=save_format)
+        return buffer.getvalue()
+
+
+class ReferenceCache:
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def prepare(self, image_path, max_size):
+        """
+        Prepared (bytes, file_extension) for image_path at max_size.
+        Concurrent callers for the same file wait for one preparation instead of repeating it.
+        """
+        file_extension = Path(image_path).suffix.lower()
+        if file_extension not in SAVE_FORMATS:
+            raise ValueError(f"Unsupported image format: {file_extension}")
+
+        key = file_identity(image_path) + (tuple(max_size),)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            try:
+                with self._lock:
+                    if key in self._entries:
+                        self._entries.move_to_end(key)
+                        self.hits += 1
+                        return self._entries[key], file_extension
+                    self.misses += 1
+
+                with open(image_path, 'rb') as file:
+                    prepared = prepare_image(file.read(), file_extension, max_size)
+
+                with self._lock:
+                    self._entries[key] = prepared
+                    self._size += len(prepared)
+                    while self._size > self.max_bytes and len(self._entries) > 1:
+                        _, old = self._entries.popitem(last=False)
+                        self._size -= len(old)
+            finally:
+                # Also on a hit or an unreadable image, so no key keeps its lock
+                with self._lock:
+                    self._key_locks.pop(key, None)
+        return prepared, file_extension
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+_cache = ReferenceCache()
+
+
+def prepare_reference(image_path, max_size):
+    return _cache.prepare(image_path, max_size)
+
+
+def get_reference_cache():
+    return _cache
@@ -0,0 +1,193 @@
+"""
+Persistent, content-addressed cache of API results.
+
+The key is a SHA-256 over everything that affects the output: the endpoint and
+every multipart field, with uploaded files hashed by content (so the reference
+image is identified by its bytes, not its path). The API key is not part of
+the key, so a cache directory can be shared between teammates.
+
+Entries are plain PNG files under generated_images/.cache/. The least recently
+used ones are evicted when the cache grows past max_bytes.
+"""
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+DEFAULT_CACHE_DIR = os.path.join('generated_images', '.cache')
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3  # 2 GB
+
+
+def _field_value(value):
+    # files entries are (filename, content, mime) tuples; data entries are plain strings
+    if isinstance(value, tuple):
+        return [_field_value(v) for v in value]
+    if isinstance(value, (bytes, bytearray)):
+        return 'sha256:' + hashlib.sha256(value).hexdigest()
+    return value
+
+
+def request_key(request):
+    """
+    Cache key for a built request, or None if the request should not be cached.
+    Seed 0 asks the API for a random seed, so those results are never reused.
+    """
+    fields = {}
+    for name, value in (request.get('data') or {}).items():
+        fields[name] = _field_value(value)
+    for name, value in (request.get('files') or {}).items():
+        fields[name] = _field_value(value)
+
+    seed = fields.get('seed')
+    if isinstance(seed, list):
+        seed = seed[-1]
+    if str(seed) in ('', '0', 'None'):
+        return None
+
+    blob = json.dumps({'url': request['url'], 'fields': fields}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+
+class CachedResponse:
+    """
+    Looks enough like a requests.Response for the code that saves results.
+    """
+    status_code = 200
+    text = ''
+    retries = 0
+    from_cache = True
+
+    def __init__(self, content):
+        self.content = content
+        self.headers = {'Content-Type': 'image/png'}
+
+
+class ResultCache:
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, enabled=True):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._size = None  # computed on first store
+
+    def _path(self, key):
+        return self.cache_dir / key[:2] / f'{key}.png'
+
+    def get(self, key):
+        if not self.enabled or key is None:
+            return None
+
+        path = self._path(key)
+        try:
+            content = path.read_bytes()
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        # Touch the entry so eviction sees it as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return content
+
+    def contains(self, key):
+        """
+        True if get() would find a result, without reading it or counting a hit.
+        """
+        return self.enabled and key is not None and self._path(key).exists()
+
+    def put(self, key, content):
+        if not self.enabled or key is None:
+            return
+
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_suffix(f'.{threading.get_ident()}.tmp')
+        with open(temp_path, 'wb') as file:
+            file.write(content)
+
+        with self._lock:
+            # Replacing an entry only grows the cache by the difference
+            try:
+                old_size = path.stat().st_size
+            except OSError:
+                old_size = 0
+            os.replace(temp_path, path)
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._entries())
+            else:
+                self._size += len(content) - old_size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        for path in self.cache_dir.glob('*/*.png'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            yield path, stat.st_size, stat.st_mtime
+
+    def _evict(self):
+        # Drop least recently used entries until we are 10% under the limit
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        size = sum(entry[1] for entry in entries)
+        target = self.max_bytes * 0.9
+        for path, entry_size, _ in entries:
+            if size <= target:
+                break
+            try:
+                path.unlink()
+                size -= entry_size
+            except OSError:
+                pass
+        self._size = size
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'enabled': self.enabled,
+            }
+
+    def clear(self):
+        with self._lock:
+            for path, _, _ in list(self._entries()):
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+            self._size = 0
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    The cache shared by the GUI and the batch renderer.
+    Set STABLECANVAS_NO_CACHE=1 to start with the cache bypassed.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResultCache(enabled=not os.environ.get('STABLECANVAS_NO_CACHE'))
+        return _cache
+
+
+def configure_cache(**settings):
+    global _cache
+    with _cache_lock:
+        _cache = ResultCache(**settings)
+        return _cache
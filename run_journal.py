@@ -0,0 +1,305 @@
+"""
+Write-ahead journal of job states for batch and sweep runs.
+
+Every job gets a line when it starts and another when it finishes (done or
+failed), appended and fsynced before the run moves on. A run started again
+with the same JSON file and settings finds its journal by name and replays
+it: finished jobs whose output is still on disk (or in the run's archive)
+are skipped, failed jobs are retried until they reach the attempt cap, and
+jobs that were in flight when the process died are sent again (a fixed seed
+is answered by the result cache if the image already came back).
+
+A BuildManifest is the other record kept per JSON file, whatever the settings:
+for every scene/image position, what its latest output was made from (see
+rebuild.py).
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+from output_sink import output_exists
+
+RUNS_DIR = '.runs'
+DEFAULT_MAX_ATTEMPTS = 3
+
+# Params that don't change the image
+IGNORED_FIELDS = ('api_key', 'json_file', 'sweep')
+
+# Params that say where an image goes rather than what it looks like
+POSITION_FIELDS = ('scene_index', 'image_index')
+
+
+def job_key(job):
+    """
+    Stable id for a job: its scene/image position and every param that shapes the image.
+    A changed prompt or reference file makes a new job.
+    """
+    fields = {name: value for name, value in job.items() if name not in IGNORED_FIELDS}
+    reference = fields.get('reference_image')
+    if reference:
+        try:
+            stat = os.stat(reference)
+            fields['reference_image'] = [reference, stat.st_size, stat.st_mtime_ns]
+        except OSError:
+            pass
+    blob = json.dumps(fields, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()[:24]
+
+
+def run_path(output_dir, name, settings):
+    """
+    Journal file for a run: the same source and settings always map to the same file.
+    """
+    settings = {key: value for key, value in (settings or {}).items() if key not in IGNORED_FIELDS}
+    blob = json.dumps({'name': name, 'settings': settings}, sort_keys=True, default=str)
+    digest = hashlib.sha256(blob.encode('utf-8')).hexdigest()[:12]
+    stem = Path(name).stem if name else 'run'
+    return os.path.join(output_dir, RUNS_DIR, f'{stem}_{digest}.jsonl')
+
+
+class RunJournal:
+    def __init__(self, path, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.states = {}  # job key -> {'state', 'attempts', 'filename', 'error'}
+        self.resume_summary = None
+        self._lock = threading.Lock()
+        self._file = None
+        self._replay()
+
+    def _apply(self, entry):
+        state = self.states.setdefault(entry['job'], {'state': None, 'attempts': 0, 'filename': None, 'error': None})
+        state['state'] = entry['state']
+        if 'attempts' in entry:
+            state['attempts'] = entry['attempts']  # written by compact()
+        elif entry['state'] == 'started':
+            state['attempts'] += 1
+        if entry['state'] == 'done':
+            state['filename'] = entry.get('filename')
+        elif entry['state'] == 'failed':
+            state['error'] = entry.get('error')
+
+    def _replay(self):
+        if not os.path.exists(self.path):
+            return
+        lines = 0
+        with open(self.path, encoding='utf-8') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # torn last line from a crash
+                self._apply(entry)
+                lines += 1
+
+        if lines > 2 * len(self.states) + 1000:
+            self.compact()
+
+    def compact(self):
+        """
+        Rewrite the journal with one line per job (atomically, so a crash keeps the old one).
+        """
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            for key, state in self.states.items():
+                entry = {'job': key, 'state': state['state'], 'attempts': state['attempts']}
+                if state['filename']:
+                    entry['filename'] = state['filename']
+                if state['error']:
+                    entry['error'] = state['error']
+                file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+
+    def _append(self, entry):
+        with self._lock:
+            if self._file is None:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                self._file = open(self.path, 'a', encoding='utf-8')
+            entry['time'] = round(time.time(), 3)
+            self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._apply(entry)
+
+    def plan(self, jobs):
+        """
+        Split the jobs into (to_run, skipped): indices of the jobs to send, and (index, result)
+        for jobs already done or out of attempts. Counts by state are left in self.resume_summary.
+        """
+        to_run, skipped = [], []
+        summary = {'done': 0, 'retrying': 0, 'interrupted': 0, 'gave_up': 0, 'new': 0}
+        for index, job in enumerate(jobs):
+            state = self.states.get(job_key(job))
+            if state is None:
+                summary['new'] += 1
+                to_run.append(index)
+            elif state['state'] == 'done' and state['filename'] and output_exists(state['filename']):
+                summary['done'] += 1
+                skipped.append((index, {'filename': state['filename'], 'error': None, 'skipped': True}))
+            elif state['state'] == 'failed' and state['attempts'] >= self.max_attempts:
+                summary['gave_up'] += 1
+                skipped.append((index, {'filename': None, 'skipped': True,
+                                      'error': f"gave up after {state['attempts']} attempts: {state['error']}"}))
+            else:
+                summary['interrupted' if state['state'] == 'started' else 'retrying'] += 1
+                to_run.append(index)
+        self.resume_summary = summary
+        return to_run, skipped
+
+    def started(self, job):
+        self._append({'job': job_key(job), 'state': 'started'})
+
+    def finished(self, job, result):
+        if result['error']:
+            self._append({'job': job_key(job), 'state': 'failed', 'error': result['error']})
+        else:
+            self._append({'job': job_key(job), 'state': 'done', 'filename': result['filename']})
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def manifest_path(output_dir, json_path):
+    """
+    Build record for a JSON file: one per file, whatever settings it was last rendered with.
+    """
+    json_path = os.path.abspath(json_path)
+    digest = hashlib.sha256(json_path.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(output_dir, RUNS_DIR, f'{Path(json_path).stem}_{digest}.build.jsonl')
+
+
+def text_hash(value):
+    blob = json.dumps(value, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()[:16]
+
+
+class BuildManifest:
+    def __init__(self, path):
+        self.path = path
+        self.targets = {}  # (scene_index, image_index) -> {'prompt', 'settings', 'reference', 'filename'}
+        self.references = {}  # absolute path -> (size, mtime_ns, content hash)
+        self._lock = threading.Lock()
+        self._file = None
+        self._replay()
+
+    def _apply(self, entry):
+        if 'reference_file' in entry:
+            self.references[entry['reference_file']] = (entry['size'], entry['mtime_ns'], entry['sha256'])
+        else:
+            self.targets[tuple(entry['target'])] = entry
+
+    def _replay(self):
+        if not os.path.exists(self.path):
+            return
+        lines = 0
+        with open(self.path, encoding='utf-8') as file:
+            for line in file:
+                try:
+                    self._apply(json.loads(line))
+                except (ValueError, KeyError, TypeError):
+                    continue  # torn last line from a crash
+                lines += 1
+
+        if lines > 2 * (len(self.targets) + len(self.references)) + 1000:
+            self.compact()
+
+    def compact(self):
+        """
+        Rewrite the record with one line per position and reference (atomically).
+        """
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            for path, (size, mtime_ns, sha256) in self.references.items():
+                file.write(json.dumps({'reference_file': path, 'size': size, 'mtime_ns': mtime_ns,
+                                       'sha256': sha256}) + '\n')
+            for entry in self.targets.values():
+                file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+
+    def _append(self, *entries):
+        with self._lock:
+            if self._file is None:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                self._file = open(self.path, 'a', encoding='utf-8')
+            for entry in entries:
+                self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            for entry in entries:
+                self._apply(entry)
+
+    def reference_hash(self, path):
+        """
+        Hash of a reference image's content, read again only when its size or mtime changes.
+        'missing' if the file isn't there.
+        """
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return 'missing'
+        known = self.references.get(path)
+        if known and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+            return known[2]
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                digest.update(chunk)
+        sha256 = digest.hexdigest()[:16]
+        self._append({'reference_file': path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256})
+        return sha256
+
+    def fingerprint(self, job):
+        """
+        What the job's image depends on, as {'prompt', 'settings', 'reference'} hashes.
+        """
+        settings = {name: value for name, value in job.items()
+                    if name not in IGNORED_FIELDS + POSITION_FIELDS + ('prompt', 'reference_image')}
+        reference = job.get('reference_image')
+        return {'prompt': text_hash(job.get('prompt', '')), 'settings': text_hash(settings),
+                'reference': self.reference_hash(reference) if reference else None}
+
+    def record(self, job, fingerprint, filename):
+        """
+        Note that filename is now the latest output of the job's position, made from fingerprint.
+        """
+        self.record_many([(job, fingerprint, filename)])
+
+    def record_many(self, outputs):
+        """
+        record() for a list of (job, fingerprint, filename), with a single fsync.
+        """
+        now = round(time.time(), 3)
+        self._append(*[dict(fingerprint, target=[job['scene_index'], job['image_index']], filename=filename, time=now)
+                       for job, fingerprint, filename in outputs])
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def recorded(render, manifest):
+    """
+    Wrap a render(api_key, job, output_dir, timeout) function so every output it makes is
+    recorded in the BuildManifest as its position's latest.
+    """
+    def run(api_key, job, output_dir, timeout):
+        fingerprint = manifest.fingerprint(job)
+        result = render(api_key, job, output_dir, timeout)
+        if not result['error']:
+            manifest.record(job, fingerprint, result['filename'])
+        return result
+    return run
@@ -0,0 +1,483 @@
+"""
+Compact, streaming model of a scene JSON file.
+
+json.load on a generated storyboard of tens of MB builds a dict for every
+image and every metadata field in it, which takes several times the file size
+in memory, and nothing can be shown until the whole file is parsed.
+load_storyboard() reads the file in chunks and parses it one image at a time:
+
+- image_description and reference_image go into flat per-image slots (one
+  list entry per image, no dict per image), with repeated strings shared;
+- every other field of an image, a scene or the file is kept as the raw JSON
+  text it was written as, and only decoded when something asks for it;
+- on_scene is called as each scene is finished, and Storyboard.loaded counts
+  the finished scenes, so the app can show the first scenes while the rest of
+  the file is still loading.
+
+Storyboard.write() saves it the way json.dump(..., indent=4) would, with the
+raw fields written back as they were read. Storyboard.scenes looks like the
+list json.load would return (scenes[i]['scene'][j]['image_description'],
+scene.get('pipeline')), with views built from the slots on access, so code
+written against the nested dicts keeps working.
+
+Example:
+    board = load_storyboard('story.json')
+    print(board.loaded, board.description(0, 2))
+    board.set_field(0, 2, 'image_description', 'a lighthouse at dawn')
+    with open('story.json', 'w', encoding='utf-8') as file:
+        board.write(file)
+"""
+import json
+import re
+import sys
+from array import array
+from collections.abc import Sequence
+
+CHUNK = 1024 * 1024  # characters read at a time
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+# Fields kept in slots; an image with only these (in this order) has no raw text
+SLOT_FIELDS = ('image_description', 'reference_image')
+
+# A scene with nothing but its images
+PLAIN_SCENE = (('scene', None),)
+
+_missing = object()
+
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False)
+
+
+def _indent(text, depth):
+    # json.dumps(indent=4) output, moved in to sit at depth like json.dump would nest it
+    return text.replace('\n', '\n' + '    ' * depth)
+
+
+class _Reader:
+    """
+    A JSON document read a chunk at a time, for walking its top levels by hand.
+    """
+    def __init__(self, file):
+        self.file = file
+        self.buffer = ''
+        self.pos = 0
+        self.offset = 0  # characters dropped from the front of the buffer
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self, size=CHUNK):
+        if self.eof:
+            return False
+        if self.pos > CHUNK:
+            # Drop what has been parsed so the buffer stays about one chunk long
+            self.buffer = self.buffer[self.pos:]
+            self.offset += self.pos
+            self.pos = 0
+        data = self.file.read(size)
+        if not data:
+            self.eof = True
+            return False
+        self.buffer += data
+        return True
+
+    def error(self, message, pos=None):
+        return ValueError(f"Invalid JSON at character {self.offset + (self.pos if pos is None else pos)}: {message}")
+
+    def peek(self):
+        """
+        The next character after whitespace, or '' at the end of the file.
+        """
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, characters):
+        character = self.peek()
+        if not character or character not in characters:
+            raise self.error(f"expected {' or '.join(repr(c) for c in characters)}")
+        self.pos += 1
+        return character
+
+    def value(self):
+        """
+        Decode the JSON value at the current position. Returns (value, start); its raw
+        text is buffer[start:pos] until the next read.
+        """
+        self.peek()
+        size = CHUNK
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as e:
+                # Most likely cut off by the end of the chunk; read more and try again
+                if not self.fill(size):
+                    raise self.error(e.msg, e.pos) from None
+                size = max(size, len(self.buffer) - self.pos)  # a huge value is parsed a few times, not once per chunk
+                continue
+            if end == len(self.buffer) and self.fill():
+                continue  # a number may go on in the next chunk
+            start, self.pos = self.pos, end
+            return value, start
+
+    def key(self):
+        if self.peek() != '"':
+            raise self.error("expected a field name")
+        key, _ = self.value()
+        self.expect(':')
+        return key
+
+
+class Storyboard:
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        """
+        Forget everything read so far. Views taken from scenes stay bound to this storyboard.
+        """
+        self.fields = []  # top-level (name, raw JSON), with ('scenes', None) where the scenes go
+        self.ends = array('q')  # one past the flat index of each scene's last image
+        self.scene_fields = {}  # scene index -> its (name, raw) fields, or its raw text if it isn't an object
+        self.descriptions = []  # per image: its image_description, or None if that isn't a string
+        self.references = []  # per image: its reference_image, or None
+        self.raws = {}  # flat image index -> raw JSON of images that don't fit the slots
+        self.done = False
+        self._strings = {}
+
+    @property
+    def loaded(self):
+        """
+        Scenes parsed so far (all of them once done is set).
+        """
+        return len(self.ends)
+
+    @property
+    def scenes(self):
+        return SceneList(self)
+
+    def read(self, json_path, on_scene=None):
+        """
+        Parse json_path into this storyboard, replacing what it held. on_scene(scene_index) is
+        called after each scene. Raises ValueError for invalid JSON or a file without "scenes".
+        """
+        self.clear()
+        found = False
+        with open(json_path, 'r', encoding='utf-8') as file:
+            reader = _Reader(file)
+            if reader.peek() != '{':
+                raise ValueError("The JSON file does not contain 'scenes'.")
+            reader.pos += 1
+            if reader.peek() == '}':
+                reader.pos += 1
+            else:
+                while True:
+                    key = reader.key()
+                    if key == 'scenes' and not found:
+                        if reader.peek() != '[':
+                            raise ValueError("'scenes' must be a list.")
+                        self._read_scenes(reader, on_scene)
+                        self.fields.append(('scenes', None))
+                        found = True
+                    else:
+                        _, start = reader.value()
+                        self.fields.append((sys.intern(key), reader.buffer[start:reader.pos]))
+                    if reader.expect(',}') == '}':
+                        break
+            if reader.peek():
+                raise reader.error("extra data after the end")
+
+        if not found:
+            raise ValueError("The JSON file does not contain 'scenes'.")
+        self._strings = {}
+        self.done = True
+        return self
+
+    def _read_scenes(self, reader, on_scene):
+        reader.pos += 1
+        if reader.peek() == ']':
+            reader.pos += 1
+            return
+        while True:
+            self._read_scene(reader)
+            self.ends.append(len(self.descriptions))
+            if on_scene:
+                on_scene(len(self.ends) - 1)
+            if reader.expect(',]') == ']':
+                return
+
+    def _read_scene(self, reader):
+        index = len(self.ends)
+        if reader.peek() != '{':
+            _, start = reader.value()
+            self.scene_fields[index] = reader.buffer[start:reader.pos]  # not an object: kept as it was
+            return
+
+        reader.pos += 1
+        fields = []
+        if reader.peek() == '}':
+            reader.pos += 1
+        else:
+            while True:
+                key = reader.key()
+                if key == 'scene' and reader.peek() == '[' and ('scene', None) not in fields:
+                    self._read_images(reader)
+                    fields.append(('scene', None))
+                else:
+                    _, start = reader.value()
+                    fields.append((sys.intern(key), reader.buffer[start:reader.pos]))
+                if reader.expect(',}') == '}':
+                    break
+        if tuple(fields) != PLAIN_SCENE:
+            self.scene_fields[index] = fields
+
+    def _read_images(self, reader):
+        reader.pos += 1
+        if reader.peek() == ']':
+            reader.pos += 1
+            return
+        strings = self._strings
+        descriptions = self.descriptions
+        references = self.references
+        while True:
+            image, start = reader.value()
+            description = reference = None
+            plain = False
+            if type(image) is dict:
+                description = image.get('image_description')
+                reference = image.get('reference_image')
+                if type(description) is str:
+                    description = strings.setdefault(description, description)
+                    plain = next(iter(image)) == 'image_description' and (
+                        len(image) == 1 or (len(image) == 2 and type(reference) is str))
+                else:
+                    description = None
+                reference = sys.intern(reference) if type(reference) is str else None
+            if not plain:
+                self.raws[len(descriptions)] = reader.buffer[start:reader.pos]
+            descriptions.append(description)
+            references.append(reference)
+            if reader.expect(',]') == ']':
+                return
+
+    def _scene_range(self, scene_index):
+        if not 0 <= scene_index < len(self.ends):
+            raise IndexError('scene index out of range')
+        return (self.ends[scene_index - 1] if scene_index else 0), self.ends[scene_index]
+
+    def image_count(self, scene_index):
+        start, end = self._scene_range(scene_index)
+        return end - start
+
+    def _flat(self, scene_index, image_index):
+        start, end = self._scene_range(scene_index)
+        if not 0 <= image_index < end - start:
+            raise IndexError('image index out of range')
+        return start + image_index
+
+    def _decoded(self, flat):
+        image = json.loads(self.raws[flat])
+        return image if isinstance(image, dict) else {}
+
+    def description(self, scene_index, image_index):
+        description = self.descriptions[self._flat(scene_index, image_index)]
+        if description is None:
+            description = self.get_field(scene_index, image_index, 'image_description', '')
+        return description
+
+    def get_field(self, scene_index, image_index, field, default=None):
+        flat = self._flat(scene_index, image_index)
+        if field == 'image_description' and self.descriptions[flat] is not None:
+            return self.descriptions[flat]
+        if field == 'reference_image' and self.references[flat] is not None:
+            return self.references[flat]
+        if flat in self.raws:
+            return self._decoded(flat).get(field, default)
+        return default
+
+    def image_fields(self, scene_index, image_index):
+        flat = self._flat(scene_index, image_index)
+        if flat in self.raws:
+            return list(self._decoded(flat))
+        return ['image_description'] if self.references[flat] is None else list(SLOT_FIELDS)
+
+    def set_field(self, scene_index, image_index, field, value):
+        """
+        Change one field of one image. An image with fields beyond the slots keeps them.
+        """
+        flat = self._flat(scene_index, image_index)
+        if flat in self.raws or field not in SLOT_FIELDS or (field == 'image_description' and type(value) is not str):
+            image = self._decoded(flat) if flat in self.raws else {
+                name: self.get_field(scene_index, image_index, name) for name in self.image_fields(scene_index, image_index)}
+            image[field] = value
+            self.raws[flat] = _indent(json.dumps(image, ensure_ascii=False, indent=4), 4)
+        if field == 'image_description':
+            self.descriptions[flat] = value if type(value) is str else None
+        elif field == 'reference_image':
+            self.references[flat] = value if type(value) is str else None
+
+    def scene_field(self, scene_index, name, default=None):
+        self._scene_range(scene_index)
+        fields = self.scene_fields.get(scene_index, PLAIN_SCENE)
+        if isinstance(fields, str):
+            scene = json.loads(fields)
+            return scene.get(name, default) if isinstance(scene, dict) else default
+        for field, raw in fields:
+            if field == name:
+                return ImageList(self, scene_index) if raw is None else json.loads(raw)
+        return default
+
+    def scene_keys(self, scene_index):
+        self._scene_range(scene_index)
+        fields = self.scene_fields.get(scene_index, PLAIN_SCENE)
+        if isinstance(fields, str):
+            scene = json.loads(fields)
+            return list(scene) if isinstance(scene, dict) else []
+        return [field for field, _ in fields]
+
+    def _image_text(self, flat):
+        raw = self.raws.get(flat)
+        if raw is not None:
+            return raw
+        text = '{\n                    "image_description": ' + _dumps(self.descriptions[flat])
+        if self.references[flat] is not None:
+            text += ',\n                    "reference_image": ' + _dumps(self.references[flat])
+        return text + '\n                }'
+
+    def _scene_text(self, scene_index):
+        fields = self.scene_fields.get(scene_index, PLAIN_SCENE)
+        if isinstance(fields, str):
+            return fields
+        if not fields:
+            return '{}'
+        parts = []
+        for name, raw in fields:
+            if raw is None:
+                start, end = self._scene_range(scene_index)
+                if start == end:
+                    raw = '[]'
+                else:
+                    raw = ('[\n                ' + ',\n                '.join(self._image_text(flat) for flat in range(start, end))
+                           + '\n            ]')
+            parts.append(f'\n            {_dumps(name)}: {raw}')
+        return '{' + ','.join(parts) + '\n        }'
+
+    def write(self, file):
+        """
+        Write the storyboard as JSON, laid out like json.dump(..., indent=4).
+        """
+        if not self.fields:
+            file.write('{}')
+            return
+        file.write('{')
+        for number, (name, raw) in enumerate(self.fields):
+            file.write(f'{"," if number else ""}\n    {_dumps(name)}: ')
+            if raw is not None:
+                file.write(raw)
+            elif not self.ends:
+                file.write('[]')
+            else:
+                file.write('[')
+                for scene_index in range(len(self.ends)):
+                    file.write(f'{"," if scene_index else ""}\n        {self._scene_text(scene_index)}')
+                file.write('\n    ]')
+        file.write('\n}')
+
+
+class SceneList(Sequence):
+    """
+    The scenes parsed so far, as json.load would have returned them.
+    """
+    def __init__(self, board):
+        self._board = board
+
+    def __len__(self):
+        return self._board.loaded
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('scene index out of range')
+        return SceneView(self._board, index)
+
+
+class SceneView:
+    __slots__ = ('_board', '_index')
+
+    def __init__(self, board, index):
+        self._board = board
+        self._index = index
+
+    def get(self, name, default=None):
+        return self._board.scene_field(self._index, name, default)
+
+    def __getitem__(self, name):
+        value = self.get(name, _missing)
+        if value is _missing:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name):
+        return name in self.keys()
+
+    def keys(self):
+        return self._board.scene_keys(self._index)
+
+
+class ImageList(Sequence):
+    def __init__(self, board, scene_index):
+        self._board = board
+        self._scene_index = scene_index
+
+    def __len__(self):
+        return self._board.image_count(self._scene_index)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('image index out of range')
+        return ImageView(self._board, self._scene_index, index)
+
+
+class ImageView:
+    __slots__ = ('_board', '_scene_index', '_index')
+
+    def __init__(self, board, scene_index, index):
+        self._board = board
+        self._scene_index = scene_index
+        self._index = index
+
+    def get(self, field, default=None):
+        return self._board.get_field(self._scene_index, self._index, field, default)
+
+    def __getitem__(self, field):
+        value = self.get(field, _missing)
+        if value is _missing:
+            raise KeyError(field)
+        return value
+
+    def __setitem__(self, field, value):
+        self._board.set_field(self._scene_index, self._index, field, value)
+
+    def __contains__(self, field):
+        return field in self.keys()
+
+    def keys(self):
+        return self._board.image_fields(self._scene_index, self._index)
+
+
+def load_storyboard(json_path, on_scene=None):
+    """
+    Parse a scene JSON file into a Storyboard (see Storyboard.read).
+    """
+    return Storyboard().read(json_path, on_scene)
@@ -0,0 +1,168 @@
+"""
+Crash-safe, incremental saving of scene JSON files.
+
+Edits are appended to a small journal next to the JSON file (story.json.journal)
+as they happen, which is cheap however big the storyboard is. The full file is
+rewritten ("compacted") in the background a couple of seconds after the last
+edit, by writing a temp file and renaming it over the original, so the JSON is
+never left half-written. If the app dies before compaction, the journal is
+replayed the next time the file is loaded.
+
+The file is held as a scene_model.Storyboard, parsed a scene at a time, so the
+scenes already read can be used while a large file is still loading.
+"""
+import json
+import os
+import threading
+
+from scene_model import Storyboard
+
+COMPACT_DELAY = 2.0  # seconds of quiet before the JSON file is rewritten
+
+
+class SceneStore:
+    def __init__(self, json_path, compact_delay=COMPACT_DELAY):
+        self.json_path = os.path.abspath(json_path)
+        self.journal_path = self.json_path + '.journal'
+        self.compacting_path = self.json_path + '.journal.compacting'
+        self.compact_delay = compact_delay
+        self.board = Storyboard()
+        self.recovered = 0  # edits replayed from a journal on load
+
+        self._lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._journal = None
+        self._timer = None
+        self._dirty = False
+
+    @property
+    def scenes(self):
+        return self.board.scenes
+
+    @property
+    def loaded(self):
+        return self.board.done
+
+    def load(self):
+        """
+        Read the JSON file and replay any journal left by a crash. Raises ValueError for
+        invalid JSON. self.board fills in place as it goes, so another thread can show it
+        meanwhile and self.scenes taken before the load sees the loaded scenes.
+        """
+        self.board.read(self.json_path)
+
+        self.recovered = 0
+        for path in (self.compacting_path, self.journal_path):
+            self.recovered += self._replay(path)
+        if self.recovered:
+            self._dirty = True
+            self.compact()
+        return self.board
+
+    def _replay(self, path):
+        count = 0
+        try:
+            file = open(path, 'r', encoding='utf-8')
+        except FileNotFoundError:
+            return 0
+
+        with file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # the last line can be cut short by a crash
+                try:
+                    self._apply(entry)
+                    count += 1
+                except (IndexError, KeyError, TypeError):
+                    continue
+        return count
+
+    def _apply(self, entry):
+        self.board.set_field(entry['scene'], entry['image'], entry['field'], entry['value'])
+
+    def set_field(self, scene_index, image_index, field, value):
+        """
+        Change one field of one image. Returns at once; the JSON file is rewritten
+        later. Setting the value it already has is a no-op.
+        """
+        if self.board.get_field(scene_index, image_index, field) == value:
+            return False
+
+        entry = {'scene': scene_index, 'image': image_index, 'field': field, 'value': value}
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        with self._lock:
+            self.board.set_field(scene_index, image_index, field, value)
+            if self._journal is None:
+                self._journal = open(self.journal_path, 'a', encoding='utf-8')
+            self._journal.write(line)
+            self._journal.flush()
+            self._dirty = True
+            self._schedule()
+        return True
+
+    def set_description(self, scene_index, image_index, description):
+        return self.set_field(scene_index, image_index, 'image_description', description)
+
+    def _schedule(self):
+        # Restart the countdown so a burst of edits ends in one rewrite
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(self.compact_delay, self.compact)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def compact(self):
+        """
+        Rewrite the JSON file with every edit so far (write to temp, then rename).
+        """
+        with self._compact_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                self._dirty = False
+                # Start a fresh journal; edits made while we write go there
+                if self._journal is not None:
+                    self._journal.close()
+                    self._journal = None
+                if os.path.exists(self.journal_path):
+                    if os.path.exists(self.compacting_path):
+                        # A previous compaction failed: keep its edits too
+                        with open(self.journal_path, 'r', encoding='utf-8') as journal, \
+                                open(self.compacting_path, 'a', encoding='utf-8') as compacting:
+                            compacting.write(journal.read())
+                        os.remove(self.journal_path)
+                    else:
+                        os.replace(self.journal_path, self.compacting_path)
+
+            temp_path = f'{self.json_path}.{os.getpid()}.tmp'
+            try:
+                with open(temp_path, 'w', encoding='utf-8') as file:
+                    self.board.write(file)
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(temp_path, self.json_path)
+            except OSError:
+                with self._lock:
+                    self._dirty = True  # keep the journal; try again on the next edit or close
+                raise
+
+            try:
+                os.remove(self.compacting_path)
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        """
+        Write any pending edits now. Call before the app exits.
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        self.compact()
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
@@ -0,0 +1,409 @@
+"""
+Credit budgets and priorities for API calls.
+
+Every call that really goes to the API (not answered by the result cache or
+by an identical call already in flight) passes through the scheduler, which:
+
+- charges the call's credits (COSTS, per endpoint) to its run and to the day.
+  Credits are reserved before the call is sent, so concurrent calls can't
+  overshoot a hard budget together, and handed back if the call fails (the
+  API only charges for images). A call that only fits if one of those fails
+  waits for them to finish. Passing a soft budget prints a warning once;
+  a hard budget raises BudgetExceeded before the request goes out, and the
+  batch stops sending new jobs.
+- picks who goes next when calls wait for a slot: interactive before batch
+  before background, and between runs of the same class, weighted fair
+  queuing on credits (a run with weight 2 gets twice the credits per second
+  of a run with weight 1 while both have calls waiting). The GUI keeps a
+  slot free for interactive calls, so a click never waits behind a sweep.
+
+The day's spend is kept in credits.db in the output directory, so separate
+runs and processes share the daily budget (calls in flight in two processes
+at the same moment can overshoot it by those calls).
+
+forecast() gives the credits and time a list of jobs will take before it
+starts, leaving out results already in the cache.
+
+Example:
+    python batch_render.py story.json --budget 300 --soft-budget 200 --daily-budget 1000
+    python batch_render.py story.json --method "Image-to-Image" --reference ref.png --forecast
+"""
+import heapq
+import itertools
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date
+
+# Credits per successful call (Stability AI price list); --costs overrides them
+COSTS = {'core': 3.0, 'ultra': 8.0, 'structure': 3.0, 'outpaint': 4.0}
+
+# Seconds per call when there are no traces to go by
+LATENCIES = {'core': 6.0, 'ultra': 15.0, 'structure': 8.0, 'outpaint': 10.0}
+
+METHOD_ENDPOINTS = {
+    'Image Generation': 'core',
+    'Image-to-Image': 'ultra',
+    'Image with Structure': 'structure',
+    'Outpaint': 'outpaint',
+}
+
+PRIORITIES = {'interactive': 0, 'batch': 1, 'background': 2}
+
+_local = threading.local()
+
+
+class BudgetExceeded(RuntimeError):
+    pass
+
+
+class Run:
+    """
+    A flow of calls with its own budget and share of the slots (a batch, a sweep, GUI clicks).
+    """
+    def __init__(self, name, priority='batch', weight=1.0, budget=None, soft_budget=None):
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority: {priority} (use {', '.join(PRIORITIES)})")
+        if weight <= 0:
+            raise ValueError("A run's weight must be positive.")
+        self.name = name
+        self.priority = priority
+        self.weight = float(weight)
+        self.budget = budget
+        self.soft_budget = soft_budget
+        self.spent = 0.0
+        self.reserved = 0.0
+        self.calls = 0
+        self.stopped = None  # why the run can't send any more
+        self.warned = False
+        self.last_finish = 0.0  # fair-queuing finish tag of its latest call
+
+    def exhausted(self):
+        return self.stopped is not None
+
+
+@contextmanager
+def using(run):
+    """
+    Charge the API calls made on this thread inside the block to run.
+    """
+    previous = getattr(_local, 'run', None)
+    _local.run = run
+    try:
+        yield run
+    finally:
+        _local.run = previous
+
+
+def current_run():
+    return getattr(_local, 'run', None)
+
+
+class _Ticket:
+    def __init__(self, run, endpoint, cost, start, finish, sequence):
+        self.run = run
+        self.endpoint = endpoint
+        self.cost = cost
+        self.start = start
+        self.order = (PRIORITIES[run.priority], finish, sequence)
+        self.charged = False  # set by the caller once the API accepted the call
+
+    def __lt__(self, other):
+        return self.order < other.order
+
+
+class Scheduler:
+    def __init__(self, slots=None, interactive_reserve=0, daily_budget=None, daily_soft_budget=None,
+                 ledger_path=None, costs=None, on_warning=None):
+        self.slots = slots  # calls in flight at once; None for no limit (budgets still apply)
+        self.interactive_reserve = interactive_reserve  # slots batch work leaves free for clicks
+        self.daily_budget = daily_budget
+        self.daily_soft_budget = daily_soft_budget
+        self.ledger_path = ledger_path
+        self.costs = dict(COSTS, **(costs or {}))
+        self.on_warning = on_warning
+        self.warnings = []
+        self.default_run = Run('default')
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._in_flight = 0
+        self._reserved = 0.0
+        self._virtual = 0.0
+        self._sequence = itertools.count()
+        self._spent_by_day = {}  # without a ledger
+        self._warned_day = None
+        self._db = None
+
+    def cost(self, endpoint):
+        return self.costs.get(endpoint, 0.0)
+
+    def set_slots(self, slots):
+        with self._cond:
+            self.slots = slots
+            self._cond.notify_all()
+
+    def _ledger(self):
+        if self._db is None and self.ledger_path:
+            os.makedirs(os.path.dirname(self.ledger_path) or '.', exist_ok=True)
+            self._db = sqlite3.connect(self.ledger_path, check_same_thread=False, timeout=30)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS spend (time REAL, day TEXT, run TEXT, endpoint TEXT, credits REAL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS spend_day ON spend (day)')
+        return self._db
+
+    def spent_today(self):
+        """
+        Credits charged today, by every process sharing the ledger.
+        """
+        with self._cond:
+            return self._spent_today()
+
+    def _spent_today(self):
+        today = date.today().isoformat()
+        db = self._ledger()
+        if db is None:
+            return self._spent_by_day.get(today, 0.0)
+        return db.execute('SELECT COALESCE(SUM(credits), 0) FROM spend WHERE day = ?', (today,)).fetchone()[0]
+
+    def _over_budget(self, run, cost):
+        """
+        (reason, held) if the call would pass a hard budget, else None. held is True when only
+        credits reserved by calls in flight push it over, so it may fit once they're done.
+        """
+        if run.budget is not None and run.spent + run.reserved + cost > run.budget:
+            return f"run budget of {run.budget:g} credits reached", run.spent + cost <= run.budget
+        if self.daily_budget is not None and cost:
+            spent = self._spent_today()
+            if spent + self._reserved + cost > self.daily_budget:
+                return f"daily budget of {self.daily_budget:g} credits reached", spent + cost <= self.daily_budget
+        return None
+
+    def _reserve(self, run, cost):
+        # Called with the condition held
+        while True:
+            if run.stopped:
+                raise BudgetExceeded(run.stopped)
+            over = self._over_budget(run, cost)
+            if over is None:
+                break
+            reason, held = over
+            if not held:
+                run.stopped = reason
+                raise BudgetExceeded(reason)
+            # Wait for the calls in flight to be charged (then it's over for good) or handed back
+            self._cond.wait()
+        run.reserved += cost
+        self._reserved += cost
+
+    def _unreserve(self, ticket):
+        ticket.run.reserved -= ticket.cost
+        self._reserved -= ticket.cost
+
+    def _limit(self, ticket):
+        if ticket.run.priority == 'interactive':
+            return self.slots
+        return max(1, self.slots - self.interactive_reserve)
+
+    def acquire(self, endpoint, run=None):
+        """
+        Reserve the call's credits (BudgetExceeded if a hard budget would be passed) and wait
+        for its turn. Every acquire needs a release.
+        """
+        run = run or current_run() or self.default_run
+        cost = self.cost(endpoint)
+        with self._cond:
+            self._reserve(run, cost)
+            # Fair queuing: each call is stamped with when its run would finish it at its share
+            start = max(self._virtual, run.last_finish)
+            run.last_finish = start + cost / run.weight
+            ticket = _Ticket(run, endpoint, cost, start, run.last_finish, next(self._sequence))
+            if self.slots is not None:
+                heapq.heappush(self._waiting, ticket)
+                try:
+                    while self._waiting[0] is not ticket or self._in_flight >= self._limit(ticket):
+                        self._cond.wait()
+                except BaseException:
+                    self._waiting.remove(ticket)
+                    heapq.heapify(self._waiting)
+                    self._unreserve(ticket)
+                    self._cond.notify_all()
+                    raise
+                heapq.heappop(self._waiting)
+                self._virtual = max(self._virtual, ticket.start)
+                self._cond.notify_all()  # the next in line may have a slot too
+            self._in_flight += 1
+        return ticket
+
+    def release(self, ticket):
+        warnings = []
+        with self._cond:
+            self._in_flight -= 1
+            self._unreserve(ticket)
+            if ticket.charged:
+                run = ticket.run
+                run.spent += ticket.cost
+                run.calls += 1
+                self._charge(ticket)
+                if run.soft_budget is not None and run.spent >= run.soft_budget and not run.warned:
+                    run.warned = True
+                    warnings.append(f"{run.name}: {run.spent:g} credits spent, past the soft budget "
+                                    f"of {run.soft_budget:g}")
+                today = date.today().isoformat()
+                if self.daily_soft_budget is not None and self._warned_day != today:
+                    spent = self._spent_today()
+                    if spent >= self.daily_soft_budget:
+                        self._warned_day = today
+                        warnings.append(f"{spent:g} credits spent today, past the daily soft budget "
+                                        f"of {self.daily_soft_budget:g}")
+            self.warnings.extend(warnings)
+            self._cond.notify_all()
+        for warning in warnings:
+            if self.on_warning:
+                self.on_warning(warning)
+
+    def _charge(self, ticket):
+        today = date.today().isoformat()
+        db = self._ledger()
+        if db is None:
+            self._spent_by_day[today] = self._spent_by_day.get(today, 0.0) + ticket.cost
+            return
+        with db:
+            db.execute('INSERT INTO spend (time, day, run, endpoint, credits) VALUES (?, ?, ?, ?, ?)',
+                       (time.time(), today, ticket.run.name, ticket.endpoint, ticket.cost))
+
+    @contextmanager
+    def call(self, endpoint):
+        """
+        One API call: set ticket.charged = True inside the block if the API charged for it.
+        """
+        ticket = self.acquire(endpoint)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def close(self):
+        with self._cond:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+def job_endpoints(job):
+    """
+    The endpoints a job calls, in order (one per pipeline stage).
+    """
+    stages = job.get('pipeline') or [job]
+    return [METHOD_ENDPOINTS.get(stage.get('method', 'Image Generation'), 'core') for stage in stages]
+
+
+def recent_latencies(trace_path, limit=2000):
+    """
+    Median seconds per call for each endpoint, from the last `limit` traces of earlier runs.
+    """
+    samples = {}
+    try:
+        with open(trace_path, 'rb') as file:
+            file.seek(0, os.SEEK_END)
+            file.seek(max(0, file.tell() - limit * 600))
+            lines = file.read().splitlines()[-limit:]
+    except OSError:
+        return {}
+    for line in lines:
+        try:
+            trace = json.loads(line)
+        except ValueError:
+            continue  # the first, cut-off line
+        if trace.get('status') == 200 and not trace.get('cache') and 'total' in trace.get('phases', {}):
+            samples.setdefault(trace.get('endpoint'), []).append(trace['phases']['total'])
+    return {endpoint: sorted(values)[len(values) // 2] for endpoint, values in samples.items()}
+
+
+def forecast(jobs, concurrency=1, costs=None, latencies=None, cache=None, api_key=None):
+    """
+    What running jobs will cost: {'jobs', 'calls', 'cached', 'credits', 'seconds', 'endpoints'},
+    with endpoints mapping each endpoint to its {'calls', 'credits'}. With a ResultCache, jobs
+    whose image is already cached cost nothing. seconds assumes `concurrency` calls at a time.
+    """
+    from result_cache import request_key
+    from stability_api import build_request
+
+    costs = dict(COSTS, **(costs or {}))
+    latencies = dict(LATENCIES, **(latencies or {}))
+    result = {'jobs': len(jobs), 'calls': 0, 'cached': 0, 'credits': 0.0, 'seconds': 0.0, 'endpoints': {}}
+    busy = 0.0
+    for job in jobs:
+        if cache is not None and cache.enabled and not job.get('pipeline'):
+            try:
+                if cache.contains(request_key(build_request(api_key or 'forecast', job))):
+                    result['cached'] += 1
+                    continue
+            except (OSError, ValueError):
+                pass  # a missing reference fails the job later; count it as a call
+        for endpoint in job_endpoints(job):
+            totals = result['endpoints'].setdefault(endpoint, {'calls': 0, 'credits': 0.0})
+            totals['calls'] += 1
+            totals['credits'] += costs.get(endpoint, 0.0)
+            result['calls'] += 1
+            result['credits'] += costs.get(endpoint, 0.0)
+            busy += latencies.get(endpoint, max(LATENCIES.values()))
+    result['seconds'] = busy / max(1, concurrency)
+    return result
+
+
+def format_forecast(result):
+    """
+    One line per endpoint and a total, for printing before a run.
+    """
+    lines = []
+    for endpoint, totals in sorted(result['endpoints'].items()):
+        lines.append(f"  {endpoint}: {totals['calls']} calls, {totals['credits']:g} credits")
+    minutes, seconds = divmod(int(result['seconds'] + 0.5), 60)
+    hours, minutes = divmod(minutes, 60)
+    eta = f"{hours}h{minutes:02d}m" if hours else f"{minutes}m{seconds:02d}s"
+    lines.append(f"Forecast: {result['calls']} calls, {result['credits']:g} credits, about {eta}"
+                 + (f" ({result['cached']} jobs already cached)" if result['cached'] else ''))
+    return lines
+
+
+def load_costs(path):
+    """
+    A cost table from a JSON file like {"ultra": 8, "core": 3}.
+    """
+    with open(path, 'r', encoding='utf-8') as file:
+        costs = json.load(file)
+    if not isinstance(costs, dict) or not all(isinstance(value, (int, float)) for value in costs.values()):
+        raise ValueError(f"{path}: expected an object of endpoint: credits")
+    return {endpoint: float(value) for endpoint, value in costs.items()}
+
+
+def print_warning(text):
+    print(f"Warning: {text}", file=sys.stderr)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """
+    The scheduler every API call goes through. By default it only counts credits.
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler()
+        return _scheduler
+
+
+def configure_scheduler(**settings):
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is not None:
+            _scheduler.close()
+        _scheduler = Scheduler(**settings)
+        return _scheduler
@@ -0,0 +1,448 @@
+"""
+Perceptual-hash index of outputs, for near-duplicate detection and "find
+images that look like this one".
+
+Every output gets a 64-bit dHash (brightness gradients of a 9x8 thumbnail)
+and a 64-bit pHash (signs of the low 8x8 DCT coefficients of a 32x32
+thumbnail). Similar-looking images have hashes a few bits apart, whatever
+their file size or format. Hashes are computed with NumPy over batches of
+32x32 grayscale thumbnails and stored in the "hashes" table of index.db,
+keyed by path, size and mtime, so an update only hashes new or changed files.
+record_output() queues each saved image for a background thread that hashes
+them in batches (image_index.hash_later), so decoding stays off the request
+threads; find and dupes run an update first for anything that was missed.
+
+Lookups by Hamming distance go through a BK-tree built on first use, so a
+search over 100k images only visits the branches that can hold a match.
+
+Example:
+    python similarity.py update
+    python similarity.py find generated_images/scene_3_image_1_2024-10-01_12-00-00.png -k 6
+    python similarity.py dupes --scene 3 -k 4            # list near-duplicates
+    python similarity.py dupes --scene 3 -k 4 --prune    # delete all but the first of each group
+"""
+import argparse
+import io
+import os
+import sqlite3
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from image_index import get_index, is_copy
+from output_sink import scan_outputs
+from postprocess import is_derived
+
+HASH_POSITION = {'dhash': 0, 'phash': 1}  # hashes are (dhash, phash) pairs
+DCT_SIZE = 32  # images are reduced to 32x32 grayscale before hashing
+DEFAULT_DISTANCE = 6
+BATCH = 256
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    dhash INTEGER NOT NULL,
+    phash INTEGER NOT NULL,
+    duplicate_of TEXT
+);
+"""
+
+
+def _box_matrix(out_size, in_size):
+    # Row i averages the inputs it covers, with fractional weights at the edges
+    weights = np.zeros((out_size, in_size), dtype=np.float32)
+    scale = in_size / out_size
+    for i in range(out_size):
+        start, end = i * scale, (i + 1) * scale
+        for j in range(int(start), int(np.ceil(end))):
+            weights[i, j] = min(end, j + 1) - max(start, j)
+    return weights / scale
+
+
+def _dct_matrix(size):
+    k = np.arange(size)[:, None]
+    n = np.arange(size)[None, :]
+    matrix = np.cos(np.pi * (2 * n + 1) * k / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+
+_ROWS = _box_matrix(8, DCT_SIZE)
+_COLUMNS = _box_matrix(9, DCT_SIZE)
+_DCT = _dct_matrix(DCT_SIZE)
+
+
+def load_gray(source):
+    """
+    A 32x32 float32 grayscale thumbnail of an image file path or encoded bytes.
+    """
+    with Image.open(io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source) as img:
+        img.draft('L', (2 * DCT_SIZE, 2 * DCT_SIZE))  # JPEGs decode straight to a small size
+        small = img.convert('L').resize((DCT_SIZE, DCT_SIZE), Image.BOX, reducing_gap=2.0)
+    return np.asarray(small, dtype=np.float32)
+
+
+def _pack(bits):
+    packed = np.packbits(bits.reshape(len(bits), 64), axis=1)
+    return packed.view('>u8').ravel().tolist()
+
+
+def hash_arrays(grays):
+    """
+    dHash and pHash for a stack of 32x32 thumbnails, all at once. Returns ([dhash], [phash]).
+    """
+    grays = np.asarray(grays, dtype=np.float32).reshape(-1, DCT_SIZE, DCT_SIZE)
+    small = _ROWS @ grays @ _COLUMNS.T  # (n, 8, 9)
+    dhash = small[:, :, 1:] > small[:, :, :-1]
+
+    low = (_DCT @ grays @ _DCT.T)[:, :8, :8].reshape(len(grays), 64)
+    median = np.median(low[:, 1:], axis=1, keepdims=True)  # the DC term would skew it
+    phash = low > median
+    return _pack(dhash), _pack(phash)
+
+
+def image_hashes(source):
+    """
+    (dhash, phash) of one image file path or encoded bytes.
+    """
+    dhash, phash = hash_arrays(load_gray(source)[None])
+    return dhash[0], phash[0]
+
+
+def distance(a, b):
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over 64-bit hashes under Hamming distance. Each node keeps
+    the items with exactly its hash and its children by distance.
+    """
+    def __init__(self):
+        self.root = None  # [hash, items, {distance: child}]
+        self.size = 0
+
+    def add(self, value, item):
+        self.size += 1
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+        node = self.root
+        while True:
+            d = distance(value, node[0])
+            if d == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [value, [item], {}]
+                return
+            node = child
+
+    def search(self, value, k):
+        """
+        Every (distance, item) within k of value, nearest first.
+        """
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            d = distance(value, node[0])
+            if d <= k:
+                found.extend((d, item) for item in node[1])
+            # The triangle inequality rules out every child outside [d - k, d + k]
+            for child_distance, child in node[2].items():
+                if d - k <= child_distance <= d + k:
+                    stack.append(child)
+        found.sort()
+        return found
+
+
+def _to_db(value):
+    return value - (1 << 64) if value >= 1 << 63 else value  # SQLite integers are signed
+
+
+def _from_db(value):
+    return value & ((1 << 64) - 1)
+
+
+class HashIndex:
+    def __init__(self, db_path):
+        self.db_path = str(db_path)
+        Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+        self._hashes = None  # path -> (dhash, phash), loaded with the trees
+        self._trees = {}
+
+    def _store(self, rows):
+        # rows are (path, size, mtime, dhash, phash)
+        with self._lock:
+            with self._db:
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO hashes (path, size, mtime, dhash, phash) VALUES (?, ?, ?, ?, ?)',
+                    [(path, size, mtime, _to_db(dhash), _to_db(phash)) for path, size, mtime, dhash, phash in rows])
+            if self._hashes is None:
+                return
+            if any(path in self._hashes for path, _, _, _, _ in rows):
+                # A BK-tree can't drop the old hash of a changed file, so build the trees again
+                self._hashes = None
+                self._trees = {}
+                return
+            for path, _, _, dhash, phash in rows:
+                self._hashes[path] = (dhash, phash)
+                for kind, tree in self._trees.items():
+                    tree.add((dhash, phash)[HASH_POSITION[kind]], path)
+
+    def add(self, path, content=None):
+        """
+        Hash one image (from content if given, else from the file) and store it.
+        """
+        path = str(path)
+        stat = os.stat(path)
+        dhash, phash = image_hashes(content if content is not None else path)
+        self._store([(path, stat.st_size, stat.st_mtime, dhash, phash)])
+        return dhash, phash
+
+    def add_many(self, paths):
+        """
+        Hash the images at paths in one batch and store them. Returns (path, error) for
+        each one that couldn't be read.
+        """
+        rows, grays, failed = [], [], []
+        for path in map(str, paths):
+            try:
+                stat = os.stat(path)
+                grays.append(load_gray(path))
+            except (OSError, ValueError) as e:
+                failed.append((path, e))
+                continue
+            rows.append((path, stat.st_size, stat.st_mtime))
+        if rows:
+            dhashes, phashes = hash_arrays(np.stack(grays))
+            self._store([(path, size, mtime, dhash, phash)
+                         for (path, size, mtime), dhash, phash in zip(rows, dhashes, phashes)])
+        return failed
+
+    def update(self, output_dir, workers=4):
+        """
+        Hash PNG outputs in output_dir (and its shard directories) that are new or changed and forget files that are gone.
+        Returns (hashed, removed).
+        """
+        with self._lock:
+            known = {row[0]: (row[1], row[2]) for row in self._db.execute('SELECT path, size, mtime FROM hashes')}
+
+        todo = []
+        seen = set()
+        for directory, entries in scan_outputs(output_dir):
+            names = {entry.name for entry in entries}
+            for entry in entries:
+                if not entry.name.lower().endswith('.png') or is_copy(entry.name, names) or is_derived(entry.name):
+                    continue
+                path = f'{directory}/{entry.name}'
+                seen.add(path)
+                stat = entry.stat()
+                if known.get(path) != (stat.st_size, stat.st_mtime):
+                    todo.append((path, stat.st_size, stat.st_mtime))
+
+        # Decoding dominates; PIL releases the GIL while it decodes, so threads overlap it
+        hashed = 0
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for start in range(0, len(todo), BATCH):
+                batch = todo[start:start + BATCH]
+                grays = list(pool.map(_try_load_gray, [path for path, _, _ in batch]))
+                ok = [(item, gray) for item, gray in zip(batch, grays) if gray is not None]
+                if not ok:
+                    continue
+                dhashes, phashes = hash_arrays(np.stack([gray for _, gray in ok]))
+                self._store([(path, size, mtime, dhash, phash)
+                             for ((path, size, mtime), _), dhash, phash in zip(ok, dhashes, phashes)])
+                hashed += len(ok)
+
+        gone = [path for path in known if path not in seen and not os.path.exists(path)]
+        self.forget(gone)
+        return hashed, len(gone)
+
+    def forget(self, paths):
+        if not paths:
+            return
+        with self._lock:
+            with self._db:
+                self._db.executemany('DELETE FROM hashes WHERE path = ?', [(path,) for path in paths])
+            # A BK-tree can't drop items, so build the trees again on the next search
+            self._hashes = None
+            self._trees = {}
+
+    def hashes(self, path):
+        """
+        (dhash, phash) stored for path, or None.
+        """
+        with self._lock:
+            row = self._db.execute('SELECT dhash, phash FROM hashes WHERE path = ?', (str(path),)).fetchone()
+        return (_from_db(row[0]), _from_db(row[1])) if row else None
+
+    def _tree(self, kind):
+        # Called with the lock held
+        if self._hashes is None:
+            self._hashes = {path: (_from_db(dhash), _from_db(phash)) for path, dhash, phash in
+                            self._db.execute('SELECT path, dhash, phash FROM hashes')}
+        if kind not in self._trees:
+            tree = BKTree()
+            for path, values in self._hashes.items():
+                tree.add(values[HASH_POSITION[kind]], path)
+            self._trees[kind] = tree
+        return self._trees[kind]
+
+    def search(self, value, k=DEFAULT_DISTANCE, kind='phash'):
+        """
+        (distance, path) of every indexed image within Hamming distance k of the hash value.
+        """
+        with self._lock:
+            return self._tree(kind).search(value, k)
+
+    def similar(self, path, k=DEFAULT_DISTANCE, kind='phash'):
+        """
+        Images that look like the one at path (which needn't be indexed), nearest first.
+        """
+        values = self.hashes(path) or image_hashes(str(path))
+        value = values[HASH_POSITION[kind]]
+        # Indexed paths are spelled as saved (output_dir/name); compare the files, not the strings
+        same = os.path.realpath(path)
+        return [(d, other) for d, other in self.search(value, k, kind) if os.path.realpath(other) != same]
+
+    def groups(self, paths, k=DEFAULT_DISTANCE, kind='phash'):
+        """
+        Split paths into groups of near-duplicates (each within k of the group's first
+        image). The first path of each group is the one to keep; singletons are left out.
+        """
+        position = HASH_POSITION[kind]
+        tree = BKTree()
+        order = []
+        for path in paths:
+            values = self.hashes(path)
+            if values is not None:
+                tree.add(values[position], path)
+                order.append((path, values[position]))
+
+        grouped = set()
+        groups = []
+        for path, value in order:
+            if path in grouped:
+                continue
+            group = [path] + [other for _, other in tree.search(value, k) if other != path and other not in grouped]
+            if len(group) > 1:
+                grouped.update(group)
+                groups.append(group)
+        return groups
+
+    def flag(self, groups):
+        """
+        Record duplicate_of for every image but the first of each group.
+        """
+        with self._lock:
+            with self._db:
+                self._db.executemany('UPDATE hashes SET duplicate_of = ? WHERE path = ?',
+                                     [(group[0], path) for group in groups for path in group[1:]])
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def _try_load_gray(path):
+    try:
+        return load_gray(path)
+    except (OSError, ValueError):
+        return None  # unreadable or half-written file: skipped until the next update
+
+
+_hash_indexes = {}
+_hash_indexes_lock = threading.Lock()
+
+
+def get_hash_index(output_dir='generated_images'):
+    """
+    The hash index stored alongside the image index in output_dir/index.db.
+    """
+    with _hash_indexes_lock:
+        if output_dir not in _hash_indexes:
+            _hash_indexes[output_dir] = HashIndex(os.path.join(output_dir, 'index.db'))
+        return _hash_indexes[output_dir]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Find near-duplicate and similar outputs by perceptual hash.")
+    parser.add_argument('--output-dir', default='generated_images')
+    parser.add_argument('--hash', choices=sorted(HASH_POSITION), default='phash', help="Hash to compare (default: phash)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    update = commands.add_parser('update', help="Hash new and changed outputs")
+    update.add_argument('--workers', type=int, default=4)
+
+    find = commands.add_parser('find', help="Images within distance k of an image")
+    find.add_argument('image')
+    find.add_argument('-k', type=int, default=DEFAULT_DISTANCE, help="Largest Hamming distance (of 64 bits)")
+
+    dupes = commands.add_parser('dupes', help="Groups of near-duplicates, e.g. within one scene")
+    dupes.add_argument('--scene', type=int, help="1-based scene number (default: every output)")
+    dupes.add_argument('--json-file', help="Only images made from this scene file")
+    dupes.add_argument('-k', type=int, default=4, help="Largest Hamming distance (of 64 bits)")
+    dupes.add_argument('--flag', action='store_true', help="Record each duplicate's original in index.db")
+    dupes.add_argument('--prune', action='store_true', help="Delete all but the first image of each group")
+
+    args = parser.parse_args(argv)
+    index = get_hash_index(args.output_dir)
+
+    if args.command == 'update':
+        hashed, removed = index.update(args.output_dir, args.workers)
+        print(f"Hashed {hashed} images, forgot {removed} deleted ones")
+        return 0
+
+    index.update(args.output_dir)
+    if args.command == 'find':
+        try:
+            matches = index.similar(args.image, args.k, args.hash)
+        except OSError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            return 2
+        for d, path in matches:
+            print(f"{d:2d}  {path}")
+        return 0
+
+    # Oldest first, so the first of each group is the original and later reruns are the duplicates
+    images = get_index(args.output_dir)
+    images.rebuild(args.output_dir)  # files saved before the index existed
+    rows = images.query(scene=args.scene, json_file=args.json_file)
+    paths = [row['path'] for row in reversed(rows)
+             if Path(args.output_dir) in Path(row['path']).parents and os.path.exists(row['path'])]
+    groups = index.groups(paths, args.k, args.hash)
+    for group in groups:
+        print(f"keep {group[0]}")
+        for path in group[1:]:
+            print(f"  {'deleted' if args.prune else 'duplicate'} {path}")
+    duplicates = [path for group in groups for path in group[1:]]
+    if args.flag:
+        index.flag(groups)
+    if args.prune:
+        saved = 0
+        for path in duplicates:
+            saved += os.path.getsize(path)
+            os.remove(path)
+        index.forget(duplicates)
+        images.forget(duplicates)
+        print(f"Deleted {len(duplicates)} near-duplicates of {len(paths)} images ({saved / 1024 ** 2:.1f} MB)")
+    else:
+        print(f"{len(duplicates)} near-duplicates in {len(groups)} groups of {len(paths)} images")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,185 @@
+"""
+Single-flight coalescing of identical API requests.
+
+Storyboards repeat prompts (title cards, recurring establishing shots) and a
+batch or sweep can contain the same parameter set twice. While a request is
+in flight, any other request with the same result cache key waits for it and
+gets its response instead of calling the API again. Each requester still
+saves its own output file under its own name.
+
+Across processes that share an output directory, whoever sends a key first
+holds a lock file next to the result cache (.cache/inflight/<key>.lock). The
+others wait for the lock to go away and then find the image in the cache, so
+only one run pays for it. A lock older than LOCK_STALE seconds, or one left
+by a process that no longer exists, is taken over.
+
+Requests with seed 0 (a random seed) have no key and are never coalesced.
+"""
+import os
+import socket
+import threading
+import time
+from pathlib import Path
+
+LOCK_STALE = 300.0  # longer than any request with all its retries
+LOCK_POLL = 0.2
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self, enabled=True, stale=LOCK_STALE, poll=LOCK_POLL):
+        self.enabled = enabled
+        self.stale = stale
+        self.poll = poll
+        self.requests = 0
+        self.coalesced = 0  # answered by a call already in flight in this process
+        self.shared = 0  # answered by another process's call, through the cache
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, send, lock_dir=None):
+        """
+        Call send() unless a call for the same key is already running, in which case
+        wait for it. Returns (response, coalesced). With lock_dir, also waits for other
+        processes sending the same key; send() is expected to find their result cached.
+        """
+        with self._lock:
+            self.requests += 1
+            if not self.enabled or key is None:
+                call = None
+            else:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = _Call()
+                else:
+                    call.waiters += 1
+        if call is None:
+            return send(), False
+
+        if not leader:
+            call.done.wait()
+            with self._lock:
+                self.coalesced += 1
+            if call.error is not None:
+                raise call.error
+            return call.response, True
+
+        try:
+            call.response = self._send_locked(key, send, lock_dir)
+            with self._lock:
+                # No one can join from here on, so the waiters are known
+                del self._calls[key]
+                waiters = call.waiters
+            if waiters and getattr(call.response, 'streamed', False):
+                # A streamed body can only be read once: read it now for everyone
+                call.response.content
+                call.response.streamed = False
+            return call.response, False
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            call.done.set()
+
+    def _send_locked(self, key, send, lock_dir):
+        if lock_dir is None:
+            return send()
+
+        path = Path(lock_dir) / f'{key}.lock'
+        waited = self._acquire(path)
+        try:
+            response = send()
+        finally:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+        if waited and getattr(response, 'from_cache', False):
+            with self._lock:
+                self.shared += 1
+        return response
+
+    def _acquire(self, path):
+        """
+        Create the lock file, waiting while another process holds it. Returns True if it had to wait.
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        waited = False
+        while True:
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if self._is_stale(path):
+                    try:
+                        path.unlink()
+                    except OSError:
+                        pass
+                    continue
+                waited = True
+                time.sleep(self.poll)
+                continue
+            with os.fdopen(fd, 'w') as file:
+                file.write(f'{socket.gethostname()} {os.getpid()}')
+            return waited
+
+    def _is_stale(self, path):
+        try:
+            if time.time() - path.stat().st_mtime > self.stale:
+                return True
+            host, pid = path.read_text().split()
+        except (OSError, ValueError):
+            return False  # just released, or not written yet
+        if host != socket.gethostname() or os.name == 'nt':
+            return False  # can't see the owner; wait for the timeout
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except (OSError, ValueError):
+            pass
+        return False
+
+    def stats(self):
+        with self._lock:
+            deduplicated = self.coalesced + self.shared
+            return {
+                'requests': self.requests,
+                'coalesced': self.coalesced,
+                'shared': self.shared,
+                'dedup_rate': deduplicated / self.requests if self.requests else 0.0,
+                'enabled': self.enabled,
+            }
+
+
+_flight = None
+_flight_lock = threading.Lock()
+
+
+def get_single_flight():
+    """
+    The coalescer shared by every post_request call.
+    Set STABLECANVAS_NO_DEDUP=1 to send every request separately.
+    """
+    global _flight
+    with _flight_lock:
+        if _flight is None:
+            _flight = SingleFlight(enabled=not os.environ.get('STABLECANVAS_NO_DEDUP'))
+        return _flight
+
+
+def configure_single_flight(**settings):
+    global _flight
+    with _flight_lock:
+        _flight = SingleFlight(**settings)
+        return _flight
@@ -0,0 +1,333 @@
+"""
+Request building and output naming for the Stability AI endpoints.
+
+Shared by the GUI (Stable9.0.py) and the headless batch renderer so both send
+exactly the same multipart fields and name their outputs the same way.
+"""
+import hashlib
+import os
+import time
+from datetime import datetime
+
+import metrics
+from http_client import get_client
+from key_pool import get_key_pool
+from output_sink import CHUNK_SIZE, get_sink, write_chunks
+from reference_cache import prepare_image, prepare_reference
+from result_cache import CachedResponse, get_cache, request_key
+from scheduler import get_scheduler
+from single_flight import get_single_flight
+
+# URLs for the Stability AI API (STABILITY_API_BASE points them at another server, e.g. mock_server.py)
+API_BASE = os.environ.get('STABILITY_API_BASE', 'https://api.stability.ai').rstrip('/')
+core_url = f'{API_BASE}/v2beta/stable-image/generate/core' #  Stable Image Core API URL
+image_to_image_url = f'{API_BASE}/v2beta/stable-image/generate/ultra' # Stable Image Ultra Image-to-image API URL
+structure_url = f'{API_BASE}/v2beta/stable-image/control/structure' # Structure API URL
+outpaint_url = f'{API_BASE}/v2beta/stable-image/edit/outpaint'  # Outpaint API URL
+
+
+def set_api_base(base):
+    """
+    Send every request to another server from now on.
+    """
+    global API_BASE, core_url, image_to_image_url, structure_url, outpaint_url
+    API_BASE = base.rstrip('/')
+    core_url = f'{API_BASE}/v2beta/stable-image/generate/core'
+    image_to_image_url = f'{API_BASE}/v2beta/stable-image/generate/ultra'
+    structure_url = f'{API_BASE}/v2beta/stable-image/control/structure'
+    outpaint_url = f'{API_BASE}/v2beta/stable-image/edit/outpaint'
+
+
+METHODS = ['Image Generation', 'Image-to-Image', 'Image with Structure', 'Outpaint']
+
+# Part of the filename that tells the methods apart
+METHOD_TAGS = {
+    'Image Generation': '',
+    'Image-to-Image': '_sample_1',
+    'Image with Structure': '_structure',
+    'Outpaint': '_outpaint',
+}
+
+# Largest reference image we upload to each endpoint
+REFERENCE_MAX_SIZE = (1536, 1536)
+REFERENCE_LIMITS = {
+    'Image-to-Image': REFERENCE_MAX_SIZE,
+    'Image with Structure': REFERENCE_MAX_SIZE,
+    'Outpaint': REFERENCE_MAX_SIZE,
+}
+
+
+# MIME type sent with each kind of reference image
+MIME_TYPES = {'.png': 'image/png', '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.webp': 'image/webp'}
+
+
+def check_strength(value, name='Image Strength'):
+    """
+    Convert a strength value to float and make sure it is between 0 and 1.
+    Raises ValueError with a message that can be shown to the user.
+    """
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be a numeric value.")
+
+    if not (0 <= value <= 1):
+        raise ValueError(f"{name} must be between 0 and 1.")
+    return value
+
+
+def make_filename(output_dir, suffix, method='Image Generation', scene_index=None, image_index=None, seed=0, timestamp=None):
+    """
+    Build the output filename the same way the GUI always has.
+    scene_index and image_index are 0-based; without them the name is based on the seed.
+    """
+    if timestamp is None:
+        timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+
+    tag = METHOD_TAGS.get(method, '')
+    if scene_index is not None and image_index is not None:
+        return f"{output_dir}/scene_{scene_index + 1}_image_{image_index + 1}{tag}_{timestamp}{suffix}"
+    return f"{output_dir}/generated_image_{int(seed)}{tag}_{timestamp}{suffix}"
+
+
+def save_output(filename, content, params=None, content_type=None):
+    """
+    Save an output through the configured sink (see output_sink.py): written to a
+    temporary file, checked against content_type and the image signature, then
+    renamed into place without overwriting anything. If the name is taken (two
+    outputs in the same second) a counter is added, e.g. ..._12-00-01_2.png.
+    content is bytes, or a function that writes to the open file (for outputs too
+    big to hold in memory). params (the job) picks the shard directory. Returns the
+    name actually used; raises ValueError if the content isn't an image.
+    """
+    return get_sink().save(filename, content, params, content_type)
+
+
+def response_body(response, suffix='.png'):
+    """
+    What to pass save_output() for a response: its bytes if they have been read (cache
+    hits, shared results), else a writer that copies the body into the output file as
+    it downloads, so the image is never held in memory whole. The writer rejects a
+    non-image on the first chunk and sets response.size once done.
+    """
+    if not getattr(response, 'streamed', False):
+        return response.content
+
+    def write(file):
+        started = time.perf_counter()
+        try:
+            response.size = write_chunks(file, response.iter_content(CHUNK_SIZE), suffix)
+        finally:
+            response.close()
+        # save_output times the whole copy as 'write'; most of it is the download
+        elapsed = time.perf_counter() - started
+        metrics.add_phase('download', elapsed)
+        metrics.add_phase('write', -elapsed)
+        metrics.annotate(bytes=response.size)
+    return write
+
+
+def read_reference(reference_image_path, method=None):
+    """
+    Return (bytes, file_extension) ready to upload, resized in memory if it's too large
+    for the method's endpoint. Prepared bytes are cached, so reusing a reference is free.
+    """
+    max_size = REFERENCE_LIMITS.get(method, REFERENCE_MAX_SIZE)
+    with metrics.timed('reference'):
+        return prepare_reference(reference_image_path, max_size)
+
+
+def reference_from_bytes(image_bytes, method=None, file_extension='.png'):
+    """
+    Like read_reference, for image bytes already in memory (e.g. a previous response).
+    """
+    max_size = REFERENCE_LIMITS.get(method, REFERENCE_MAX_SIZE)
+    with metrics.timed('reference'):
+        return prepare_image(image_bytes, file_extension, max_size), file_extension
+
+
+def _headers(api_key):
+    headers = {'Accept': 'image/*'}  # Accept raw image response
+    if api_key:
+        headers['Authorization'] = f'Bearer {api_key}'
+    # Without a key, post_request takes one from the key pool for each attempt
+    return headers
+
+
+def build_core_request(api_key, prompt, seed='', negative_prompt=''):
+    files = {
+        'prompt': (None, prompt),
+        'negative_prompt': (None, negative_prompt),
+        'output_format': (None, 'png'),
+        'size': (None, '1024x1024'),
+        'seed': (None, str(seed))
+    }
+    return {'url': core_url, 'headers': _headers(api_key), 'files': files, 'data': None}
+
+
+def build_image_to_image_request(api_key, prompt, image_bytes, file_extension, seed=0, image_strength=0.5, negative_prompt=''):
+    files = {
+        'image': ('reference' + file_extension, image_bytes, MIME_TYPES.get(file_extension))
+    }
+    data = {
+        'prompt': prompt,
+        'strength': str(image_strength),
+        'output_format': 'png',
+        'aspect_ratio': '1:1',
+        'seed': str(seed),
+        'negative_prompt': negative_prompt
+    }
+    return {'url': image_to_image_url, 'headers': _headers(api_key), 'files': files, 'data': data}
+
+
+def build_structure_request(api_key, prompt, image_bytes, file_extension, control_strength=0.5, seed='', negative_prompt=''):
+    files = {
+        'image': ('reference' + file_extension, image_bytes, MIME_TYPES.get(file_extension))
+    }
+    data = {
+        'prompt': prompt,
+        'negative_prompt': negative_prompt,
+        'output_format': 'png',
+        'size': '1024x1024',
+        'control_strength': str(control_strength),
+        'seed': str(seed)
+    }
+    return {'url': structure_url, 'headers': _headers(api_key), 'files': files, 'data': data}
+
+
+def build_outpaint_request(api_key, image_bytes, file_extension, left, right, up, down, prompt='', seed=''):
+    files = {
+        'image': ('reference' + file_extension, image_bytes, MIME_TYPES.get(file_extension))
+    }
+    data = {
+        'left': str(left),
+        'right': str(right),
+        'up': str(up),
+        'down': str(down),
+        'prompt': prompt,
+        'seed': str(seed),
+        'output_format': 'png',  # Specify the desired output format
+        'creativity': '0.7'  # Optional: adjust creativity
+    }
+    return {'url': outpaint_url, 'headers': _headers(api_key), 'files': files, 'data': data}
+
+
+def build_request(api_key, params):
+    """
+    Build the request for one job.
+    params is a dict with 'method', 'prompt', 'seed', 'negative_prompt' and, depending
+    on the method, 'reference_image', 'image_strength', 'control_strength',
+    'left', 'right', 'up', 'down'. 'reference_bytes' (PNG bytes) takes the place of
+    'reference_image' when a pipeline stage feeds the next one.
+    """
+    method = params.get('method', 'Image Generation')
+    prompt = params.get('prompt', '')
+    seed = params.get('seed', 0)
+    negative_prompt = params.get('negative_prompt', '')
+
+    if method == 'Image Generation':
+        return build_core_request(api_key, prompt, seed, negative_prompt)
+    if method not in METHODS:
+        raise ValueError(f"Unknown generation method: {method}")
+
+    if params.get('reference_bytes') is not None:
+        # Output of an earlier pipeline stage, handed over in memory
+        image_bytes, file_extension = reference_from_bytes(params['reference_bytes'], method)
+    else:
+        reference_image_path = params.get('reference_image')
+        if not reference_image_path:
+            raise ValueError(f"{method} needs a reference image.")
+        image_bytes, file_extension = read_reference(reference_image_path, method)
+
+    if method == 'Image-to-Image':
+        image_strength = check_strength(params.get('image_strength', 0.5), 'Image Strength')
+        return build_image_to_image_request(api_key, prompt, image_bytes, file_extension, seed, image_strength, negative_prompt)
+    if method == 'Image with Structure':
+        control_strength = check_strength(params.get('control_strength', 0.5), 'Control Strength')
+        return build_structure_request(api_key, prompt, image_bytes, file_extension, control_strength, seed, negative_prompt)
+    return build_outpaint_request(api_key, image_bytes, file_extension,
+                                  int(params.get('left') or 0), int(params.get('right') or 0),
+                                  int(params.get('up') or 0), int(params.get('down') or 0),
+                                  prompt, seed)
+
+
+def request_fields(request):
+    """
+    The fields of a built request as a JSON-friendly dict, with uploads replaced by
+    their name, size and SHA-256. The API key (in the headers) is not included.
+    """
+    fields = {}
+    for name, value in list((request.get('data') or {}).items()) + list((request.get('files') or {}).items()):
+        if isinstance(value, tuple) and len(value) >= 2 and isinstance(value[1], (bytes, bytearray)):
+            fields[name] = {'filename': value[0], 'size': len(value[1]),
+                            'sha256': hashlib.sha256(value[1]).hexdigest()}
+        elif isinstance(value, tuple):
+            fields[name] = value[1]
+        else:
+            fields[name] = value
+    return fields
+
+
+def endpoint_name(url):
+    """
+    Short endpoint label for metrics: 'core', 'ultra', 'structure' or 'outpaint'.
+    """
+    return url.rstrip('/').rsplit('/', 1)[-1]
+
+
+def post_request(request, timeout=None, use_cache=True, stream=False):
+    """
+    Send a built request through the shared client (pooled connections, retries).
+    Identical requests are answered from the result cache without calling the API,
+    and one already in flight is waited for, not repeated: in this process even with
+    use_cache off, and in other processes through the cache.
+    The calls that do reach the API are charged to the current run's credit budget and
+    take their turn by priority (see scheduler.py).
+    A request built without an API key uses the shared key pool.
+    With stream, a response that isn't going into the cache is left unread for
+    response_body() to copy to its file in chunks.
+    """
+    started = time.perf_counter()
+    metrics.annotate(endpoint=endpoint_name(request['url']))
+    cache = get_cache()
+    # Only STABLECANVAS_NO_DEDUP turns coalescing off; waiting on other processes needs the cache
+    key = request_key(request)
+    cache_key = key if use_cache and cache.enabled else None
+    lock_dir = cache.cache_dir / 'inflight' if cache_key is not None else None
+
+    response, coalesced = get_single_flight().run(key, lambda: _send(request, timeout, cache, cache_key, stream), lock_dir)
+    if coalesced:
+        # Every requester gets its own copy, so latency etc. can be set per request
+        metrics.annotate(cache='coalesced', status=response.status_code, bytes=len(response.content))
+        shared = CachedResponse(response.content)
+        shared.status_code = response.status_code
+        shared.text = response.text
+        shared.headers = response.headers
+        shared.from_cache = False
+        shared.coalesced = True
+        response = shared
+    response.latency = time.perf_counter() - started
+    return response
+
+
+def _send(request, timeout, cache, key, stream=False):
+    if key is not None:
+        content = cache.get(key)
+        if content is not None:
+            metrics.annotate(cache='hit', status=200, bytes=len(content))
+            return CachedResponse(content)
+
+    key_pool = None
+    if 'Authorization' not in request['headers']:
+        key_pool = get_key_pool()
+        if key_pool is None:
+            raise ValueError("No API key: enter one, or set STABILITY_API_KEYS / STABILITY_API_KEYS_FILE.")
+    # Only calls that reach the API are charged and queued by priority
+    with get_scheduler().call(endpoint_name(request['url'])) as ticket:
+        response = get_client().post(request['url'], headers=request['headers'], files=request['files'],
+                                     data=request['data'], timeout=timeout, key_pool=key_pool,
+                                     stream=stream and key is None)  # a cache put needs the whole body
+        ticket.charged = response.status_code == 200
+    if key is not None and response.status_code == 200 and 'image' in response.headers.get('Content-Type', ''):
+        cache.put(key, response.content)
+    return response
@@ -0,0 +1,263 @@
+"""
+Seed and parameter sweeps.
+
+A sweep takes one prompt (typically the current scene/image) and a grid of
+seeds, image strengths, control strengths and outpaint margins, renders every
+combination concurrently and lays the results out on a labeled contact sheet.
+
+Example:
+    python sweep.py story.json --scene 3 --image 2 --seeds 1-16 --image-strengths 0.3,0.5,0.7 \\
+        --method Image-to-Image --reference ref.png --concurrency 16
+"""
+import argparse
+import itertools
+import os
+import re
+import sys
+import time
+from datetime import datetime
+
+from batch_render import (add_budget_arguments, configure_budget, print_dedup, print_forecast, print_spend, render_jobs,
+                          tally)
+from engine import load_scenes
+from http_client import configure_client
+from key_pool import configure_key_pool, get_key_pool, load_keys
+from output_sink import LAYOUTS, configure_sink
+from result_cache import configure_cache
+from run_journal import RunJournal, run_path
+from stability_api import METHODS
+
+TILE_SIZE = 256
+LABEL_HEIGHT = 20
+INT_RANGE = re.compile(r'^(-?\d+)-(-?\d+)$')
+
+
+def parse_values(text, cast=float):
+    """
+    Parse "1,2,5-8" (integer ranges) or "0.2:0.8:0.2" (start:stop:step, stop included)
+    into a list. None or "" gives None.
+    """
+    if not text:
+        return None
+
+    values = []
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if ':' in part:
+            start, stop, step = (float(v) for v in part.split(':'))
+            if step <= 0:
+                raise ValueError(f"Step must be positive: {part}")
+            count = int(round((stop - start) / step)) + 1
+            values.extend(cast(round(start + i * step, 6)) for i in range(max(0, count)))
+        elif cast is int and INT_RANGE.match(part):
+            start, stop = INT_RANGE.match(part).groups()
+            values.extend(range(int(start), int(stop) + 1))
+        else:
+            values.append(cast(part))
+    return values
+
+
+def parse_margins(text):
+    """
+    Parse outpaint margins like "0,0,0,0; 256,256,0,0" into (left, right, up, down) tuples.
+    """
+    if not text:
+        return None
+
+    margins = []
+    for group in text.split(';'):
+        group = group.strip()
+        if not group:
+            continue
+        values = [int(v) for v in group.split(',')]
+        if len(values) != 4:
+            raise ValueError(f"Margins need four values (left,right,up,down): {group}")
+        margins.append(tuple(values))
+    return margins
+
+
+def expand_grid(base, seeds=None, image_strengths=None, control_strengths=None, margins=None):
+    """
+    Every combination of the given values, as params dicts built on top of base.
+    Axes that don't apply to base['method'] are ignored.
+    """
+    method = base.get('method', 'Image Generation')
+    axes = {
+        'seed': seeds or [base.get('seed', 0)],
+        'image_strength': (image_strengths if method == 'Image-to-Image' else None) or [base.get('image_strength', 0.5)],
+        'control_strength': (control_strengths if method == 'Image with Structure' else None) or [base.get('control_strength', 0.5)],
+        'margins': (margins if method == 'Outpaint' else None) or [tuple(int(base.get(k) or 0) for k in ('left', 'right', 'up', 'down'))],
+    }
+
+    variants = []
+    for seed, image_strength, control_strength, margin in itertools.product(*axes.values()):
+        params = dict(base, seed=seed, image_strength=image_strength, control_strength=control_strength)
+        params.update(zip(('left', 'right', 'up', 'down'), margin))
+        variants.append(params)
+    return variants
+
+
+def variant_label(params):
+    method = params.get('method', 'Image Generation')
+    label = f"seed {params.get('seed', 0)}"
+    if method == 'Image-to-Image':
+        label += f"  str {params.get('image_strength')}"
+    elif method == 'Image with Structure':
+        label += f"  ctl {params.get('control_strength')}"
+    elif method == 'Outpaint':
+        label += "  " + ",".join(str(params.get(k, 0)) for k in ('left', 'right', 'up', 'down'))
+    return label
+
+
+def make_contact_sheet(entries, path, tile_size=TILE_SIZE, columns=None):
+    """
+    Lay (image_path, label) entries out on a grid and save it to path.
+    Only one source image is decoded at a time; failed entries (image_path None) stay blank.
+    """
+    if not entries:
+        return None
+    from PIL import Image, ImageDraw  # only needed once a sweep is done
+
+    columns = columns or max(1, int(len(entries) ** 0.5 + 0.999))
+    rows = (len(entries) + columns - 1) // columns
+    cell_height = tile_size + LABEL_HEIGHT
+    sheet = Image.new('RGB', (columns * tile_size, rows * cell_height), 'white')
+    draw = ImageDraw.Draw(sheet)
+
+    for position, (image_path, label) in enumerate(entries):
+        x = (position % columns) * tile_size
+        y = (position // columns) * cell_height
+        if image_path:
+            try:
+                with Image.open(image_path) as img:
+                    img.draft('RGB', (tile_size, tile_size))
+                    img.thumbnail((tile_size, tile_size), Image.LANCZOS, reducing_gap=2.0)
+                    sheet.paste(img.convert('RGB'), (x + (tile_size - img.width) // 2, y + (tile_size - img.height) // 2))
+            except OSError:
+                label += "  (unreadable)"
+        else:
+            label += "  (failed)"
+        draw.text((x + 4, y + tile_size + 4), label, fill='black')
+
+    sheet.save(path)
+    return path
+
+
+def sheet_filename(output_dir, base):
+    timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+    if base.get('scene_index') is not None:
+        return f"{output_dir}/sweep_scene_{base['scene_index'] + 1}_image_{base['image_index'] + 1}_{timestamp}.png"
+    return f"{output_dir}/sweep_{timestamp}.png"
+
+
+def run_sweep(api_key, base, variants, output_dir='generated_images', concurrency=8, timeout=None, progress=None,
+              resume=True, credit_run=None):
+    """
+    Render every variant concurrently and build the contact sheet.
+    Returns (results, sheet_path); results are in the same order as variants.
+    Like a batch run, a restarted sweep skips the variants it already rendered.
+    API calls are charged to credit_run (a scheduler.Run) if given.
+    """
+    journal_path = run_path(output_dir, 'sweep', base)
+    if not resume and os.path.exists(journal_path):
+        os.remove(journal_path)
+    journal = RunJournal(journal_path)
+    try:
+        results = render_jobs(api_key, variants, output_dir, concurrency, timeout, progress, journal,
+                              credit_run=credit_run)
+    finally:
+        journal.close()
+    entries = [(result['filename'], variant_label(params)) for result, params in zip(results, variants)]
+    sheet_path = make_contact_sheet(entries, sheet_filename(output_dir, base))
+    return results, sheet_path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render a grid of variants of one prompt.")
+    parser.add_argument('json_file', nargs='?', help="Scene JSON file to take the prompt from")
+    parser.add_argument('--scene', type=int, default=1, help="Scene number (1-based)")
+    parser.add_argument('--image', type=int, default=1, help="Image number inside the scene (1-based)")
+    parser.add_argument('--prompt', help="Prompt to use instead of a scene JSON file")
+    parser.add_argument('--api-key', default=os.environ.get('STABILITY_API_KEY'))
+    parser.add_argument('--keys-file', help="File with one API key per line to spread requests over")
+    parser.add_argument('--method', default='Image Generation', choices=METHODS)
+    parser.add_argument('--reference', help="Reference image for the image-based methods")
+    parser.add_argument('--negative-prompt', default='')
+    parser.add_argument('--seeds', help="e.g. 1-16 or 3,7,42")
+    parser.add_argument('--image-strengths', help="e.g. 0.3,0.5 or 0.2:0.8:0.2")
+    parser.add_argument('--control-strengths', help="e.g. 0.4,0.6,0.8")
+    parser.add_argument('--margins', help='Outpaint margins, e.g. "256,256,0,0; 512,512,0,0"')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--output-dir', default='generated_images')
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--no-cache', action='store_true', help="Always call the API, ignoring cached results")
+    parser.add_argument('--cache-size', type=int, default=2048, help="Result cache size limit in MB")
+    parser.add_argument('--max-retries', type=int, default=4, help="Retries for 429/5xx and connection errors")
+    parser.add_argument('--fresh', action='store_true', help="Forget earlier runs of this sweep and render everything again")
+    add_budget_arguments(parser)
+    parser.add_argument('--layout', choices=LAYOUTS, default=os.environ.get('STABLECANVAS_LAYOUT') or 'flat',
+                        help="Output directories: flat, json, scene or date (see output_sink.py)")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.keys_file:
+            configure_key_pool(load_keys(args.keys_file))
+            args.api_key = None  # every request draws from the pool
+        elif not args.api_key and get_key_pool() is None and not args.forecast:
+            print("API key is required (--api-key, STABILITY_API_KEY, --keys-file or STABILITY_API_KEYS).", file=sys.stderr)
+            return 2
+        credit_run = configure_budget(args, 'sweep')
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+
+    base = {'method': args.method, 'negative_prompt': args.negative_prompt, 'reference_image': args.reference,
+            'scene_index': None, 'image_index': None}
+    try:
+        if args.prompt is not None:
+            base['prompt'] = args.prompt
+        elif args.json_file:
+            scenes = load_scenes(args.json_file)
+            base['prompt'] = scenes[args.scene - 1]['scene'][args.image - 1]['image_description']
+            base.update(scene_index=args.scene - 1, image_index=args.image - 1, json_file=args.json_file)
+        else:
+            parser.error("give a scene JSON file or --prompt")
+
+        variants = expand_grid(base, parse_values(args.seeds, int), parse_values(args.image_strengths),
+                               parse_values(args.control_strengths), parse_margins(args.margins))
+    except (OSError, ValueError, IndexError, KeyError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+
+    # Before the forecast, so it counts what this sweep's cache already holds
+    configure_cache(cache_dir=os.path.join(args.output_dir, '.cache'),
+                    max_bytes=args.cache_size * 1024 ** 2, enabled=not args.no_cache)
+    print_forecast(variants, args, run_path(args.output_dir, 'sweep', base))
+    if args.forecast:
+        return 0
+    configure_client(max_in_flight=args.concurrency, max_retries=args.max_retries,
+                     pool_size=max(32, args.concurrency), timeout=args.timeout)
+    configure_sink(args.layout)
+
+    def progress(result, done, total):
+        if result.get('deferred'):
+            return  # summed up at the end
+        print(f"[{done}/{total}] {result['filename'] or 'FAILED: ' + str(result['error'])}")
+
+    started = time.perf_counter()
+    results, sheet_path = run_sweep(args.api_key, base, variants, args.output_dir, args.concurrency, args.timeout, progress,
+                                    resume=not args.fresh, credit_run=credit_run)
+    counts = tally(results)
+    print(f"{counts['rendered']}/{counts['rendered'] + counts['failed']} variants in {time.perf_counter() - started:.1f}s, "
+          f"contact sheet: {sheet_path}")
+    if counts['skipped']:
+        print(f"Resumed: {counts['skipped']} variants were already finished or given up in an earlier run")
+    print_dedup()
+    print_spend(credit_run, results)
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,35 @@
+"""
+Regression tests for SceneStore loading. Run with: python -m pytest test_scene_store.py
+"""
+import json
+
+from scene_store import SceneStore
+
+
+def write_story(path, scene_count=3):
+    story = {'scenes': [{'scene': [{'image_description': f'scene {s} image {i}'} for i in range(2)]}
+                        for s in range(scene_count)]}
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(story, file, indent=4)
+
+
+def test_scenes_taken_before_load_see_the_loaded_file(tmp_path):
+    path = tmp_path / 'story.json'
+    write_story(path)
+    store = SceneStore(path)
+    scenes = store.scenes
+    store.load()
+    assert len(scenes) == 3
+    assert scenes[2]['scene'][1]['image_description'] == 'scene 2 image 1'
+
+
+def test_load_again_replaces_the_scenes(tmp_path):
+    path = tmp_path / 'story.json'
+    write_story(path)
+    store = SceneStore(path)
+    scenes = store.scenes
+    store.load()
+    write_story(path, scene_count=2)
+    store.load()
+    assert len(scenes) == 2
+    assert store.board.description(1, 0) == 'scene 1 image 0'
@@ -0,0 +1,113 @@
+"""
+Tests for the scheduler's credit budgets and call order. Run with: python -m pytest test_scheduler.py
+"""
+import threading
+import time
+
+import pytest
+
+from scheduler import BudgetExceeded, Run, Scheduler, using
+
+COST = 3.0  # a 'core' call
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def test_concurrent_calls_cannot_overshoot_a_hard_budget():
+    scheduler = Scheduler()
+    run = Run('batch', budget=10)
+    start = threading.Barrier(12)
+    sent, refused = [], []
+
+    def call():
+        start.wait()
+        try:
+            with using(run), scheduler.call('core') as ticket:
+                sent.append(ticket)
+                time.sleep(0.01)
+                ticket.charged = True
+        except BudgetExceeded:
+            refused.append(True)
+
+    threads = [threading.Thread(target=call) for _ in range(12)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(sent) == 3
+    assert len(refused) == 9
+    assert run.spent == 3 * COST <= run.budget
+    assert run.reserved == 0
+    assert run.exhausted()
+
+
+def test_credits_come_back_when_the_call_is_not_charged():
+    scheduler = Scheduler(daily_budget=100)
+    run = Run('batch', budget=COST)
+    ticket = scheduler.acquire('core', run)
+    assert run.reserved == COST
+    scheduler.release(ticket)  # e.g. a 500: the API didn't charge for it
+
+    assert run.spent == 0
+    assert run.reserved == 0
+    assert scheduler.spent_today() == 0
+    ticket = scheduler.acquire('core', run)  # the budget still covers one call
+    ticket.charged = True
+    scheduler.release(ticket)
+    assert run.spent == COST
+    with pytest.raises(BudgetExceeded):
+        scheduler.acquire('core', run)
+
+
+def test_a_call_held_up_by_reserved_credits_goes_once_they_are_handed_back():
+    scheduler = Scheduler()
+    run = Run('batch', budget=2 * COST)
+    first = scheduler.acquire('core', run)
+    second = scheduler.acquire('core', run)
+    third = []
+    thread = threading.Thread(target=lambda: third.append(scheduler.acquire('core', run)))
+    thread.start()
+    time.sleep(0.05)
+    assert not third  # waiting: it only fits if one of the calls in flight fails
+
+    scheduler.release(first)  # not charged
+    thread.join(5)
+    assert third
+    assert not run.exhausted()
+    for ticket in (second, third[0]):
+        ticket.charged = True
+        scheduler.release(ticket)
+    assert run.spent == 2 * COST
+    with pytest.raises(BudgetExceeded):
+        scheduler.acquire('core', run)
+    assert run.exhausted()
+
+
+def test_interactive_calls_go_ahead_of_batch_calls():
+    scheduler = Scheduler(slots=1)
+    batch, clicks = Run('batch', 'batch'), Run('clicks', 'interactive')
+    busy = scheduler.acquire('core', batch)
+    order = []
+
+    def call(run, name):
+        ticket = scheduler.acquire('core', run)
+        order.append(name)
+        scheduler.release(ticket)
+
+    waiting = [threading.Thread(target=call, args=(batch, 'batch'))]
+    waiting[0].start()
+    wait_for(lambda: len(scheduler._waiting) == 1)
+    waiting.append(threading.Thread(target=call, args=(clicks, 'interactive')))
+    waiting[1].start()
+    wait_for(lambda: len(scheduler._waiting) == 2)
+
+    scheduler.release(busy)
+    for thread in waiting:
+        thread.join(5)
+    assert order == ['interactive', 'batch']
@@ -0,0 +1,91 @@
+"""
+Tests for WorkQueue leases and attempts. Run with: python -m pytest test_work_queue.py
+"""
+import pytest
+
+from work_queue import WorkQueue
+
+JOB = {'scene_index': 0, 'image_index': 0, 'image_description': 'a lighthouse', 'method': 'Image Generation',
+       'seed': 1}
+
+
+@pytest.fixture
+def make_queue(tmp_path):
+    queues = []
+
+    def make(lease=60.0, max_attempts=3):
+        # A negative lease has run out as soon as it is taken, so no test has to sleep
+        queue = WorkQueue(tmp_path / 'queue.db', lease=lease, max_attempts=max_attempts)
+        queues.append(queue)
+        return queue
+
+    yield make
+    for queue in queues:
+        queue.close()
+
+
+def job_row(queue):
+    return dict(queue._db.execute('SELECT status, attempts, worker, filename, error FROM jobs').fetchone())
+
+
+def done(filename):
+    return {'filename': filename, 'error': None, 'elapsed': 1.0}
+
+
+def failed(error):
+    return {'filename': None, 'error': error, 'elapsed': 1.0}
+
+
+def test_expired_lease_is_re_leased_until_max_attempts(make_queue):
+    queue = make_queue(lease=-1, max_attempts=2)
+    queue.submit([JOB])
+    assert queue.claim('a') is not None
+    assert queue.claim('b') is not None
+    assert job_row(queue)['attempts'] == 2
+
+    assert queue.claim('c') is None
+    row = job_row(queue)
+    assert row['status'] == 'failed'
+    assert row['worker'] is None
+    assert queue.pending() == 0
+
+
+def test_failure_after_the_lease_was_reassigned_is_ignored(make_queue):
+    queue = make_queue(lease=-1)
+    queue.submit([JOB])
+    job_id, _ = queue.claim('a')
+    queue.claim('b')
+
+    queue.finish(job_id, 'a', failed('timed out'))
+    row = job_row(queue)
+    assert row['status'] == 'running'
+    assert row['worker'] == 'b'
+    assert row['error'] is None
+
+
+def test_done_is_kept_when_a_result_arrives_late(make_queue):
+    queue = make_queue(lease=-1)
+    queue.submit([JOB])
+    job_id, _ = queue.claim('a')
+    queue.claim('b')
+
+    queue.finish(job_id, 'a', done('first.png'))
+    queue.finish(job_id, 'b', failed('server error'))
+    queue.finish(job_id, 'b', done('second.png'))
+    row = job_row(queue)
+    assert row['status'] == 'done'
+    assert row['filename'] == 'first.png'
+    assert row['error'] is None
+
+
+def test_failure_is_retried_until_max_attempts(make_queue):
+    queue = make_queue(max_attempts=2)
+    queue.submit([JOB])
+    job_id, _ = queue.claim('a')
+    queue.finish(job_id, 'a', failed('server error'))
+    assert job_row(queue)['status'] == 'queued'
+
+    job_id, _ = queue.claim('a')
+    queue.finish(job_id, 'a', failed('server error'))
+    assert job_row(queue)['status'] == 'failed'
+    assert queue.claim('a') is None
@@ -0,0 +1,100 @@
+"""
+A list widget that only draws the rows on screen.
+
+Unlike a Listbox or Combobox it never holds a string per row: row_text(i) is
+called for the visible rows only, so a list of 100,000 entries costs the same
+to show as a list of ten.
+"""
+import tkinter as tk
+
+ROW_HEIGHT = 20
+
+
+class VirtualList(tk.Frame):
+    def __init__(self, master, row_text=None, on_select=None, rows=8, width=220):
+        super().__init__(master)
+        self.row_text = row_text or (lambda index: str(index))
+        self.on_select = on_select
+        self.count = 0
+        self.offset = 0
+        self.selected = None
+
+        self.canvas = tk.Canvas(self, width=width, height=rows * ROW_HEIGHT, bg="white",
+                                highlightthickness=1, highlightbackground="gray70", takefocus=1)
+        self.canvas.pack(side="left", fill="both", expand=True)
+        self.scrollbar = tk.Scrollbar(self, command=self.yview)
+        self.scrollbar.pack(side="right", fill="y")
+
+        self.canvas.bind("<Configure>", lambda event: self.redraw())
+        self.canvas.bind("<Button-1>", self.click)
+        self.canvas.bind("<MouseWheel>", lambda event: self.yview('scroll', -1 if event.delta > 0 else 1, 'units'))
+        self.canvas.bind("<Button-4>", lambda event: self.yview('scroll', -1, 'units'))
+        self.canvas.bind("<Button-5>", lambda event: self.yview('scroll', 1, 'units'))
+        self.canvas.bind("<Up>", lambda event: self.move(-1))
+        self.canvas.bind("<Down>", lambda event: self.move(1))
+
+    def set_count(self, count, row_text=None):
+        self.count = count
+        if row_text is not None:
+            self.row_text = row_text
+        self.offset = 0
+        self.selected = None
+        self.redraw()
+
+    def grow(self, count):
+        """
+        Show more rows at the end, keeping the scroll position and selection.
+        """
+        self.count = count
+        self.redraw()
+
+    def visible_rows(self):
+        return max(1, self.canvas.winfo_height() // ROW_HEIGHT)
+
+    def yview(self, *args):
+        if args[0] == 'moveto':
+            self.offset = int(float(args[1]) * self.count)
+        elif args[0] == 'scroll':
+            step = 1 if args[2] == 'units' else self.visible_rows()
+            self.offset += int(args[1]) * step
+        self.redraw()
+
+    def see(self, index):
+        visible = self.visible_rows()
+        if index < self.offset:
+            self.offset = index
+        elif index >= self.offset + visible:
+            self.offset = index - visible + 1
+        self.redraw()
+
+    def select(self, index, notify=True):
+        if not 0 <= index < self.count:
+            return
+        self.selected = index
+        self.see(index)
+        if notify and self.on_select:
+            self.on_select(index)
+
+    def move(self, step):
+        self.select(min(self.count - 1, max(0, (self.selected if self.selected is not None else -1) + step)))
+
+    def click(self, event):
+        self.canvas.focus_set()
+        self.select(self.offset + event.y // ROW_HEIGHT)
+
+    def redraw(self):
+        visible = self.visible_rows()
+        self.offset = max(0, min(self.offset, self.count - visible))
+        if self.count:
+            self.scrollbar.set(self.offset / self.count, min(1.0, (self.offset + visible) / self.count))
+        else:
+            self.scrollbar.set(0, 1)
+
+        width = self.canvas.winfo_width()
+        self.canvas.delete("all")
+        for row in range(min(visible, self.count - self.offset)):
+            index = self.offset + row
+            y = row * ROW_HEIGHT
+            if index == self.selected:
+                self.canvas.create_rectangle(0, y, width, y + ROW_HEIGHT, fill="#cce0ff", outline="")
+            self.canvas.create_text(4, y + ROW_HEIGHT // 2, text=self.row_text(index), anchor="w")
@@ -0,0 +1,359 @@
+"""
+Shared job queue for running several render workers at once.
+
+The queue is a SQLite file that any number of worker processes (on this machine,
+or on machines sharing the filesystem) pull scene/image jobs from. A worker
+claims a job by taking a lease on it and keeps the lease alive with heartbeats
+while the request runs. If a worker dies, its leases run out and another worker
+picks the jobs up. Every worker writes into the same output directory; names
+are claimed with exclusive creates, so two workers never overwrite each other.
+
+The queue uses SQLite's rollback journal rather than WAL, because WAL needs
+every process on one host. Workers on other machines should pass --no-index
+(index.db does use WAL) and the results can be indexed afterwards with `reindex`.
+
+SQLite relies on the filesystem's locks to keep two workers from claiming the
+same job, and file locking on network filesystems (NFS, SMB) is often broken
+or missing: workers there can take the same job or corrupt queue.db. Only share
+a queue between machines on a filesystem whose locks are known to work;
+otherwise keep every worker on the host where queue.db is on a local disk.
+
+A job whose lease runs out is leased again until it has used max_attempts, so
+one that keeps killing its worker ends up 'failed' instead of going round forever.
+
+Example:
+    python work_queue.py submit story.json --method "Image with Structure" --reference ref.png
+    python work_queue.py work --concurrency 4           # run one of these per process / machine
+    python work_queue.py status
+"""
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from batch_render import build_parser, parse_range, print_dedup, render_job, settings_from_args
+from engine import collect_jobs, load_scenes
+from http_client import configure_client
+from image_index import get_index
+from key_pool import configure_key_pool, get_key_pool, load_keys
+from output_sink import LAYOUTS, configure_sink
+from run_journal import DEFAULT_MAX_ATTEMPTS, job_key
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_until REAL,
+    filename TEXT,
+    error TEXT,
+    elapsed REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (status, lease_until);
+CREATE TABLE IF NOT EXISTS workers (
+    id TEXT PRIMARY KEY,
+    host TEXT,
+    pid INTEGER,
+    started_at REAL,
+    heartbeat REAL,
+    done INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+DEFAULT_QUEUE = 'generated_images/queue.db'
+LEASE_SECONDS = 60.0
+
+
+class WorkQueue:
+    def __init__(self, path=DEFAULT_QUEUE, lease=LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.path = str(path)
+        self.lease = lease
+        self.max_attempts = max_attempts
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # Autocommit; claims open their own BEGIN IMMEDIATE so two workers can't take the same job
+        self._db = sqlite3.connect(self.path, check_same_thread=False, timeout=60, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute('PRAGMA journal_mode=DELETE')
+        self._db.executescript(SCHEMA)
+
+    def submit(self, jobs):
+        """
+        Add jobs. A job that is already queued (same position and params) is not added twice.
+        Returns the number added.
+        """
+        now = time.time()
+        rows = [(job_key(job), json.dumps(job, ensure_ascii=False), now, now) for job in jobs]
+        with self._lock:
+            before = self._db.total_changes
+            self._db.execute('BEGIN IMMEDIATE')
+            self._db.executemany('INSERT OR IGNORE INTO jobs (key, params, created_at, updated_at) '
+                                 'VALUES (?, ?, ?, ?)', rows)
+            self._db.execute('COMMIT')
+            return self._db.total_changes - before
+
+    def claim(self, worker):
+        """
+        Lease the next queued job (or one whose lease ran out) to worker.
+        Returns (id, params) or None if there is nothing to do. A job whose lease ran out
+        after max_attempts (e.g. it keeps killing its worker) is marked failed instead.
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._db.execute(
+                    "UPDATE jobs SET status = 'failed', error = 'lease ran out on every attempt (the worker may have died)', "
+                    "worker = NULL, lease_until = NULL, updated_at = ? "
+                    "WHERE status = 'running' AND lease_until < ? AND attempts >= ?", (now, now, self.max_attempts))
+                row = self._db.execute(
+                    "SELECT id, params FROM jobs WHERE status = 'queued' "
+                    "OR (status = 'running' AND lease_until < ? AND attempts < ?) ORDER BY id LIMIT 1",
+                    (now, self.max_attempts)).fetchone()
+                if row is not None:
+                    self._db.execute(
+                        "UPDATE jobs SET status = 'running', worker = ?, lease_until = ?, attempts = attempts + 1, "
+                        "updated_at = ? WHERE id = ?", (worker, now + self.lease, now, row['id']))
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+        return None if row is None else (row['id'], json.loads(row['params']))
+
+    def heartbeat(self, worker):
+        """
+        Extend the leases of every job worker holds.
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute("UPDATE jobs SET lease_until = ? WHERE worker = ? AND status = 'running'",
+                             (now + self.lease, worker))
+            self._db.execute('UPDATE workers SET heartbeat = ? WHERE id = ?', (now, worker))
+
+    def finish(self, job_id, worker, result):
+        """
+        Record a result. A failed job goes back in the queue until it has used max_attempts.
+        """
+        now = time.time()
+        with self._lock:
+            if result['error']:
+                self._db.execute(
+                    "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, "
+                    "error = ?, worker = NULL, lease_until = NULL, elapsed = ?, updated_at = ? "
+                    "WHERE id = ? AND worker = ?",
+                    (self.max_attempts, result['error'], result['elapsed'], now, job_id, worker))
+                self._db.execute('UPDATE workers SET failed = failed + 1 WHERE id = ?', (worker,))
+            else:
+                # Even if the lease was lost meanwhile, the image exists: keep the first result
+                self._db.execute(
+                    "UPDATE jobs SET status = 'done', filename = ?, error = NULL, worker = NULL, lease_until = NULL, "
+                    "elapsed = ?, updated_at = ? WHERE id = ? AND status != 'done'",
+                    (result['filename'], result['elapsed'], now, job_id))
+                self._db.execute('UPDATE workers SET done = done + 1 WHERE id = ?', (worker,))
+
+    def register(self, worker):
+        now = time.time()
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO workers (id, host, pid, started_at, heartbeat) '
+                             'VALUES (?, ?, ?, ?, ?)', (worker, socket.gethostname(), os.getpid(), now, now))
+
+    def pending(self):
+        """
+        Jobs not finished yet: queued, running, or held by a worker that may have died.
+        """
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')").fetchone()[0]
+
+    def counts(self):
+        with self._lock:
+            rows = self._db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        return {status: count for status, count in rows}
+
+    def workers(self, alive_within=None):
+        alive_within = alive_within or 2 * self.lease
+        with self._lock:
+            rows = self._db.execute('SELECT * FROM workers WHERE heartbeat >= ? ORDER BY started_at',
+                                    (time.time() - alive_within,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def done_jobs(self):
+        with self._lock:
+            rows = self._db.execute("SELECT params, filename, elapsed, updated_at FROM jobs "
+                                    "WHERE status = 'done'").fetchall()
+        return [(json.loads(row['params']), row['filename'], row['elapsed'], row['updated_at']) for row in rows]
+
+    def retry_failed(self):
+        with self._lock:
+            return self._db.execute("UPDATE jobs SET status = 'queued', attempts = 0 "
+                                    "WHERE status = 'failed'").rowcount
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def make_worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}'
+
+
+def run_worker(queue, api_key, output_dir='generated_images', concurrency=4, timeout=None, index=True,
+               exit_when_empty=False, poll_interval=2.0, progress=None, stop=None):
+    """
+    Pull and render jobs until stopped (or, with exit_when_empty, until the queue is drained).
+    Returns (done, failed) counts for this worker.
+    """
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    worker = make_worker_id()
+    queue.register(worker)
+    stop = stop or threading.Event()
+    counts = {'done': 0, 'failed': 0}
+    counts_lock = threading.Lock()
+
+    def beat():
+        while not stop.wait(queue.lease / 3):
+            queue.heartbeat(worker)
+
+    def work():
+        while not stop.is_set():
+            claimed = queue.claim(worker)
+            if claimed is None:
+                if exit_when_empty and not queue.pending():
+                    return
+                stop.wait(poll_interval)
+                continue
+
+            job_id, job = claimed
+            result = render_job(api_key, job, output_dir, timeout, index=index)
+            queue.finish(job_id, worker, result)
+            with counts_lock:
+                counts['failed' if result['error'] else 'done'] += 1
+            if progress:
+                progress(worker, result)
+
+    heartbeat = threading.Thread(target=beat, name='queue-heartbeat', daemon=True)
+    heartbeat.start()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        futures = [pool.submit(work) for _ in range(max(1, concurrency))]
+        try:
+            for future in futures:
+                future.result()
+        finally:
+            # On Ctrl-C the jobs in progress still finish and are recorded
+            stop.set()
+    return counts['done'], counts['failed']
+
+
+def reindex(queue, output_dir='generated_images'):
+    """
+    Add every finished job to index.db, for workers that ran with --no-index.
+    """
+    index = get_index(output_dir)
+    added = 0
+    for params, filename, elapsed, finished_at in queue.done_jobs():
+        if index.find(filename) is None and os.path.exists(filename):
+            index.record(filename, params, json_file=params.get('json_file'), scene_index=params.get('scene_index'),
+                         image_index=params.get('image_index'), latency=elapsed,
+                         size=os.path.getsize(filename), created_at=finished_at)
+            added += 1
+    return added
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Share render jobs between worker processes.")
+    parser.add_argument('--queue', default=DEFAULT_QUEUE, help="Queue database (on a shared filesystem for several machines)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    # submit takes the same job options as batch_render.py
+    commands.add_parser('submit', parents=[build_parser(add_help=False)], help="Queue every image of a scene JSON file")
+
+    work = commands.add_parser('work', help="Run a worker")
+    work.add_argument('--api-key', default=os.environ.get('STABILITY_API_KEY'))
+    work.add_argument('--keys-file', help="File with one API key per line to spread requests over")
+    work.add_argument('--concurrency', type=int, default=4, help="Jobs this worker runs at once")
+    work.add_argument('--output-dir', default='generated_images')
+    work.add_argument('--timeout', type=float, default=120)
+    work.add_argument('--lease', type=float, default=LEASE_SECONDS, help="Seconds before a silent worker's jobs are reassigned")
+    work.add_argument('--max-attempts', type=int, default=DEFAULT_MAX_ATTEMPTS)
+    work.add_argument('--layout', choices=LAYOUTS, default=os.environ.get('STABLECANVAS_LAYOUT') or 'flat',
+                      help="Output directories: flat, json, scene or date (see output_sink.py)")
+    work.add_argument('--no-index', action='store_true', help="Don't write index.db (for workers on other machines)")
+    work.add_argument('--exit-when-empty', action='store_true', help="Stop once every job is finished")
+
+    commands.add_parser('status', help="Show job counts and live workers")
+    commands.add_parser('retry', help="Put failed jobs back in the queue")
+    reindex_parser = commands.add_parser('reindex', help="Add finished jobs to index.db")
+    reindex_parser.add_argument('--output-dir', default='generated_images')
+    args = parser.parse_args(argv)
+
+    queue = WorkQueue(args.queue, lease=getattr(args, 'lease', LEASE_SECONDS),
+                      max_attempts=getattr(args, 'max_attempts', DEFAULT_MAX_ATTEMPTS))
+    try:
+        if args.command == 'submit':
+            try:
+                settings = dict(settings_from_args(args), json_file=args.json_file)
+                jobs = collect_jobs(load_scenes(args.json_file), settings, parse_range(args.scenes),
+                                    parse_range(args.images), Path(args.json_file).parent)
+            except (OSError, ValueError) as e:
+                print(f"Error: {e}", file=sys.stderr)
+                return 2
+            print(f"Queued {queue.submit(jobs)} of {len(jobs)} jobs in {args.queue}")
+
+        elif args.command == 'work':
+            try:
+                if args.keys_file:
+                    configure_key_pool(load_keys(args.keys_file))
+                    args.api_key = None
+                elif not args.api_key and get_key_pool() is None:
+                    print("API key is required (--api-key, STABILITY_API_KEY, --keys-file or STABILITY_API_KEYS).",
+                          file=sys.stderr)
+                    return 2
+            except (OSError, ValueError) as e:
+                print(f"Error: {e}", file=sys.stderr)
+                return 2
+            configure_client(max_in_flight=args.concurrency, pool_size=max(32, args.concurrency), timeout=args.timeout)
+            configure_sink(args.layout)
+
+            def progress(worker, result):
+                print(f"{result['filename'] or 'FAILED: ' + str(result['error'])} ({result['elapsed']:.1f}s)")
+
+            try:
+                done, failed = run_worker(queue, args.api_key, args.output_dir, args.concurrency, args.timeout,
+                                          index=not args.no_index, exit_when_empty=args.exit_when_empty,
+                                          progress=progress)
+            except KeyboardInterrupt:
+                return 130
+            print(f"Worker finished: {done} done, {failed} failed")
+            print_dedup()
+
+        elif args.command == 'status':
+            counts = queue.counts()
+            print(', '.join(f"{counts.get(status, 0)} {status}" for status in ('queued', 'running', 'done', 'failed')))
+            for worker in queue.workers():
+                print(f"  {worker['id']}: {worker['done']} done, {worker['failed']} failed, "
+                      f"last seen {time.time() - worker['heartbeat']:.0f}s ago")
+
+        elif args.command == 'retry':
+            print(f"Requeued {queue.retry_failed()} failed jobs")
+
+        elif args.command == 'reindex':
+            print(f"Indexed {reindex(queue, args.output_dir)} images")
+    finally:
+        queue.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())